@@ -0,0 +1,188 @@
+"""
+Hardware backends for the display, the LED strands and the button.
+
+"pi": the real hardware. The Adafruit/rpi_ws281x/gpiozero libraries are only
+      imported when these are created (and their import time is recorded in the
+      startup timeline).
+"sim": in memory stand-ins with simulated transfer times, so the render loop
+       can be run and profiled on any Linux box.
+"""
+from time import sleep
+from typing import Callable, List, Optional, Tuple
+
+import adafruit_framebuf
+
+from startup import timeline
+
+DISPLAY_WIDTH = 128
+DISPLAY_HEIGHT = 64
+I2C_FREQUENCY = 800000
+DISPLAY_ROTATION = 2
+
+# WS2812B: 24 bits per LED at 800kHz, followed by >50us reset
+LED_SECONDS_PER_PIXEL = 24 / 800000
+LED_RESET_SECONDS = 50e-6
+
+
+def Color(red: int, green: int, blue: int, white: int = 0) -> int:
+    """
+    Same packing as rpi_ws281x.Color, without needing the library
+    """
+    return (white << 24) | (red << 16) | (green << 8) | blue
+
+
+class _SimI2CDevice(object):
+    def __init__(self, display: "SimSSD1306"):
+        self.display = display
+
+    def __enter__(self) -> "_SimI2CDevice":
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+    def write(self, data) -> None:
+        self.display._receive(bytes(data))
+
+
+class SimSSD1306(adafruit_framebuf.FrameBuffer):
+    """
+    Stand-in for adafruit_ssd1306.SSD1306_I2C (horizontal addressing mode).
+
+    Emulates the display RAM (ram) and sleeps for the time the I2C
+    transfer would take (9 clock cycles per byte, plus address byte)
+    if simulate_timing is set.
+    """
+    def __init__(self, width: int, height: int, simulate_timing: bool = True,
+                 frequency: int = I2C_FREQUENCY):
+        self.buffer = bytearray(width * height // 8 + 1)
+        self.buffer[0] = 0x40
+        super().__init__(memoryview(self.buffer)[1:], width, height, adafruit_framebuf.MVLSB)
+        self.pages = height // 8
+        self.page_addressing = False
+        self.i2c_device = _SimI2CDevice(self)
+        self.simulate_timing = simulate_timing
+        self.frequency = frequency
+        self.ram = bytearray(width * height // 8)
+        self.bytes_sent = 0
+        self.transactions = 0
+        self._cmds: List[int] = []
+        self._window = (0, width - 1, 0, self.pages - 1)
+
+    def _transfer(self, n_bytes: int) -> None:
+        self.bytes_sent += n_bytes
+        self.transactions += 1
+        if self.simulate_timing:
+            sleep((n_bytes + 1) * 9 / self.frequency)
+
+    def write_cmd(self, cmd: int) -> None:
+        self._transfer(2)
+        self._cmds.append(cmd)
+        if len(self._cmds) == 3 and self._cmds[0] == 0x21:
+            self._window = (self._cmds[1], self._cmds[2]) + self._window[2:]
+            self._cmds = []
+        elif len(self._cmds) == 3 and self._cmds[0] == 0x22:
+            self._window = self._window[:2] + (self._cmds[1], self._cmds[2])
+            self._cmds = []
+        elif self._cmds[0] not in (0x21, 0x22):
+            self._cmds = []
+
+    def _receive(self, data: bytes) -> None:
+        self._transfer(len(data))
+        if data[:1] != b"\x40":
+            return
+        col0, col1, page0, page1 = self._window
+        col, page = col0, page0
+        for byte in data[1:]:
+            self.ram[page * self.width + col] = byte
+            col += 1
+            if col > col1:
+                col = col0
+                page = page0 if page >= page1 else page + 1
+
+    def show(self) -> None:
+        for cmd in (0x21, 0, self.width - 1, 0x22, 0, self.pages - 1):
+            self.write_cmd(cmd)
+        self._receive(bytes(self.buffer))
+
+
+class SimPixelStrip(object):
+    """
+    Stand-in for rpi_ws281x.PixelStrip, sleeps for the time the data transfer
+    would take on show() if simulate_timing is set.
+    """
+    def __init__(self, num: int, pin: int, channel: int = 0, simulate_timing: bool = True):
+        self.num = num
+        self.pin = pin
+        self.channel = channel
+        self.simulate_timing = simulate_timing
+        self.pixels = [0] * num
+        self.shown = [0] * num
+        self.n_shows = 0
+
+    def begin(self) -> None:
+        pass
+
+    def numPixels(self) -> int:
+        return self.num
+
+    def setPixelColor(self, n: int, color: int) -> None:
+        self.pixels[n] = color
+
+    def getPixelColor(self, n: int) -> int:
+        return self.pixels[n]
+
+    def show(self) -> None:
+        self.shown = list(self.pixels)
+        self.n_shows += 1
+        if self.simulate_timing:
+            sleep(self.num * LED_SECONDS_PER_PIXEL + LED_RESET_SECONDS)
+
+
+class SimButton(object):
+    def __init__(self, pin: int):
+        self.pin = pin
+        self.when_released: Optional[Callable[[], None]] = None
+
+    def release(self) -> None:
+        if self.when_released is not None:
+            self.when_released()
+
+
+def create_display(backend: str, simulate_timing: bool = True):
+    if backend == "pi":
+        board = timeline.import_module("board")
+        busio = timeline.import_module("busio")
+        adafruit_ssd1306 = timeline.import_module("adafruit_ssd1306")
+        i2c = busio.I2C(board.SCL, board.SDA, frequency=I2C_FREQUENCY)
+        display = adafruit_ssd1306.SSD1306_I2C(DISPLAY_WIDTH, DISPLAY_HEIGHT, i2c)
+    elif backend == "sim":
+        display = SimSSD1306(DISPLAY_WIDTH, DISPLAY_HEIGHT, simulate_timing)
+    else:
+        raise ValueError(f"Unknown backend {backend}")
+    display.rotation = DISPLAY_ROTATION
+    return display
+
+
+def create_strands(backend: str, n_leds: int, pin1: int, pin2: int,
+                   simulate_timing: bool = True) -> Tuple:
+    if backend == "pi":
+        PixelStrip = timeline.import_module("rpi_ws281x").PixelStrip
+        strands = (PixelStrip(n_leds, pin1), PixelStrip(n_leds, pin2, channel=1))
+    elif backend == "sim":
+        strands = (SimPixelStrip(n_leds, pin1, simulate_timing=simulate_timing),
+                   SimPixelStrip(n_leds, pin2, channel=1, simulate_timing=simulate_timing))
+    else:
+        raise ValueError(f"Unknown backend {backend}")
+    for s in strands:
+        s.begin()
+    return strands
+
+
+def create_button(backend: str, pin: int):
+    if backend == "pi":
+        gpiozero = timeline.import_module("gpiozero")
+        return gpiozero.Button(pin, bounce_time=0.05)
+    elif backend == "sim":
+        return SimButton(pin)
+    raise ValueError(f"Unknown backend {backend}")
@@ -0,0 +1,550 @@
+"""
+End-to-end throughput benchmark, runs on any Linux box using the "sim" backend.
+
+Writes a synthetic reference and VCFs (fixtures.py, plus packed reference and
+consensus tracks) to a temporary directory and reports:
+    loci/s: consensus iteration speed of each data source (fasta, packed, track)
+    start at calls: loci differing from the full consensus and calls dropped as unsorted
+                    when iteration starts exactly at / right after a call (should be 0)
+    jump latency: time from choosing a random location to its first locus
+    reference streaming: bases/s of dna.iterate_ref_blocks and the per-base iterate_ref
+    Locus vs CompactLocus: time and memory per locus of a whole contig iteration
+    startup: time from process start to the loading message and the first frame
+             (in a new process, with the indexes loaded up front or in the background,
+             and resuming from a checkpoint)
+    pacing: per frame cost of scanning the window vs. querying the variant density map,
+            and the share of frames fast-forwarded
+    variant tour: variants/s of the sparse tour over a whole contig (fasta and packed
+                  reference) vs. the full consensus walk, and the tour loci that differ
+                  from the full consensus (should be 0, with and without filters)
+    playlist: staging time per region, switch latency to the next region and
+              stalls waiting for staging, loci/s of a random BED playlist
+    frames/s: the run loop (prefetcher, window, render, display, LEDs) without
+              the frame rate cap (render and transfer overlap, no frames dropped)
+    peak RSS of the process
+
+Usage: python benchmark.py [--size 6M] [--frames N] [--no-timing] ...
+Needs adafruit_framebuf (pip install adafruit-circuitpython-framebuf), nothing else
+beyond the standard library.
+"""
+import argparse
+import logging
+import os
+import json
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from collections import deque
+from itertools import islice
+from time import perf_counter
+from typing import Dict, Iterable, List
+
+from config import (CONTIGS, JUMP_PROB, N_BASES_DISPLAYED, N_LEDS, PREFETCH_QUEUE_SIZE,
+                    PLAYLIST_BUFFER_BYTES, PLAYLIST_MAX_REGION_BASES)
+from density import build_density
+from dna import (get_consensus_sequence, iterate_ref, iterate_ref_blocks, read_fai,
+                 ConsensusBlock, RefStatus, VariantType)
+from fixtures import FixtureSpec, generate, parse_size
+from main import (DNAIterator, DNASculpture, LociPrefetcher, PlaybackPacer, COLOR_TABLES,
+                  FRAME_STAGES, N_REF_STATUS, iterate_sliding)
+from packed_ref import PackedContig, convert_contig
+from playlist import Region, RegionStager, read_bed, stage_region
+from regions import ContigRegions, count_variants, find_valid_intervals, save_regions
+from timing import FrameStats
+from track import ConsensusTrack, compile_contig
+from vcf_bulk import read_columns
+
+
+def prepare_data(data_dir: str, contigs: List[str], n_bases: int, variant_rate: float,
+                 seed: int = 0) -> Dict:
+    """
+    Synthetic reference and VCFs (see fixtures.py) plus their packed reference,
+    consensus tracks, variant density maps and valid regions index. Returns the paths in the layout of config.py.
+    """
+    fixture = generate(data_dir, n_bases, contigs, FixtureSpec(variant_rate=variant_rate), seed)
+    paths = {"fasta": fixture.fasta_path, "fai": fixture.fai_path, "vcf": fixture.vcf_paths,
+             "packed": {}, "track": {}, "density": {}, "regions": os.path.join(data_dir, "valid_regions.bin")}
+    regions = {}
+    fai_index = read_fai(fixture.fai_path, contigs)
+    with open(fixture.fasta_path, "rb") as ref_file:
+        for contig in contigs:
+            packed_path = os.path.join(data_dir, f"ref_{contig}.2bit")
+            with open(packed_path, "wb") as out_file:
+                convert_contig(ref_file, fai_index[contig], out_file)
+            paths["packed"][contig] = packed_path
+
+            track_path = os.path.join(data_dir, f"track_{contig}.bin")
+            with PackedContig(packed_path, contig) as packed, open(track_path, "wb") as out_file:
+                compile_contig(paths["vcf"][contig], packed, fai_index[contig], out_file)
+                starts, ends = find_valid_intervals(packed)
+            paths["track"][contig] = track_path
+
+            density_path = os.path.join(data_dir, f"density_{contig}.bin")
+            with open(density_path, "wb") as out_file:
+                build_density(paths["vcf"][contig], contig, fai_index[contig].len, out_file)
+            paths["density"][contig] = density_path
+
+            n_variants = count_variants(starts, ends,
+                                        read_columns(paths["vcf"][contig], contig).pos)
+            regions[contig] = ContigRegions(contig, packed.len, starts, ends, n_variants)
+    save_regions(paths["regions"], regions)
+    return paths
+
+
+def bench_loci(paths: Dict, contigs: List[str], n_loci: int) -> None:
+    sources = {
+        "fasta": DNAIterator(paths["fasta"], contigs, paths["vcf"], paths["fai"]),
+        "packed": DNAIterator(paths["fasta"], contigs, paths["vcf"], paths["fai"],
+                              paths["packed"]),
+        "track": DNAIterator(paths["fasta"], contigs, paths["vcf"], paths["fai"],
+                             paths["packed"], paths["track"]),
+    }
+    # skip the N run at the start of the contig
+    start_pos = sources["fasta"].fai_index[contigs[0]].len // 4
+    for name, dna_iterator in sources.items():
+        t0 = perf_counter()
+        n = sum(1 for _ in islice(dna_iterator.iterate_loci(contigs[0], start_pos), n_loci))
+        t = perf_counter() - t0
+        print(f"loci/s ({name}): {n / t:.0f} ({n} loci in {t:.2f}s)")
+
+
+def _consensus_windows(paths: Dict, contig: str, starts: List[int], n: int) -> Dict[int, List]:
+    """
+    The first n loci of the full consensus from each of the sorted 0-based starts
+    """
+    windows: Dict[int, List] = {start: [] for start in starts}
+    active: deque = deque()
+    next_starts = iter(starts)
+    start = next(next_starts, None)
+    for l in _iterate_contig(paths, contig, "packed", compact=True):
+        while start is not None and l.pos > start:
+            active.append(start)
+            start = next(next_starts, None)
+        for s in active:
+            windows[s].append(l)
+        while active and len(windows[active[0]]) >= n:
+            active.popleft()
+        if start is None and not active:
+            break
+    return windows
+
+
+class _UnsortedDrops(logging.Handler):
+    """
+    Counts the calls dropped as unsorted (see dna.resolve_calls)
+    """
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.n = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if "(unsorted" in record.getMessage():
+            self.n += 1
+
+
+def check_start_at_calls(paths: Dict, contigs: List[str], n_starts: int = 200,
+                         n: int = 50) -> None:
+    """
+    Starts iteration exactly at calls (not inside an earlier one) and right after
+    single base calls, and compares the first n loci with the full consensus
+    """
+    contig = contigs[0]
+    cols = read_columns(paths["vcf"][contig], contig)
+    starts = []
+    prev_end = 0
+    for pos, ref_len, passed, gt1, gt2 in zip(cols.pos, cols.ref_len, cols.passed,
+                                              cols.gt1, cols.gt2):
+        if not passed:
+            continue
+        if pos - 1 >= prev_end and (gt1 > 0 or gt2 > 0):
+            starts.append(pos - 1)
+            if ref_len == 1:
+                starts.append(pos)
+        prev_end = max(prev_end, pos - 1 + ref_len)
+    starts = sorted(set(starts[::max(len(starts) // n_starts, 1)]))
+    expected = _consensus_windows(paths, contig, starts, n)
+    root = logging.getLogger()
+    level, handlers = root.level, root.handlers
+    results = []
+    for name, packed_paths, track_paths in (("fasta", None, None),
+                                            ("packed", paths["packed"], None),
+                                            ("track", paths["packed"], paths["track"])):
+        dna_iterator = DNAIterator(paths["fasta"], contigs, paths["vcf"], paths["fai"],
+                                   packed_paths, track_paths)
+        n_diff = 0
+        drops = _UnsortedDrops()
+        root.handlers = [drops]
+        root.setLevel(logging.WARNING)
+        try:
+            for start in starts:
+                got = list(islice(dna_iterator.iterate_loci(contig, start), n))
+                n_diff += (abs(len(got) - len(expected[start]))
+                           + sum(a != b for a, b in zip(got, expected[start])))
+        finally:
+            root.handlers = handlers
+            root.setLevel(level)
+        dna_iterator.close()
+        results.append(f"{name} {n_diff} ({drops.n} dropped)")
+    print(f"start at calls ({len(starts)} starts, {n} loci each), loci differing from "
+          f"the full consensus: " + ", ".join(results))
+
+
+def bench_ref_stream(paths: Dict, contig: str) -> None:
+    fai_line = read_fai(paths["fai"], [contig])[contig]
+    with open(paths["fasta"], "rb") as ref_file:
+        t0 = perf_counter()
+        n_blocks = sum(len(codes) for _, codes in iterate_ref_blocks(ref_file, fai_line))
+        t1 = perf_counter()
+        n_bases = sum(1 for _ in iterate_ref(ref_file, fai_line))
+        t2 = perf_counter()
+    print(f"reference streaming: blocks {n_blocks / (t1 - t0):.0f} bases/s, "
+          f"per base {n_bases / (t2 - t1):.0f} bases/s")
+
+
+def _iterate_contig(paths: Dict, contig: str, source: str, compact: bool):
+    fai_line = read_fai(paths["fai"], [contig])[contig]
+    with PackedContig(paths["packed"][contig], contig) as packed:
+        if source == "track":
+            with ConsensusTrack(paths["track"][contig], packed) as track:
+                yield from track.iterate_from(0, compact=compact)
+        else:
+            yield from get_consensus_sequence(paths["vcf"][contig], None, fai_line, 0,
+                                              reference=packed, compact=compact)
+
+
+def bench_locus_repr(paths: Dict, contig: str, n_kept: int = 100000) -> None:
+    """
+    Whole contig iteration with the colour table lookup of the render loop,
+    and the memory of n_kept loci (incl. their list slot)
+    """
+    table = COLOR_TABLES[0]
+    for source in ("builder", "track"):
+        results = {}
+        for compact in (False, True):
+            t0 = perf_counter()
+            n = 0
+            if compact:
+                for l in _iterate_contig(paths, contig, source, True):
+                    color = table[l.b2 * N_REF_STATUS + l.rs]
+                    n += 1
+            else:
+                for l in _iterate_contig(paths, contig, source, False):
+                    color = table[l.bases[1].value * N_REF_STATUS + l.ref_status.value]
+                    n += 1
+            t = perf_counter() - t0
+
+            tracemalloc.start()
+            loci = list(islice(_iterate_contig(paths, contig, source, compact), n_kept))
+            nbytes = tracemalloc.get_traced_memory()[0] / len(loci)
+            tracemalloc.stop()
+            del loci
+            results[compact] = (1e6 * t / n, nbytes)
+        (t_enum, b_enum), (t_compact, b_compact) = results[False], results[True]
+        print(f"Locus vs CompactLocus ({source}, {n} loci): {t_enum:.3f} vs {t_compact:.3f}us/locus "
+              f"({t_enum / t_compact:.1f}x), {b_enum:.0f} vs {b_compact:.0f} bytes/locus")
+
+
+def bench_jumps(dna_iterator: DNAIterator, n_jumps: int, name: str) -> None:
+    latencies = []
+    for _ in range(n_jumps):
+        t0 = perf_counter()
+        l_it = dna_iterator.iterate_from_random()
+        next(l_it)
+        latencies.append(perf_counter() - t0)
+        l_it.close()
+    latencies.sort()
+    print(f"jump latency ({name}): mean {1000 * sum(latencies) / len(latencies):.1f}ms "
+          f"p95 {1000 * latencies[int(0.95 * (len(latencies) - 1))]:.1f}ms "
+          f"max {1000 * latencies[-1]:.1f}ms")
+
+
+# the startup path of main.py, with the sim backend and the benchmark data
+STARTUP_SCRIPT = """
+import json, logging, sys
+logging.basicConfig(level="CRITICAL")
+from startup import timeline
+from main import DNAIterator, DNASculpture
+paths, contigs, background, checkpoint_path = json.loads(sys.argv[1])
+sculpture = DNASculpture("sim")
+with timeline.stage("dna iterator"):
+    dna_iterator = DNAIterator(paths["fasta"], contigs, paths["vcf"], paths["fai"], paths["packed"],
+                               paths["track"], paths["regions"], load_in_background=background)
+sculpture.run(dna_iterator, max_frames=1, checkpoint_path=checkpoint_path)
+if checkpoint_path is not None:
+    sculpture.checkpointer.write()
+print(json.dumps(timeline.events))
+"""
+
+
+def bench_startup(paths: Dict, contigs: List[str], data_dir: str) -> None:
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    checkpoint_path = os.path.join(data_dir, "checkpoint.json")
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    runs = [("up front index loading", False, None), ("background index loading", True, None),
+            ("writing a checkpoint", True, checkpoint_path),
+            ("resuming from the checkpoint", True, checkpoint_path)]
+    for label, background, checkpoint in runs:
+        out = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT,
+                              json.dumps([paths, contigs, background, checkpoint])],
+                             cwd=code_dir, check=True, capture_output=True, text=True).stdout
+        events = {name: (t, d) for name, t, d in json.loads(out)}
+        print(f"startup ({label}): "
+              f"loading message {events['loading message'][0]:.3f}s, "
+              f"first frame {events['first frame'][0]:.3f}s")
+        print("  " + ", ".join(f"{name} {t:.3f}s" + (f" ({d:.3f}s)" if d is not None else "")
+                               for name, (t, d) in sorted(events.items(), key=lambda e: e[1][0])))
+
+
+def bench_pacing(paths: Dict, contig: str, n_frames: int = 100000) -> None:
+    dna_iterator = DNAIterator(paths["fasta"], [contig], paths["vcf"], paths["fai"],
+                               paths["packed"], paths["track"], density_paths=paths["density"])
+    pacer = PlaybackPacer(dna_iterator.cache)
+    pacer.pace(next(iterate_sliding(dna_iterator.iterate_loci(contig, 0), N_BASES_DISPLAYED)))
+    results = {}
+    for name in ("window scan", "density map"):
+        windows = iterate_sliding(dna_iterator.iterate_loci(contig, 0), N_BASES_DISPLAYED)
+        t = 0.0
+        n = 0
+        for window in islice(windows, n_frames):
+            t0 = perf_counter()
+            if name == "window scan":
+                any(window.ref_status(N_LEDS))
+            else:
+                pacer.pace(window)
+            t += perf_counter() - t0
+            n += 1
+        results[name] = 1e6 * t / n
+    print("pacing: " + ", ".join(f"{name} {us:.2f}us/frame" for name, us in results.items())
+          + f", {pacer.n_fast_forward / n:.0%} of frames fast-forwarded")
+    dna_iterator.close()
+
+
+def _tour_mismatches(paths: Dict, contig: str, blocks: Iterable[ConsensusBlock]) -> int:
+    """
+    # of loci of the tour blocks that differ from the full consensus of the same stretches
+    """
+    full = _iterate_contig(paths, contig, "packed", compact=True)
+    l = next(full, None)
+    n = 0
+    for block in blocks:
+        start, end = block.pos[0] - 1, max(block.pos)
+        while l is not None and l.pos <= start:
+            l = next(full, None)
+        expected = []
+        while l is not None and l.pos <= end:
+            expected.append(l)
+            l = next(full, None)
+        got = list(block.compact_loci())
+        n += abs(len(got) - len(expected)) + sum(a != b for a, b in zip(got, expected))
+    return n
+
+
+def bench_tour(paths: Dict, contig: str, flank: int = 10) -> None:
+    n_calls = len(read_columns(paths["vcf"][contig], contig).pos)
+    t0 = perf_counter()
+    n_loci = sum(1 for _ in _iterate_contig(paths, contig, "packed", compact=True))
+    t_full = perf_counter() - t0
+    results = []
+    for name, packed_paths in (("fasta", None), ("packed", paths["packed"])):
+        dna_iterator = DNAIterator(paths["fasta"], [contig], paths["vcf"], paths["fai"],
+                                   packed_paths, tour_flank=flank)
+        t0 = perf_counter()
+        n_stops = 0
+        n_shown = 0
+        for block in dna_iterator.iterate_tour(contig, 0):
+            n_stops += 1
+            n_shown += len(block.pos)
+        t = perf_counter() - t0
+        dna_iterator.close()
+        results.append(f"{name} {n_calls / t:.0f} variants/s ({t:.2f}s)")
+    print(f"variant tour ({contig}, {n_calls} calls, flank {flank}): " + ", ".join(results)
+          + f"; {n_stops} stops, {n_shown} of {n_loci} loci, "
+          f"full consensus {n_calls / t_full:.0f} variants/s ({t_full:.2f}s)")
+
+    checks = []
+    for name, types, ref_statuses in (("all", None, None),
+                                      ("INS", {VariantType.INS}, None),
+                                      ("hom_alt", None, {RefStatus.hom_alt})):
+        dna_iterator = DNAIterator(paths["fasta"], [contig], paths["vcf"], paths["fai"],
+                                   paths["packed"], tour_flank=flank, tour_types=types,
+                                   tour_ref_statuses=ref_statuses)
+        blocks = dna_iterator.iterate_tour(contig, 0)
+        checks.append(f"{name} {_tour_mismatches(paths, contig, blocks)}")
+        dna_iterator.close()
+    print("  loci differing from the full consensus: " + ", ".join(checks))
+
+
+def bench_playlist(paths: Dict, contigs: List[str], data_dir: str, n_regions: int) -> None:
+    dna_iterator = DNAIterator(paths["fasta"], contigs, paths["vcf"], paths["fai"],
+                               paths["packed"], paths["track"])
+    rng = random.Random(0)
+    bed_path = os.path.join(data_dir, "playlist.bed")
+    with open(bed_path, "w") as f:
+        for i in range(n_regions):
+            contig = rng.choice(contigs)
+            length = rng.randint(1000, 20000)
+            start = rng.randrange(max(dna_iterator.fai_index[contig].len - length, 1))
+            f.write(f"{contig}\t{start}\t{start + length}\tregion{i}\n")
+    playlist = RegionStager(dna_iterator, read_bed(bed_path, dna_iterator.fai_index),
+                            PLAYLIST_BUFFER_BYTES, PLAYLIST_MAX_REGION_BASES, loop=False)
+    prefetcher = LociPrefetcher(dna_iterator, JUMP_PROB, PREFETCH_QUEUE_SIZE, playlist=playlist)
+    t_start = perf_counter()
+    prefetcher.start()
+    switches = []
+    n_loci = 0
+    for _ in range(n_regions):
+        t0 = perf_counter()
+        segment = prefetcher.iterate_segment()
+        if next(segment, None) is None:
+            break
+        switches.append(perf_counter() - t0)
+        n_loci += 1 + sum(1 for _ in segment)
+    t = perf_counter() - t_start
+    metrics = playlist.metrics()
+    prefetcher.stop()
+    dna_iterator.close()
+    switches.sort()
+    print(f"playlist ({len(switches)} regions): {n_loci / t:.0f} loci/s, "
+          f"staging mean {1000 * metrics['staging_mean']:.1f}ms "
+          f"p95 {1000 * metrics['staging_p95']:.1f}ms, "
+          f"switch latency mean {1000 * sum(switches) / len(switches):.2f}ms "
+          f"max {1000 * switches[-1]:.2f}ms, "
+          f"{metrics['n_stalls']} stalls ({1000 * metrics['stall_time']:.1f}ms)")
+    check_staging_boundary(paths, contigs)
+
+
+def check_staging_boundary(paths: Dict, contigs: List[str], flank: int = 50,
+                           n_regions: int = 100) -> None:
+    """
+    Plays regions around deletions, staging only up to the middle of the deletion
+    (max_region_bases), and compares the loci with the full consensus
+    """
+    contig = contigs[0]
+    cols = read_columns(paths["vcf"][contig], contig)
+    regions = []
+    prev_end = 0
+    for pos, ref_len, passed, gt1, gt2 in zip(cols.pos, cols.ref_len, cols.passed,
+                                              cols.gt1, cols.gt2):
+        if not passed:
+            continue
+        start = pos - 1 - flank
+        if ref_len > 1 and start >= prev_end and (gt1 > 0 or gt2 > 0):
+            regions.append(Region(contig, start, pos - 1 + ref_len + flank, f"del{pos}"))
+        prev_end = max(prev_end, pos - 1 + ref_len)
+    regions = regions[::max(len(regions) // n_regions, 1)]
+
+    expected: Dict[Region, List] = {region: [] for region in regions}
+    active: deque = deque()
+    next_regions = iter(regions)
+    region = next(next_regions, None)
+    for l in _iterate_contig(paths, contig, "packed", compact=True):
+        while region is not None and l.pos > region.start:
+            active.append(region)
+            region = next(next_regions, None)
+        while active and l.pos > active[0].end:
+            active.popleft()
+        for r in active:
+            if l.pos <= r.end:
+                expected[r].append(l)
+        if region is None and not active:
+            break
+
+    results = []
+    for name, track_paths in (("packed", None), ("track", paths["track"])):
+        dna_iterator = DNAIterator(paths["fasta"], contigs, paths["vcf"], paths["fai"],
+                                   paths["packed"], track_paths)
+        # the staged part would end right after the first base of each deletion
+        stager = RegionStager(dna_iterator, regions, PLAYLIST_BUFFER_BYTES, flank + 1,
+                              loop=False)
+        n_diff = 0
+        for region in regions:
+            got = list(stager.iterate(stage_region(dna_iterator, region, flank + 1)))
+            n_diff += (abs(len(got) - len(expected[region]))
+                       + sum(a != b for a, b in zip(got, expected[region])))
+        dna_iterator.close()
+        results.append(f"{name} {n_diff}")
+    print(f"playlist staging boundary in deletions ({len(regions)} regions), loci differing "
+          f"from the full consensus: " + ", ".join(results))
+
+
+def bench_frames(dna_iterator: DNAIterator, n_frames: int, jump_prob: float,
+                 simulate_timing: bool) -> None:
+    sculpture = DNASculpture("sim", simulate_timing)
+    stats = FrameStats(FRAME_STAGES, 0, bin_width=0.0001, n_bins=1000)
+    prefetcher = LociPrefetcher(dna_iterator, jump_prob, PREFETCH_QUEUE_SIZE)
+    prefetcher.start()
+
+    n_jumps = 0
+    windows = iterate_sliding(prefetcher.iterate_segment(), N_BASES_DISPLAYED)
+    t_start = perf_counter()
+    while stats.n_frames < n_frames:
+        t0 = perf_counter()
+        seq = next(windows, None)
+        if seq is None:
+            n_jumps += 1
+            windows = iterate_sliding(prefetcher.iterate_segment(), N_BASES_DISPLAYED)
+            continue
+        stats.record("fetch", perf_counter() - t0)
+        sculpture.output_frame(seq, stats, block=True)
+        stats.end_frame()
+    sculpture.output.flush()
+    t = perf_counter() - t_start
+    prefetcher.stop()
+
+    display = sculpture.display.display
+    print(f"frames/s: {stats.n_frames / t:.0f} ({stats.n_frames} frames in {t:.2f}s, "
+          f"{n_jumps} jumps, simulated hardware timing {'on' if simulate_timing else 'off'})")
+    print(f"  {stats.summary()}")
+    print(f"  i2c: {display.bytes_sent / stats.n_frames:.0f} bytes/frame, "
+          f"led shows: {sculpture.strand1.n_shows + sculpture.strand2.n_shows}, "
+          f"prefetch: {prefetcher.metrics()}, output: {sculpture.output.metrics()}")
+    print(f"  cache: {dna_iterator.cache.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", default="6M", help="total # of bases, e.g. 500K, 10M, 3G")
+    parser.add_argument("--contigs", type=int, default=3)
+    parser.add_argument("--variant-rate", type=float, default=1 / 1000,
+                        help="variants per base")
+    parser.add_argument("--loci", type=int, default=200000, help="loci for the loci/s test")
+    parser.add_argument("--jumps", type=int, default=50)
+    parser.add_argument("--regions", type=int, default=50, help="regions of the playlist test")
+    parser.add_argument("--frames", type=int, default=5000)
+    parser.add_argument("--jump-prob", type=float, default=JUMP_PROB)
+    parser.add_argument("--no-timing", action="store_true",
+                        help="don't simulate the I2C / LED transfer times")
+    parser.add_argument("--data-dir", help="keep the fixtures here instead of a temporary dir")
+    args = parser.parse_args()
+
+    # the synthetic data contains conflicting calls on purpose, don't log each of them
+    logging.basicConfig(level="CRITICAL")
+    contigs = CONTIGS[:args.contigs]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir or tmp_dir
+        os.makedirs(data_dir, exist_ok=True)
+        t0 = perf_counter()
+        paths = prepare_data(data_dir, contigs, parse_size(args.size), args.variant_rate)
+        print(f"fixtures: {args.size} bases in {len(contigs)} contigs, {perf_counter() - t0:.1f}s")
+
+        bench_loci(paths, contigs, args.loci)
+        check_start_at_calls(paths, contigs)
+        bench_ref_stream(paths, contigs[0])
+        bench_locus_repr(paths, contigs[0])
+        bench_jumps(DNAIterator(paths["fasta"], contigs, paths["vcf"], paths["fai"],
+                                paths["packed"], paths["track"]), args.jumps, "redraw")
+        dna_iterator = DNAIterator(paths["fasta"], contigs, paths["vcf"], paths["fai"],
+                                   paths["packed"], paths["track"], paths["regions"])
+        bench_jumps(dna_iterator, args.jumps, "valid regions")
+        bench_startup(paths, contigs, data_dir)
+        bench_pacing(paths, contigs[0])
+        bench_tour(paths, contigs[0])
+        bench_playlist(paths, contigs, data_dir, args.regions)
+        bench_frames(dna_iterator, args.frames, args.jump_prob, not args.no_timing)
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"peak RSS: {peak_rss / 1024:.1f}MB")
@@ -0,0 +1,385 @@
+"""
+Random access reader for BGZF (bgzip) compressed files, stdlib only.
+
+BGZF files are a series of gzip members ("blocks") of at most 64KB
+uncompressed data each. BGZFFile behaves like a binary file opened for
+reading with offsets in the uncompressed data, so fai offsets, VCF indexes
+and binary searches work unchanged. Only the blocks needed for a read are
+inflated, recently used blocks are kept in an LRU cache shared by all files.
+
+Block offsets are read from the ".gzi" index (bgzip -i / samtools faidx),
+if there is none the block headers are scanned once (without inflating).
+For VCFs the linear index of a ".tbi" (tabix -p vcf) can be used to jump
+to a position.
+
+Run directly to compress files (FILE -> FILE.gz + FILE.gz.gzi) if htslib is not available.
+"""
+import gzip
+import logging
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from io import SEEK_CUR, SEEK_END, SEEK_SET
+from typing import BinaryIO, Dict, Optional, Tuple, Union
+
+GZIP_MAGIC = b"\x1f\x8b"
+BLOCK_HEADER = struct.Struct("<4BI2BH")  # id1, id2, cm, flg, mtime, xfl, os, xlen
+BLOCK_FOOTER = struct.Struct("<II")  # crc32, isize
+MAX_BLOCK_DATA = 0xff00
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+DEFAULT_CACHE_BLOCKS = 64
+
+TABIX_LINEAR_SHIFT = 14
+
+
+def is_bgzf(filename: str) -> bool:
+    with open(filename, "rb") as f:
+        header = f.read(16)
+    return (len(header) == 16 and header[:2] == GZIP_MAGIC and header[3] & 4
+            and header[12:14] == b"BC")
+
+
+def _block_size(extra: bytes) -> int:
+    """
+    Total (compressed) size of the block from its BC extra subfield
+    """
+    i = 0
+    while i + 4 <= len(extra):
+        si, slen = extra[i:i + 2], struct.unpack_from("<H", extra, i + 2)[0]
+        if si == b"BC" and slen == 2:
+            return struct.unpack_from("<H", extra, i + 4)[0] + 1
+        i += 4 + slen
+    raise ValueError("Not a BGZF block")
+
+
+class BlockIndex(object):
+    """
+    Compressed and uncompressed start offsets of all blocks
+    """
+    def __init__(self, coffsets: array, uoffsets: array, size: int):
+        self.coffsets = coffsets
+        self.uoffsets = uoffsets
+        self.size = size
+
+    @classmethod
+    def scan(cls, raw: BinaryIO) -> "BlockIndex":
+        coffsets = array("Q")
+        uoffsets = array("Q")
+        coffset = uoffset = 0
+        while True:
+            raw.seek(coffset)
+            header = raw.read(BLOCK_HEADER.size)
+            if len(header) < BLOCK_HEADER.size:
+                break
+            xlen = BLOCK_HEADER.unpack(header)[-1]
+            bsize = _block_size(raw.read(xlen))
+            raw.seek(coffset + bsize - 4)
+            isize = struct.unpack("<I", raw.read(4))[0]
+            if isize:
+                coffsets.append(coffset)
+                uoffsets.append(uoffset)
+            coffset += bsize
+            uoffset += isize
+        return cls(coffsets, uoffsets, uoffset)
+
+    @classmethod
+    def load_gzi(cls, filename: str, raw: BinaryIO) -> "BlockIndex":
+        """
+        .gzi: # of entries, then (compressed, uncompressed) offset pairs for all blocks but the first
+        """
+        with open(filename, "rb") as f:
+            n = struct.unpack("<Q", f.read(8))[0]
+            pairs = array("Q")
+            pairs.fromfile(f, 2 * n)
+        coffsets = array("Q", [0]) + pairs[0::2]
+        uoffsets = array("Q", [0]) + pairs[1::2]
+        # size of the last block from its footer
+        raw.seek(coffsets[-1])
+        header = raw.read(BLOCK_HEADER.size)
+        bsize = _block_size(raw.read(BLOCK_HEADER.unpack(header)[-1]))
+        raw.seek(coffsets[-1] + bsize - 4)
+        size = uoffsets[-1] + struct.unpack("<I", raw.read(4))[0]
+        return cls(coffsets, uoffsets, size)
+
+    def save_gzi(self, filename: str) -> None:
+        # unique temp file, so concurrent writers of the same .gzi don't mix their data
+        fd, tmp_filename = tempfile.mkstemp(prefix=os.path.basename(filename) + ".",
+                                            suffix=".tmp", dir=os.path.dirname(filename) or ".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(struct.pack("<Q", max(len(self.coffsets) - 1, 0)))
+                pairs = array("Q")
+                for c, u in zip(self.coffsets[1:], self.uoffsets[1:]):
+                    pairs.extend((c, u))
+                pairs.tofile(f)
+            os.replace(tmp_filename, filename)
+        except Exception:
+            os.remove(tmp_filename)
+            raise
+
+    def find(self, uoffset: int) -> int:
+        """
+        Index of the block containing uoffset
+        """
+        return max(bisect_right(self.uoffsets, uoffset) - 1, 0)
+
+
+class BlockCache(object):
+    """
+    LRU cache of inflated blocks, keyed by (filename, compressed offset).
+    Shared by the prefetch thread and the main thread, hence the lock.
+    """
+    def __init__(self, max_blocks: int = DEFAULT_CACHE_BLOCKS):
+        self.max_blocks = max_blocks
+        self.blocks: "OrderedDict[Tuple[str, int], bytes]" = OrderedDict()
+        self.n_hits = 0
+        self.n_inflates = 0
+        self._lock = threading.Lock()
+
+    def get(self, filename: str, raw: BinaryIO, coffset: int) -> bytes:
+        key = (filename, coffset)
+        with self._lock:
+            data = self.blocks.get(key)
+            if data is not None:
+                self.blocks.move_to_end(key)
+                self.n_hits += 1
+                return data
+
+        raw.seek(coffset)
+        header = raw.read(BLOCK_HEADER.size)
+        xlen = BLOCK_HEADER.unpack(header)[-1]
+        bsize = _block_size(raw.read(xlen))
+        cdata = raw.read(bsize - BLOCK_HEADER.size - xlen)
+        data = zlib.decompress(cdata[:-BLOCK_FOOTER.size], -15)
+
+        with self._lock:
+            self.n_inflates += 1
+            self.blocks[key] = data
+            if len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+        return data
+
+
+block_cache = BlockCache()
+
+_index_cache: Dict[str, Tuple[BlockIndex, int, int]] = {}
+
+
+def get_block_index(filename: str, raw: BinaryIO) -> BlockIndex:
+    st = os.stat(filename)
+    cached = _index_cache.get(filename)
+    if cached is not None and cached[1:] == (st.st_size, st.st_mtime_ns):
+        return cached[0]
+
+    gzi_path = filename + ".gzi"
+    if os.path.exists(gzi_path) and os.stat(gzi_path).st_mtime_ns >= st.st_mtime_ns:
+        index = BlockIndex.load_gzi(gzi_path, raw)
+    else:
+        logging.info(f"No block index for {filename}, scanning blocks")
+        index = BlockIndex.scan(raw)
+        try:
+            index.save_gzi(gzi_path)
+        except OSError as e:
+            logging.warning(f"Could not write block index {gzi_path}: {e}")
+    _index_cache[filename] = (index, st.st_size, st.st_mtime_ns)
+    return index
+
+
+class BGZFFile(object):
+    """
+    Read only binary file interface to a BGZF file, offsets refer to the uncompressed data
+    """
+    def __init__(self, filename: str, cache: BlockCache = block_cache):
+        self.filename = filename
+        self.cache = cache
+        self._raw = open(filename, "rb")
+        self.index = get_block_index(filename, self._raw)
+        self.size = self.index.size
+        self._block_i = 0
+        self._block_start = 0
+        self._block = b""
+        self._pos = 0
+
+    def close(self) -> None:
+        self._raw.close()
+
+    def __enter__(self) -> "BGZFFile":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _load(self, uoffset: int) -> bool:
+        """
+        Makes the block containing uoffset current, False at the end of the file
+        """
+        if self._block_start <= uoffset < self._block_start + len(self._block):
+            return True
+        if uoffset >= self.size:
+            return False
+        i = self.index.find(uoffset)
+        self._block_i = i
+        self._block_start = self.index.uoffsets[i]
+        self._block = self.cache.get(self.filename, self._raw, self.index.coffsets[i])
+        return True
+
+    def seek(self, offset: int, whence: int = SEEK_SET) -> int:
+        if whence == SEEK_CUR:
+            offset += self._pos
+        elif whence == SEEK_END:
+            offset += self.size
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def seek_virtual(self, voffset: int) -> int:
+        """
+        Seek to a virtual offset (compressed block offset << 16 | offset in block)
+        """
+        coffset, within = voffset >> 16, voffset & 0xffff
+        i = max(bisect_right(self.index.coffsets, coffset) - 1, 0)
+        return self.seek(self.index.uoffsets[i] + within)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def read(self, n: int = -1) -> bytes:
+        if n < 0:
+            n = self.size - self._pos
+        parts = []
+        while n > 0 and self._load(self._pos):
+            start = self._pos - self._block_start
+            part = self._block[start:start + n]
+            parts.append(part)
+            self._pos += len(part)
+            n -= len(part)
+        return b"".join(parts)
+
+    def readline(self) -> bytes:
+        parts = []
+        while self._load(self._pos):
+            start = self._pos - self._block_start
+            end = self._block.find(b"\n", start)
+            if end >= 0:
+                parts.append(self._block[start:end + 1])
+                self._pos += end + 1 - start
+                break
+            parts.append(self._block[start:])
+            self._pos += len(self._block) - start
+        return b"".join(parts)
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+
+def open_file(filename: str) -> Union[BinaryIO, BGZFFile]:
+    """
+    Opens a plain or BGZF compressed file for binary reading
+    """
+    if filename.endswith(".gz") or filename.endswith(".bgz"):
+        if not is_bgzf(filename):
+            raise ValueError(f"{filename} is gzip but not BGZF compressed (use bgzip)")
+        return BGZFFile(filename)
+    return open(filename, "rb")
+
+
+class TabixIndex(object):
+    """
+    Linear index of a .tbi file: virtual offset of the first record
+    overlapping each 16kb window, per contig.
+    """
+    def __init__(self, linear: Dict[str, array]):
+        self.linear = linear
+
+    @classmethod
+    def load(cls, filename: str) -> "TabixIndex":
+        with gzip.open(filename, "rb") as f:
+            data = f.read()
+        magic, n_ref, _, _, _, _, _, _, l_nm = struct.unpack_from("<4s8i", data, 0)
+        if magic != b"TBI\x01":
+            raise ValueError(f"{filename} is not a tabix index")
+        i = 36
+        names = data[i:i + l_nm].rstrip(b"\0").decode("ascii").split("\0")
+        i += l_nm
+
+        linear = {}
+        for name in names[:n_ref]:
+            n_bin = struct.unpack_from("<i", data, i)[0]
+            i += 4
+            for _ in range(n_bin):
+                _, n_chunk = struct.unpack_from("<Ii", data, i)
+                i += 8 + 16 * n_chunk
+            n_intv = struct.unpack_from("<i", data, i)[0]
+            i += 4
+            linear[name] = array("Q", data[i:i + 8 * n_intv])
+            i += 8 * n_intv
+        return cls(linear)
+
+    def seek_to_pos(self, file: BGZFFile, contig: str, pos: int) -> None:
+        """
+        Seek file to the first record of contig with position >= pos
+        """
+        ioff = self.linear.get(contig)
+        if not ioff:
+            file.seek(0, SEEK_END)
+            return
+        window = min(max(pos - 1, 0) >> TABIX_LINEAR_SHIFT, len(ioff) - 1)
+        file.seek_virtual(ioff[window])
+        contig_name = contig.encode("ascii")
+        offset = file.tell()
+        for line in iter(file.readline, b""):
+            if not line.startswith(b"#"):
+                cols = line.split(b"\t", 2)
+                if cols[0] != contig_name or int(cols[1]) >= pos:
+                    break
+            offset += len(line)
+        file.seek(offset)
+
+
+def get_tabix_index(filename: str) -> Optional[TabixIndex]:
+    tbi_path = filename + ".tbi"
+    if not os.path.exists(tbi_path):
+        return None
+    try:
+        return TabixIndex.load(tbi_path)
+    except (ValueError, struct.error, OSError) as e:
+        logging.warning(f"Could not read tabix index {tbi_path}: {e}")
+        return None
+
+
+def compress(in_path: str, out_path: str, level: int = 6) -> BlockIndex:
+    """
+    Writes in_path BGZF compressed to out_path, returns the block index
+    """
+    coffsets = array("Q")
+    uoffsets = array("Q")
+    coffset = uoffset = 0
+    with open(in_path, "rb") as f_in, open(out_path, "wb") as f_out:
+        for data in iter(lambda: f_in.read(MAX_BLOCK_DATA), b""):
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            cdata = compressor.compress(data) + compressor.flush()
+            bsize = BLOCK_HEADER.size + 6 + len(cdata) + BLOCK_FOOTER.size
+            f_out.write(BLOCK_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6))
+            f_out.write(b"BC" + struct.pack("<HH", 2, bsize - 1))
+            f_out.write(cdata)
+            f_out.write(BLOCK_FOOTER.pack(zlib.crc32(data), len(data)))
+            coffsets.append(coffset)
+            uoffsets.append(uoffset)
+            coffset += bsize
+            uoffset += len(data)
+        f_out.write(EOF_BLOCK)
+    return BlockIndex(coffsets, uoffsets, uoffset)
+
+
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level="INFO")
+    for path in sys.argv[1:]:
+        logging.info(f"Compressing {path}")
+        compress(path, path + ".gz").save_gzi(path + ".gz.gzi")
@@ -0,0 +1,355 @@
+"""
+Cache layer used by DNAIterator, so jumps don't reopen and re-read the data files.
+
+Keeps the fasta, packed reference, consensus track, variant density and VCF files
+open per contig, and recently decoded reference chunks (Base values) and VCF chunks
+(vcf_bulk.VariantColumns) in an LRU cache limited to max_bytes.
+
+All reads from the shared file handles are done under one lock and never
+span a yield, so the prefetch thread and the main thread, as well as several
+interleaved iterators, can use the same handles.
+"""
+import logging
+import os
+import struct
+import threading
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from io import SEEK_END
+from typing import Any, BinaryIO, Dict, Hashable, Iterator, List, Optional, Tuple
+
+from bgzf import BGZFFile, get_tabix_index, open_file
+from density import VariantDensity
+from dna import BASES_BY_VALUE, Base, FaiLine, FastaContig, Variant, VCFFile
+from packed_ref import PackedContig
+from track import ConsensusTrack
+from vcf_bulk import VariantColumns, read_columns
+from vcf_index import get_index
+
+REFERENCE_CHUNK_SIZE = 1 << 16  # bases
+VARIANT_CHUNK_SIZE = 1 << 16  # bytes of the VCF file
+
+
+class LRUCache(object):
+    """
+    Least recently used cache limited by the (approximate) size of its values
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.n_evictions = 0
+        self._items: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key: Hashable, value: Any, nbytes: int) -> None:
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self._items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            # always keep the newest item, even if it alone exceeds max_bytes
+            while self.nbytes > self.max_bytes and len(self._items) > 1:
+                _, (_, n) = self._items.popitem(last=False)
+                self.nbytes -= n
+                self.n_evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+
+class CachedReference(object):
+    """
+    Reference source (see dna.ConsensusBuilder) reading through the chunk cache of a DataCache
+    """
+    def __init__(self, data_cache: "DataCache", reference):
+        self.data_cache = data_cache
+        self.reference = reference
+        self.contig = reference.contig
+        self.len = reference.len
+
+    def get_codes(self, start: int, end: int) -> bytes:
+        start = max(start, 0)
+        end = min(end, self.len)
+        if start >= end:
+            return b""
+        first = start // REFERENCE_CHUNK_SIZE
+        last = (end - 1) // REFERENCE_CHUNK_SIZE
+        chunks = [self.data_cache._reference_chunk(self, i) for i in range(first, last + 1)]
+        offset = first * REFERENCE_CHUNK_SIZE
+        if len(chunks) == 1:
+            return chunks[0][start - offset:end - offset]
+        return b"".join(chunks)[start - offset:end - offset]
+
+    def get_bases(self, start: int, end: int) -> List[Base]:
+        return [BASES_BY_VALUE[c] for c in self.get_codes(start, end)]
+
+
+class DirectReference(object):
+    """
+    Reference source reading every get_codes straight from the file (a seek to the
+    fai / packed offset) instead of through the chunk cache, for sparse reads like
+    the variant tour where most of each chunk would be read for nothing
+    """
+    def __init__(self, data_cache: "DataCache", reference):
+        self.data_cache = data_cache
+        self.reference = reference
+        self.contig = reference.contig
+        self.len = reference.len
+
+    def get_codes(self, start: int, end: int) -> bytes:
+        with self.data_cache._lock:
+            codes = self.reference.get_codes(start, end)
+        self.data_cache.counts["ref_direct_reads"] += 1
+        self.data_cache.counts["bytes_read"] += len(codes)
+        return codes
+
+
+class DataCache(object):
+    def __init__(self, ref_path: str, vcf_paths: Dict[str, str], fai_index: Dict[str, FaiLine],
+                 packed_ref_paths: Dict[str, str] = None, track_paths: Dict[str, str] = None,
+                 max_bytes: int = 32 * 1024 * 1024, density_paths: Dict[str, str] = None):
+        self.ref_path = ref_path
+        self.vcf_paths = vcf_paths
+        self.fai_index = fai_index
+        self.packed_ref_paths = packed_ref_paths or {}
+        self.track_paths = track_paths or {}
+        self.density_paths = density_paths or {}
+        self.chunks = LRUCache(max_bytes)
+
+        self._lock = threading.RLock()
+        self._files: Dict[str, BinaryIO] = {}
+        self._packed: Dict[str, Optional[PackedContig]] = {}
+        self._tracks: Dict[str, Optional[ConsensusTrack]] = {}
+        self._densities: Dict[str, Optional[VariantDensity]] = {}
+        self._references: Dict[str, CachedReference] = {}
+        self._vcf_sizes: Dict[str, int] = {}
+        self.counts = Counter()
+
+    def close(self) -> None:
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            for p in self._packed.values():
+                if p is not None:
+                    p.close()
+            for t in self._tracks.values():
+                if t is not None:
+                    t.close()
+            for d in self._densities.values():
+                if d is not None:
+                    d.close()
+            self._files.clear()
+            self._packed.clear()
+            self._tracks.clear()
+            self._densities.clear()
+            self._references.clear()
+            self.chunks.clear()
+
+    def __enter__(self) -> "DataCache":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _file(self, path: str) -> BinaryIO:
+        f = self._files.get(path)
+        if f is None:
+            f = self._files[path] = open_file(path)
+            self.counts["files_opened"] += 1
+        return f
+
+    def packed(self, contig: str) -> Optional[PackedContig]:
+        """
+        The packed reference of contig, None if there is none
+        """
+        with self._lock:
+            if contig not in self._packed:
+                path = self.packed_ref_paths.get(contig)
+                self._packed[contig] = None
+                if path is not None and os.path.exists(path):
+                    self._packed[contig] = PackedContig(path, contig)
+                    self.counts["files_opened"] += 1
+            return self._packed[contig]
+
+    def track(self, contig: str) -> Optional[ConsensusTrack]:
+        """
+        The consensus track of contig, None if there is none (or no packed reference,
+        or it doesn't match the VCF)
+        """
+        with self._lock:
+            if contig not in self._tracks:
+                path = self.track_paths.get(contig)
+                packed = self.packed(contig)
+                self._tracks[contig] = None
+                if path is not None and os.path.exists(path) and packed is not None:
+                    try:
+                        track = ConsensusTrack(path, packed)
+                    except (ValueError, struct.error, OSError) as e:
+                        logging.warning(f"Can't read the consensus track of {contig} ({e}), "
+                                        f"ignoring it")
+                        return None
+                    self.counts["files_opened"] += 1
+                    if not track.is_valid_for(self.vcf_paths[contig]):
+                        logging.warning(f"Consensus track of {contig} is older than "
+                                        f"{self.vcf_paths[contig]}, ignoring it "
+                                        f"(rebuild it with track.py)")
+                        track.close()
+                    else:
+                        self._tracks[contig] = track
+            return self._tracks[contig]
+
+    def density(self, contig: str) -> Optional[VariantDensity]:
+        """
+        The variant density map of contig, None if there is none
+        (or it doesn't match the reference or the VCF)
+        """
+        with self._lock:
+            if contig not in self._densities:
+                path = self.density_paths.get(contig)
+                self._densities[contig] = None
+                if path is not None and os.path.exists(path):
+                    try:
+                        density = VariantDensity(path, contig)
+                    except (ValueError, struct.error, OSError) as e:
+                        logging.warning(f"Can't read the variant density map of {contig} ({e}), "
+                                        f"ignoring it")
+                        return None
+                    self.counts["files_opened"] += 1
+                    if density.len != self.fai_index[contig].len:
+                        logging.warning(f"Variant density map of {contig} doesn't match "
+                                        f"the reference, ignoring it")
+                        density.close()
+                    elif not density.is_valid_for(self.vcf_paths[contig]):
+                        logging.warning(f"Variant density map of {contig} is older than "
+                                        f"{self.vcf_paths[contig]}, ignoring it "
+                                        f"(rebuild it with density.py)")
+                        density.close()
+                    else:
+                        self._densities[contig] = density
+            return self._densities[contig]
+
+    def reference(self, contig: str) -> CachedReference:
+        """
+        Cached reference of contig (packed if available, else the fasta)
+        """
+        with self._lock:
+            reference = self._references.get(contig)
+            if reference is None:
+                source = self.packed(contig)
+                if source is None:
+                    source = FastaContig(self._file(self.ref_path), self.fai_index[contig])
+                reference = self._references[contig] = CachedReference(self, source)
+            return reference
+
+    def direct_reference(self, contig: str) -> DirectReference:
+        """
+        Uncached reference of contig (packed if available, else the fasta)
+        """
+        return DirectReference(self, self.reference(contig).reference)
+
+    def preload(self, contig: str) -> None:
+        """
+        Opens the files of contig and loads their indexes (e.g. in the background at startup),
+        so the first jump there doesn't have to
+        """
+        vcf_path = self.vcf_paths[contig]
+        self.track(contig)
+        self.density(contig)
+        self.reference(contig)
+        with self._lock:
+            vcf_file = self._file(vcf_path)
+        if get_index(vcf_path) is None and isinstance(vcf_file, BGZFFile):
+            get_tabix_index(vcf_path)
+
+    def _get_chunk(self, key: Tuple, load) -> Any:
+        chunk = self.chunks.get(key)
+        if chunk is not None:
+            self.counts[key[0] + "_hits"] += 1
+            return chunk
+        self.counts[key[0] + "_misses"] += 1
+        with self._lock:
+            chunk, nbytes, n_read = load()
+        self.counts["bytes_read"] += n_read
+        self.chunks.put(key, chunk, nbytes)
+        return chunk
+
+    def _reference_chunk(self, reference: CachedReference, i: int) -> bytes:
+        def load():
+            codes = reference.reference.get_codes(i * REFERENCE_CHUNK_SIZE,
+                                                  (i + 1) * REFERENCE_CHUNK_SIZE)
+            return codes, len(codes), len(codes)
+        return self._get_chunk(("ref", reference.contig, i), load)
+
+    def _variant_chunk(self, contig: str, i: int) -> VariantColumns:
+        vcf_path = self.vcf_paths[contig]
+
+        def load():
+            start = i * VARIANT_CHUNK_SIZE
+            end = min(start + VARIANT_CHUNK_SIZE, self._vcf_sizes[vcf_path])
+            cols = read_columns(vcf_path, contig, start_offset=start, end_offset=end,
+                                file=self._file(vcf_path))
+            return cols, cols.nbytes(), end - start
+        return self._get_chunk(("vcf", contig, i), load)
+
+    def vcf_offset(self, contig: str, pos: int) -> int:
+        """
+        Offset of the first VCF record of contig at or after pos (1-based)
+        """
+        vcf_path = self.vcf_paths[contig]
+        with self._lock:
+            f = self._file(vcf_path)
+            VCFFile(vcf_path, contig).seek_to_pos(f, pos)
+            return f.tell()
+
+    def iterate_variants(self, contig: str, pos: int,
+                         offset: Optional[int] = None) -> Iterator[Variant]:
+        """
+        PASS variants of contig at or after pos (1-based), same as VCFFile.iterate_from_pos.
+        offset: vcf_offset(contig, pos) if already known (e.g. from a checkpoint)
+        """
+        vcf_path = self.vcf_paths[contig]
+        if offset is None:
+            offset = self.vcf_offset(contig, pos)
+        with self._lock:
+            f = self._file(vcf_path)
+            if vcf_path not in self._vcf_sizes:
+                self._vcf_sizes[vcf_path] = f.seek(0, SEEK_END)
+            size = self._vcf_sizes[vcf_path]
+
+        i = offset // VARIANT_CHUNK_SIZE
+        while i * VARIANT_CHUNK_SIZE < size:
+            cols = self._variant_chunk(contig, i)
+            for j in range(bisect_left(cols.pos, pos), len(cols)):
+                yield cols.get_variant(j)
+            i += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        hit rates of the reference / VCF chunks, bytes read from the files,
+        cache size and # of open files
+        """
+        c = self.counts
+        stats = dict(c)
+        for kind in ("ref", "vcf"):
+            n = c[kind + "_hits"] + c[kind + "_misses"]
+            stats[kind + "_hit_rate"] = round(c[kind + "_hits"] / n, 3) if n else None
+        stats["cached_bytes"] = self.chunks.nbytes
+        stats["evictions"] = self.chunks.n_evictions
+        stats["open_files"] = (len(self._files) + sum(p is not None for p in self._packed.values())
+                               + sum(t is not None for t in self._tracks.values())
+                               + sum(d is not None for d in self._densities.values()))
+        return stats
@@ -0,0 +1,128 @@
+"""
+Playback checkpoint, so a restart (or the shutdown button) continues where
+the sculpture left off instead of jumping to a new random location.
+
+The checkpoint stores the position of the first displayed locus together with
+the offsets needed to resume there without searching (VCF record offset, fasta
+byte offset), the next jump target and the state of the jump RNG. It is a small
+json file written with an atomic replace by a background thread, at most once
+every interval seconds (and only if the position changed) to limit SD card writes.
+
+The offsets are only used if the files didn't change since the checkpoint was
+written (fasta offset and VCF size/mtime are checked), otherwise the position
+is searched as usual.
+"""
+import json
+import logging
+import os
+import threading
+from typing import Any, NamedTuple, Optional, Tuple
+
+CHECKPOINT_VERSION = 1
+
+
+class Checkpoint(NamedTuple):
+    contig: str
+    pos: int  # 0-based reference position of the first displayed locus
+    vcf_offset: int  # of the first VCF record at or after pos (DataCache.vcf_offset(contig, pos + 1))
+    vcf_stamp: Tuple[int, int]  # VCF size and mtime (ns)
+    ref_offset: int  # byte offset of pos in the fasta
+    next_target: Optional[Tuple[str, int]]  # (contig, 0-based position) of the next jump
+    rng_state: Any  # random.Random.getstate() of the jump RNG
+
+
+def file_stamp(path: str) -> Tuple[int, int]:
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def save_checkpoint(path: str, checkpoint: Checkpoint) -> None:
+    data = checkpoint._asdict()
+    data["version"] = CHECKPOINT_VERSION
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _to_tuple(x: Any) -> Any:
+    """
+    json lists back to (nested) tuples, as in random.getstate()
+    """
+    return tuple(_to_tuple(y) for y in x) if isinstance(x, list) else x
+
+
+def load_checkpoint(path: str) -> Optional[Checkpoint]:
+    """
+    The checkpoint in path, None if there is none or it can't be read
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.pop("version", None) != CHECKPOINT_VERSION:
+            raise ValueError("unknown version")
+        next_target = data["next_target"]
+        return Checkpoint(
+            contig=data["contig"], pos=int(data["pos"]), vcf_offset=int(data["vcf_offset"]),
+            vcf_stamp=tuple(data["vcf_stamp"]), ref_offset=int(data["ref_offset"]),
+            next_target=tuple(next_target) if next_target is not None else None,
+            rng_state=_to_tuple(data["rng_state"]))
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logging.warning(f"Could not read checkpoint {path}: {e}")
+        return None
+
+
+class Checkpointer(object):
+    """
+    Writes checkpoints of the playback position in a background thread.
+
+    update() is called by the render loop for every frame and only stores the
+    position; the offsets are looked up when the checkpoint is written.
+    make_checkpoint(contig, pos, next_target) builds the Checkpoint (see
+    main.DNAIterator.checkpoint).
+    """
+    def __init__(self, path: str, make_checkpoint, interval: float):
+        self.path = path
+        self.make_checkpoint = make_checkpoint
+        self.interval = interval
+        self.n_written = 0
+        self._position: Optional[Tuple[str, int, Optional[Tuple[str, int]]]] = None
+        self._written: Optional[Tuple[str, int, Optional[Tuple[str, int]]]] = None
+        self._write_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="checkpoint", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._thread.join(timeout=1)
+
+    def update(self, contig: str, pos: int, next_target: Optional[Tuple[str, int]]) -> None:
+        self._position = (contig, pos, next_target)
+
+    def write(self) -> bool:
+        """
+        Writes the current position if it changed since the last write, returns if it did
+        """
+        with self._write_lock:
+            position = self._position
+            if position is None or position == self._written:
+                return False
+            try:
+                save_checkpoint(self.path, self.make_checkpoint(*position))
+            except Exception:
+                logging.exception(f"Could not write checkpoint {self.path}")
+                return False
+            self._written = position
+            self.n_written += 1
+            return True
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            self.write()
@@ -2,18 +2,60 @@ FASTA_PATH = "./data/GCA_000001405.15_GRCh38_no_alt_plus_hs38d1_analysis_set.fna
 FAI_PATH = "./data/GCA_000001405.15_GRCh38_no_alt_plus_hs38d1_analysis_set.fna.fai"
 
 VCF_PATH_PATTERN = "./data/grch38_calls_filtered_{contig}.vcf"
+# the fasta and VCFs can also be BGZF compressed (".gz", see bgzf.py)
 
 CONTIGS = ["chr{}".format(i) for i in range(1,23)] + ["chrX", "chrY", "chrM"]
 
 VCF_PATHS = {c: VCF_PATH_PATTERN.format(contig=c) for c in CONTIGS}
 
+# 2-bit packed reference, created with packed_ref.py (used instead of the fasta if present)
+PACKED_REF_PATH_PATTERN = "./data/ref_{contig}.2bit"
+PACKED_REF_PATHS = {c: PACKED_REF_PATH_PATTERN.format(contig=c) for c in CONTIGS}
+
+# precompiled consensus tracks, created with track.py (needs the packed reference)
+TRACK_PATH_PATTERN = "./data/track_{contig}.bin"
+TRACK_PATHS = {c: TRACK_PATH_PATTERN.format(contig=c) for c in CONTIGS}
+
+# variant density maps, created with density.py (used for fast-forwarding, see below)
+VARIANT_DENSITY_PATH_PATTERN = "./data/density_{contig}.bin"
+VARIANT_DENSITY_PATHS = {c: VARIANT_DENSITY_PATH_PATTERN.format(contig=c) for c in CONTIGS}
+
+BACKEND = "pi" # "pi" for the real hardware, "sim" for the in memory stand-ins in backends.py
+BUTTON_PIN = 4
+
 N_LEDS = 9
 LED_PIN_1 = 18
 LED_PIN_2 = 13
 HOMREF_BRIGHTNESS_FACTOR = 0.25
+# per strand, applied when the colour tables are built at startup
+LED_GAMMA = (1.0, 1.0)
+LED_BRIGHTNESS = (1.0, 1.0)
 
 
 N_BASES_DISPLAYED = 20
 JUMP_PROB = 1 / 10000 # probability of jumping to a new location after each base
+# index of the non-N intervals for drawing jump targets, created with regions.py
+VALID_REGIONS_PATH = "./data/valid_regions.bin"
+JUMP_VARIANT_BIAS = 0.0 # 0: jump targets uniform over all valid bases, 1: proportional to variant density
 BASES_PER_SECOND = 10
-BASES_PER_SECOND_DIFF = 2
\ No newline at end of file
+BASES_PER_SECOND_DIFF = 2
+# hom-ref stretches at least FAST_FORWARD_DISTANCE bases before the next variant are played
+# at this rate (several bases per frame, needs the variant density maps)
+BASES_PER_SECOND_FAST = 50
+FAST_FORWARD_DISTANCE = 100
+PREFETCH_QUEUE_SIZE = 200 # loci buffered by the background producer thread
+DATA_CACHE_MAX_BYTES = 32 * 1024 * 1024 # decoded reference / VCF chunks kept in memory across jumps
+FRAME_STATS_LOG_INTERVAL = 600 # frames between timing summaries in the log
+# variant tour: play only the variants, each with VARIANT_TOUR_FLANK reference bases on both
+# sides, read directly from the VCF and fasta (see dna.iterate_variant_tour)
+VARIANT_TOUR = False
+VARIANT_TOUR_FLANK = 10
+VARIANT_TOUR_TYPES = None # e.g. ["INS", "DEL"] (VariantType names), None: all
+VARIANT_TOUR_REF_STATUSES = None # e.g. ["hom_alt", "het_alt"] (RefStatus names), None: all
+PLAYLIST_PATH = None # e.g. "./data/genes.bed": play these regions in order instead of random jumps (full consensus, also with VARIANT_TOUR)
+PLAYLIST_LOOP = True # start over at the end of the playlist (else continue with random jumps)
+PLAYLIST_BUFFER_BYTES = 4 * 1024 * 1024 # staged loci of the upcoming regions (~8 bytes per locus)
+PLAYLIST_MAX_REGION_BASES = 100000 # staged bases per region, the rest is read while it plays
+CHECKPOINT_PATH = "./data/checkpoint.json" # playback position, resumed from on startup (None to disable)
+CHECKPOINT_INTERVAL = 120 # seconds between checkpoint writes (limits SD card wear)
+FRAME_STATS_DUMP_PATH = None # e.g. "./frame_stats.json" to also write the histograms to a file
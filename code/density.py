@@ -0,0 +1,160 @@
+"""
+Variant density map of each contig, so the run loop knows how far away the
+next variant is without scanning loci (e.g. to fast-forward through long
+hom-ref stretches).
+
+Built from the PASS calls of the VCF (0/0 calls are left out as they don't
+change the consensus) with `python density.py`, and memory mapped for playback.
+A map is only used if the VCF size and mtime still match, a stale map would
+fast-forward over variants.
+
+File format (one file per contig, see VARIANT_DENSITY_PATHS in config.py):
+    header: magic, vcf size, vcf mtime (ns), contig length, bin size, # of bins, # of spans
+    counts: # of calls starting in each bin (uint32 array)
+    span starts, span ends: merged reference spans of the calls
+                            (0-based, end exclusive, sorted, uint32 arrays)
+"""
+import logging
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_right
+from typing import BinaryIO, Optional
+
+from vcf_bulk import read_columns
+
+MAGIC = b"DNADEN02"
+HEADER = struct.Struct("<8sQQQQQQ")
+
+DENSITY_BIN_SIZE = 1 << 12
+
+
+def build_density(vcf_path: str, contig: str, contig_len: int, out_file: BinaryIO,
+                  bin_size: int = DENSITY_BIN_SIZE) -> None:
+    # before reading, so a VCF that changes meanwhile makes the map stale
+    st = os.stat(vcf_path)
+    cols = read_columns(vcf_path, contig)
+    counts = array("I", [0]) * ((contig_len + bin_size - 1) // bin_size)
+    starts = array("I")
+    ends = array("I")
+    for pos, ref_len, gt1, gt2 in zip(cols.pos, cols.ref_len, cols.gt1, cols.gt2):
+        if gt1 == 0 and gt2 <= 0:
+            continue
+        start = pos - 1
+        end = start + ref_len
+        if start >= contig_len:
+            continue
+        if starts and start < starts[-1]:
+            logging.warning(f"{contig}:{pos} Call out of order, ignoring it")
+            continue
+        counts[start // bin_size] += 1
+        if ends and start < ends[-1]:
+            # overlaps the previous span
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+
+    out_file.write(HEADER.pack(MAGIC, st.st_size, st.st_mtime_ns, contig_len, bin_size,
+                               len(counts), len(starts)))
+    counts.tofile(out_file)
+    starts.tofile(out_file)
+    ends.tofile(out_file)
+
+
+class VariantDensity(object):
+    """
+    Memory mapped density map of one contig, queries are binary searches.
+    The span found last is remembered, so successive queries during
+    playback (pos increasing by one) don't search again.
+    """
+    def __init__(self, filename: str, contig: str):
+        self.filename = filename
+        self.contig = contig
+        self._file = open(filename, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.vcf_size, self.vcf_mtime_ns, self.len, self.bin_size,
+         n_bins, n_spans) = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{filename} is not a valid variant density file")
+        view = memoryview(self._mmap)
+        offset = HEADER.size
+        self.counts = view[offset:offset + 4 * n_bins].cast("I")
+        offset += 4 * n_bins
+        self.starts = view[offset:offset + 4 * n_spans].cast("I")
+        offset += 4 * n_spans
+        self.ends = view[offset:offset + 4 * n_spans].cast("I")
+        view.release()
+        # (lower, upper, start): positions in [lower, upper) have their next variant in the span
+        # starting at start (None after the last one)
+        self._last_span = (0, 0, None)
+
+    def close(self) -> None:
+        for name in ("counts", "starts", "ends"):
+            if hasattr(self, name):
+                getattr(self, name).release()
+        self._mmap.close()
+        self._file.close()
+
+    def is_valid_for(self, vcf_path: str) -> bool:
+        st = os.stat(vcf_path)
+        return st.st_size == self.vcf_size and st.st_mtime_ns == self.vcf_mtime_ns
+
+    def __enter__(self) -> "VariantDensity":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def next_variant(self, pos: int) -> Optional[int]:
+        """
+        First position (0-based) at or after pos covered by a call, None if there is none
+        """
+        lower, upper, start = self._last_span
+        if not lower <= pos < upper:
+            i = bisect_right(self.ends, pos)
+            lower = self.ends[i - 1] if i > 0 else 0
+            if i == len(self.ends):
+                upper, start = self.len, None
+            else:
+                upper, start = self.ends[i], self.starts[i]
+            self._last_span = (lower, upper, start)
+        if start is None:
+            return None
+        return max(start, pos)
+
+    def distance(self, pos: int) -> int:
+        """
+        # of bases from pos (0-based) to the next variant, 0 inside one,
+        the distance to the contig end if there are no more variants
+        """
+        next_pos = self.next_variant(pos)
+        if next_pos is None:
+            return max(self.len - pos, 0)
+        return next_pos - pos
+
+    def count(self, start: int, end: int) -> int:
+        """
+        # of calls starting in the bins overlapping [start, end)
+        """
+        if end <= start:
+            return 0
+        return sum(self.counts[start // self.bin_size:(end - 1) // self.bin_size + 1])
+
+
+if __name__ == "__main__":
+    from config import CONTIGS, FAI_PATH, VCF_PATHS, VARIANT_DENSITY_PATHS
+    from dna import read_fai
+
+    logging.basicConfig(level="INFO")
+    fai_index = read_fai(FAI_PATH, CONTIGS)
+    for contig in CONTIGS:
+        out_path = VARIANT_DENSITY_PATHS[contig]
+        tmp_path = out_path + ".tmp"
+        with open(tmp_path, "wb") as out_file:
+            build_density(VCF_PATHS[contig], contig, fai_index[contig].len, out_file)
+        os.replace(tmp_path, out_path)
+        with VariantDensity(out_path, contig) as density:
+            logging.info(f"{contig}: {sum(density.counts)} calls in {len(density.starts)} spans")
@@ -1,12 +1,18 @@
 import gzip
-from collections import namedtuple
+from array import array
+from collections import Counter, deque, namedtuple
 from enum import Enum
-from typing import (Dict, List, Tuple, TextIO, BinaryIO,
-                    Iterator, NamedTuple, Union, Iterable)
+from typing import (Collection, Dict, List, Tuple, TextIO, BinaryIO,
+                    Iterator, NamedTuple, Union, Iterable, Optional)
 import logging
-from itertools import zip_longest
+from heapq import heappop, heappush
+from itertools import combinations, count, groupby, repeat, zip_longest
+from operator import attrgetter
 from io import SEEK_END, SEEK_SET
 
+from bgzf import BGZFFile, get_tabix_index, open_file
+from vcf_index import get_index
+
 
 class EnumNameOnly(Enum):
     def __repr__(self) -> str:
@@ -46,6 +52,16 @@ base_to_enum = {"N": Base.N, "A": Base.A,
 
 INVERSE_BASES = {B.A: B.T, B.T: B.A, B.C: B.G, B.G: B.C}
 
+# Base members indexed by value
+BASES_BY_VALUE = tuple(Base)
+
+# translates fasta characters to Base values, invalid characters to INVALID_BASE_VALUE
+INVALID_BASE_VALUE = b"\xff"
+CHAR_TO_BASE_VALUE = bytearray(INVALID_BASE_VALUE * 256)
+for _c, _b in base_to_enum.items():
+    CHAR_TO_BASE_VALUE[ord(_c)] = _b.value
+CHAR_TO_BASE_VALUE = bytes(CHAR_TO_BASE_VALUE)
+
 
 class Genotype(EnumNameOnly):
     g00 = 0
@@ -63,6 +79,8 @@ class RefStatus(EnumNameOnly):
 
 RS = RefStatus
 
+REF_STATUS_BY_VALUE = tuple(RefStatus)
+
 gt_to_ref_status = {
     (0, 0): RS.hom_ref, (0, 1): RS.het_mix, (1, 1): RS.hom_alt,
     (1, 2): RS.het_alt, (2, 2): RS.hom_alt,
@@ -84,6 +102,57 @@ class Locus(NamedTuple):
     ref_base: Base
 
 
+class CompactLocus(object):
+    """
+    Locus with the bases and ref status as their enum values (small ints)
+    and without the inner bases tuple, for the per-locus hot paths.
+
+    b1, b2: Base values of both haplotypes
+    rs: RefStatus value
+    rb: Base value of the reference
+
+    bases, ref_status and ref_base return the enum members like Locus does.
+    """
+    __slots__ = ("contig", "pos", "b1", "b2", "rs", "rb")
+
+    def __init__(self, contig: str, pos: int, b1: int, b2: int, rs: int, rb: int):
+        self.contig = contig
+        self.pos = pos
+        self.b1 = b1
+        self.b2 = b2
+        self.rs = rs
+        self.rb = rb
+
+    @property
+    def bases(self) -> Tuple[Base, Base]:
+        return BASES_BY_VALUE[self.b1], BASES_BY_VALUE[self.b2]
+
+    @property
+    def ref_status(self) -> RefStatus:
+        return REF_STATUS_BY_VALUE[self.rs]
+
+    @property
+    def ref_base(self) -> Base:
+        return BASES_BY_VALUE[self.rb]
+
+    def to_locus(self) -> Locus:
+        return Locus(self.contig, self.pos, self.bases, self.ref_status, self.ref_base)
+
+    @classmethod
+    def from_locus(cls, l: Locus) -> "CompactLocus":
+        return cls(l.contig, l.pos, l.bases[0].value, l.bases[1].value, l.ref_status.value,
+                   l.ref_base.value)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, CompactLocus):
+            return NotImplemented
+        return (self.contig, self.pos, self.b1, self.b2, self.rs, self.rb) == \
+            (other.contig, other.pos, other.b1, other.b2, other.rs, other.rb)
+
+    def __repr__(self) -> str:
+        return repr(self.to_locus()).replace("Locus(", "CompactLocus(", 1)
+
+
 class VariantType(EnumNameOnly):
     SNP = 0
     INS = 1
@@ -146,6 +215,13 @@ def read_fai(filename: str, contigs: Iterable[str]) -> Dict[str, FaiLine]:
     return fai_index
 
 
+def fai_offset(fai_line: FaiLine, pos: int) -> int:
+    """
+    Byte offset of (0-based) pos in the fasta file
+    """
+    return fai_line.start + pos // fai_line.bapl * fai_line.bypl + pos % fai_line.bapl
+
+
 class VCFFile(object):
     def __init__(self, filename: str, contig: str, filter_status: bool = True):
         self.filename = filename
@@ -153,10 +229,26 @@ class VCFFile(object):
         self.filter_status = filter_status
 
     def iterate_from_pos(self, pos: int) -> Iterator[Variant]:
-        with open(self.filename, "rb") as f:
-            self._search_for_pos(f, pos)
+        with open_file(self.filename) as f:
+            self.seek_to_pos(f, pos)
             yield from self._iterate_vcf(f)
 
+    def seek_to_pos(self, file: BinaryIO, pos: int) -> None:
+        """
+        Seek file (opened self.filename) to the first variant call at or after pos,
+        using the VCF index or tabix index if there is one
+        """
+        index = get_index(self.filename)
+        tabix_index = None
+        if index is None and isinstance(file, BGZFFile):
+            tabix_index = get_tabix_index(self.filename)
+        if index is not None:
+            index.seek_to_pos(file, pos)
+        elif tabix_index is not None:
+            tabix_index.seek_to_pos(file, self.contig, pos)
+        else:
+            self._search_for_pos(file, pos)
+
     def _search_for_pos(self, file: BinaryIO, pos: int) -> None:
         """
         Binary search through the VCF file to find the position of
@@ -195,7 +287,17 @@ class VCFFile(object):
 
             logging.debug(f"{self.contig}:{lower}-{upper}")
 
-        file.seek(upper)
+        # lines between lower and upper haven't all been looked at (the search stops once
+        # no line starts after the middle), so check them one by one
+        file.seek(lower)
+        offset = lower
+        while offset < upper:
+            line = file.readline()
+            v = self._parse_vcf_line(line.decode("ascii"))
+            if v is not None and v.pos >= pos:
+                break
+            offset += len(line)
+        file.seek(offset)
         logging.info(
             f"Found next variant.")
 
@@ -215,7 +317,7 @@ class VCFFile(object):
         else:
             v_type = VT.OTHER
 
-        gt, pl = cols[-1].split(":")
+        gt, _, pl = cols[-1].partition(":")
         gt = tuple(int(gi) for gi in gt.split("/"))
         v = Variant(contig=cols[0], pos=int(cols[1]), type=v_type,
                     ref=ref, alts=alts, qual=float(cols[5]),
@@ -237,150 +339,617 @@ class InvalidVariantsError(ValueError):
     pass
 
 
-def filter_variants(variants: List[Variant], contig: str, i: int) -> List[Variant]:
+# calls a haplotype can carry at one position
+PLOIDY = 2
+
+
+def call_score(v: Variant) -> float:
     """
-    This tries to filter out incompatible calls, assuming everything should be diploid
-    This is sort of useless as we only display one sequence anyway
-    so if there are multiple calls at a locus (e.g. an insertion and an SNP)
-    we have to choose one in the end.
+    Confidence that the call isn't hom-ref: the phred scaled likelihood of the
+    0/0 genotype (the first PL) if there are likelihoods, else the quality score.
+    Unlike qual this is based on the reads of the sample, so e.g. an indel seen
+    in a single read doesn't beat a well supported SNP.
     """
-    variants.sort(key=lambda v: -v.qual)
+    pl = v.pl.split(",", 1)[0]
+    if pl and pl != ".":
+        try:
+            return float(pl)
+        except ValueError:
+            pass
+    return v.qual
 
-    if len(variants) > 2:
-        logging.warning(
-            f"{len(variants)} variant calls at {contig}:{i}, dropping lowest quality non-SNP!")
-        new_vs = []
-        to_drop = len(variants) - 2
-        for v in reversed(variants):
-            if to_drop > 0 and v.type != VT.SNP:
-                to_drop += 1
-                continue
-            new_vs.append(v)
-        if len(variants) > 2:
-            logging.error(
-                f"{len(variants)} SNP variant calls at {contig}:{i}???")
-        # if there were no non-SNPs drop lowest quality SNPs (should never happen).
-        variants = new_vs[:2]
-
-    if len(variants) == 2 and any(v.gt != (0, 1) for v in variants):
-        # I think this should only occur if one of the variant calls is an SNP and the other an INDEL
-        # although I'm not sure why they wouldn't be combined into one?
-        # see https://github.com/samtools/bcftools/issues/552
-
-        if any(v.type == VT.SNP for v in variants):
-            # There seem to be some weird INDEL calls, e.g. the one at chr1:4060135
-            # is based on only one read but gets a higher quality score then the
-            # hom alt call based on 10s of reads
-            # TODO: bcftools call seems to make some very clear mistakes when an SNP is
-            #       colocated with an insert.
-            #       E.g. at chr2:15909961 the SNP is called homozygous alt even though it
-            #       appears in exactly 50% of reads! Unfortunately we throw the insert away
-            #       here even though it's clearly real.
-            #       Probably best to fix this when calling, not in post
-            logging.warning(
-                f"{contig}:{i} One of 2 variant calls not heterozygous, dropping indel!")
-            variants = [v for v in variants if v.type == VT.SNP]
+
+class _Call(object):
+    """
+    A call in the resolution: reference span [start, end) (0-based)
+    and the (allele index, bases) it puts on each haplotype
+    """
+    __slots__ = ("variant", "n", "start", "end", "score", "alleles", "load", "dropped")
+
+    def __init__(self, variant: Variant, n: int):
+        self.variant = variant
+        self.n = n  # order in the stream, breaks ties
+        self.start = variant.pos - 1
+        self.end = self.start + len(variant.ref)
+        self.score = call_score(variant)
+        gt = variant.gt if len(variant.gt) > 1 else variant.gt * 2  # haploid chrX/Y/M
+        alleles = [variant.ref] + variant.alts
+        # (allele index, bases) per haplotype
+        if gt[0] == 0 or gt[1] == 0:
+            # het: one haplotype, chosen when the cluster is complete
+            self.alleles = [None, (max(gt), alleles[max(gt)])]
         else:
-            logging.warning(
-                f"{contig}:{i} One of 2 variant calls not heterozygous, dropping lowest quality!")
-            variants = variants[:1]
-
-    return variants
-
-
-def iterate_ref(ref_file: TextIO, fai_line: FaiLine, start_pos: int = 0) -> Iterator[Tuple[int, Base]]:
-    contig = fai_line.contig
-    ref_file.seek(fai_line.start + start_pos // fai_line.bapl *
-                  fai_line.bypl + start_pos % fai_line.bapl)
-    i = start_pos
-    valid_bases = frozenset(base_to_enum.keys())
-    for line in ref_file:
-        for c in line.strip():
-            if i >= fai_line.len:
-                return
-
-            if c in valid_bases:
-                i += 1
-                yield i, base_to_enum[c]
-            elif c == ">":
-                logging.warning(
-                    f"{contig}:{i} Contig ended prematurely, expected {fai_line.len} bases, got {i}.")
-                return
+            self.alleles = [(gt[0], alleles[gt[0]]), (gt[1], alleles[gt[1]])]
+        self.load = sum(1 for g in gt[:2] if g != 0)
+        self.dropped = False
+
+
+def _drop(call: _Call, reason: str, stats: Counter, log: bool = True) -> None:
+    call.dropped = True
+    stats["dropped_calls"] += 1
+    stats["dropped_" + reason] += 1
+    if log:
+        v = call.variant
+        logging.warning(f"{v.contig}:{v.pos} Dropping {v.type} call ({reason}, score {call.score})")
+
+
+def _finish_cluster(calls: List[_Call], stats: Counter) -> List[_Call]:
+    """
+    Assigns the het calls of a cluster to a haplotype, returns the chosen calls
+    """
+    calls = sorted((c for c in calls if not c.dropped), key=lambda c: (c.start, c.n))
+    # end of the last call on each haplotype
+    hap_end = [-1, -1]
+    for c in calls:
+        if c.alleles[0] is None:
+            # the alt allele goes to the second haplotype (as for a single 0/1 call) if it's free
+            if hap_end[1] > c.start:
+                c.alleles.reverse()
+                hap_end[0] = c.end
             else:
-                logging.error(f"{contig}:{i} Invalid char '{c}' in fasta")
-
-
-def get_consensus_sequence(vcf_path: str, ref_file: TextIO, fai_line: FaiLine,
-                           start_pos: int = 0) -> Iterator[Locus]:
-    contig = fai_line.contig
-    vcf_file = VCFFile(vcf_path, contig, filter_status=True)
-    vcf_iter = vcf_file.iterate_from_pos(start_pos)
-    next_variant = next(vcf_iter)
-
-    reference = iterate_ref(ref_file, fai_line, start_pos)
-
-    n_diffs = 0
-    for i, ref_base in reference:
-        if i % 1E6 == 0:
-            print(i, n_diffs)
-
-        if next_variant is not None and i == next_variant.pos:
-            n_diffs += 1
-            variants = [next_variant]
-            for next_variant in vcf_iter:
-                if i != next_variant.pos:
-                    break
-                variants.append(next_variant)
-
-            for v in variants:
-                if v.ref[0] != ref_base:
-                    logging.error(
-                        f"{contig}:{i} Difference between VCF ref ({v.ref[0]}) and fasta ref ({ref_base})")
-
-            variants = filter_variants(variants, contig, i)
-
-            # choose the SNP if there is one as the quality scores don't seem comparable
-            # between SNP/INDEL
-            variant = ([v for v in variants if v.type == VT.SNP] + variants)[0]
-            # TODO: use multiple variants where it makes sense
-            # e.g. at chr1:50156031 it's pretty clear that it's heterozygous
-            # with an insertion on the reference chromosome
-            
-            if len(variant.gt) == 1:
-                # for chr x/y/m (ugly...)
-                variant = variant._replace(gt=(variant.gt[0], variant.gt[0]))
-
-            if variant.type == VT.SNP:
-                base_options = variant.ref + sum(variant.alts, [])
-                bases = tuple(base_options[bi] for bi in variant.gt)
-                yield Locus(contig, i, bases, gt_to_ref_status[variant.gt], ref_base=ref_base)
+                hap_end[1] = c.end
+        else:
+            hap_end = [c.end, c.end]
+    if len(calls) > 1:
+        stats["combined_calls"] += len(calls)
+    return calls
+
+
+def resolve_calls(variants: Iterable[Variant], stats: Counter) -> Iterator[List[_Call]]:
+    """
+    Chooses compatible calls from a position sorted stream of PASS calls in one pass,
+    yields clusters of chosen calls with overlapping reference spans in order.
+
+    Each haplotype carries at most one call at a position: het calls (e.g. 0/1)
+    use one haplotype, hom / 1/2 / haploid calls both. A call that doesn't fit
+    next to the chosen calls covering its start replaces the lowest scoring set
+    of them that makes room if it has a higher score (see call_score),
+    otherwise it's dropped. The chosen calls covering the current position are
+    kept in a heap by end, so a call costs O(log k) for k overlapping calls.
+
+    stats counts dropped_calls, split into dropped_conflicting, dropped_hom_ref
+    (0/0 calls don't change anything) and dropped_unsorted,
+    and combined_calls (kept in a cluster together with other calls)
+    """
+    active: List[Tuple[int, int, _Call]] = []  # heap of (end, n, call)
+    load = 0  # haplotypes used at the current position
+    cluster: List[_Call] = []
+    cluster_end = 0
+    last_pos = 0
+    n = 0
+    for pos, group in groupby(variants, key=attrgetter("pos")):
+        calls = [_Call(v, n + j) for j, v in enumerate(group)]
+        n += len(calls)
+        if pos < last_pos:
+            for c in calls:
+                _drop(c, "unsorted", stats)
+            continue
+        last_pos = pos
+
+        start = pos - 1
+        while active and active[0][0] <= start:
+            c = heappop(active)[2]
+            if not c.dropped:
+                load -= c.load
+        if cluster and cluster_end <= start:
+            chosen = _finish_cluster(cluster, stats)
+            if chosen:
+                yield chosen
+            cluster = []
+
+        # the best calls at a position get the first choice
+        for c in sorted(calls, key=lambda c: -c.score):
+            if c.load == 0:
+                _drop(c, "hom_ref", stats, log=False)
+                continue
+            if load + c.load > PLOIDY:
+                chosen = [a for _, _, a in active if not a.dropped]
+                need = load + c.load - PLOIDY
+                options = [o for k in range(1, len(chosen) + 1)
+                           for o in combinations(chosen, k) if sum(a.load for a in o) >= need]
+                replaced = min(options, key=lambda o: sum(a.score for a in o), default=None)
+                if replaced is None or sum(a.score for a in replaced) >= c.score:
+                    _drop(c, "conflicting", stats)
+                    continue
+                for a in replaced:
+                    _drop(a, "conflicting", stats)
+                    load -= a.load
+            heappush(active, (c.end, c.n, c))
+            load += c.load
+            cluster.append(c)
+            cluster_end = max(cluster_end, c.end)
+    chosen = _finish_cluster(cluster, stats)
+    if chosen:
+        yield chosen
+
+
+def _cluster_loci(calls: List[_Call], start: int,
+                  codes: bytes) -> List[Tuple[int, int, int, int, int]]:
+    """
+    (pos, base 1, base 2, ref status, ref base) values of the loci of a resolved cluster
+    starting at start (0-based), codes: the reference from start to the end of the cluster.
+
+    Alleles are aligned to the reference base by base from the call position. Bases
+    an allele has beyond its reference span are inserted after it, missing ones are X.
+    All loci of a call get its position. The ref status follows the calls covering a
+    locus: hom_ref/het_mix if none/one haplotype is covered, hom_alt if both are covered
+    by the same allele, het_alt for different alleles.
+    """
+    n = len(codes)
+    bases = [bytearray(codes), bytearray(codes)]
+    keys: List[List[Optional[Tuple[int, int]]]] = [[None] * n, [None] * n]
+    inserts: List[Dict[int, List[Base]]] = [{}, {}]
+    col_pos: List[Optional[int]] = [None] * n
+    for c in calls:
+        offset = c.start - start
+        ref_len = c.end - c.start
+        for h, allele in enumerate(c.alleles):
+            if allele is None:
+                continue
+            key = (c.n, allele[0])
+            allele = allele[1]
+            for j in range(ref_len):
+                bases[h][offset + j] = allele[j].value if j < len(allele) else B.X.value
+                keys[h][offset + j] = key
+                if col_pos[offset + j] is None or c.variant.pos < col_pos[offset + j]:
+                    col_pos[offset + j] = c.variant.pos
+            if len(allele) > ref_len:
+                inserts[h][offset + ref_len - 1] = allele[ref_len:]
+
+    loci = []
+    for j in range(n):
+        k1, k2 = keys[0][j], keys[1][j]
+        if k1 is None and k2 is None:
+            rs = RS.hom_ref.value
+        elif k1 is None or k2 is None:
+            rs = RS.het_mix.value
+        else:
+            rs = RS.hom_alt.value if k1 == k2 else RS.het_alt.value
+        pos = col_pos[j] or start + j + 1
+        loci.append((pos, bases[0][j], bases[1][j], rs, codes[j]))
+        ins1, ins2 = inserts[0].get(j, ()), inserts[1].get(j, ())
+        for b1, b2 in zip_longest(ins1, ins2, fillvalue=B.X):
+            loci.append((pos, b1.value, b2.value, rs, B.X.value))
+    return loci
+
+
+# fasta lines read at once by iterate_ref_blocks (4MB for 60 base lines)
+REF_BLOCK_LINES = 1 << 16
+
+
+def _chars_to_codes(chars: bytes, contig: str, start: int, expected_len: int) -> bytes:
+    """
+    Base values of the fasta characters chars (newlines removed) starting at start (0-based).
+    Invalid characters are logged and replaced by N, the codes end at a premature '>'.
+    """
+    end = chars.find(b">")
+    if end != -1:
+        logging.warning(f"{contig}:{start + end} Contig ended prematurely, "
+                        f"expected {start + expected_len} bases.")
+        chars = chars[:end]
+    elif len(chars) != expected_len:
+        logging.warning(f"{contig}:{start} Expected {expected_len} bases, got {len(chars)}. "
+                        f"Does the fai match the fasta?")
+    codes = chars.translate(CHAR_TO_BASE_VALUE)
+    i = codes.find(INVALID_BASE_VALUE)
+    if i == -1:
+        return codes
+    while i != -1:
+        logging.error(f"{contig}:{start + i} Invalid char '{chr(chars[i])}' in fasta")
+        i = codes.find(INVALID_BASE_VALUE, i + 1)
+    return codes.replace(INVALID_BASE_VALUE, bytes([Base.N.value]))
+
+
+def iterate_ref_blocks(ref_file: Union[TextIO, BinaryIO], fai_line: FaiLine, start_pos: int = 0,
+                       block_lines: int = REF_BLOCK_LINES) -> Iterator[Tuple[int, bytes]]:
+    """
+    Streams the Base values of a contig from start_pos (0-based) in blocks of
+    block_lines fasta lines, yields (0-based position of the first base, codes).
+
+    The file is read sequentially with the byte ranges computed from the fai line
+    geometry (bapl/bypl), newlines are removed and characters translated for the
+    whole block at once. Invalid characters become N, a '>' ends the contig early.
+    """
+    f = getattr(ref_file, "buffer", ref_file)
+    bapl = fai_line.bapl
+
+    pos = start_pos
+    f.seek(fai_offset(fai_line, pos))
+    while pos < fai_line.len:
+        # the first line can be partial, the others are complete (except at the end)
+        end = min((pos // bapl + block_lines) * bapl, fai_line.len)
+        n_bytes = fai_offset(fai_line, end) - fai_offset(fai_line, pos)
+        chars = f.read(n_bytes).translate(None, b"\r\n")
+        codes = _chars_to_codes(chars, fai_line.contig, pos, end - pos)
+        if codes:
+            yield pos, codes
+        if len(codes) < end - pos:
+            return
+        pos = end
+
+
+def iterate_ref(ref_file: Union[TextIO, BinaryIO], fai_line: FaiLine,
+                start_pos: int = 0) -> Iterator[Tuple[int, Base]]:
+    """
+    (1-based position, base) from start_pos (0-based), see iterate_ref_blocks
+    """
+    for block_start, codes in iterate_ref_blocks(ref_file, fai_line, start_pos):
+        yield from zip(count(block_start + 1), map(BASES_BY_VALUE.__getitem__, codes))
+
+
+class FastaContig(object):
+    """
+    Random access to the bases of one contig of a fasta file, using the fai geometry.
+    """
+    def __init__(self, ref_file: Union[TextIO, BinaryIO], fai_line: FaiLine):
+        # read the underlying binary file, so the fai byte offsets work
+        self.ref_file = getattr(ref_file, "buffer", ref_file)
+        self.fai_line = fai_line
+        self.contig = fai_line.contig
+        self.len = fai_line.len
+
+    def _offset(self, pos: int) -> int:
+        return fai_offset(self.fai_line, pos)
+
+    def get_codes(self, start: int, end: int) -> bytes:
+        """
+        Base values of the bases in [start, end) (0-based) as bytes
+        """
+        start = max(start, 0)
+        end = min(end, self.len)
+        if start >= end:
+            return b""
+        self.ref_file.seek(self._offset(start))
+        chars = self.ref_file.read(self._offset(end) - self._offset(start)).translate(None, b"\r\n")
+        return _chars_to_codes(chars, self.contig, start, end - start)
+
+
+class ConsensusBlock(NamedTuple):
+    """
+    A block of consecutive loci as parallel arrays (bases etc. as enum values)
+
+    pos: positions in the contig (1-based, repeated for insertions)
+    bases1, bases2: Base values of both haplotypes
+    ref_status: RefStatus values
+    ref_base: Base values of the reference
+    """
+    contig: str
+    pos: array
+    bases1: bytearray
+    bases2: bytearray
+    ref_status: bytearray
+    ref_base: bytearray
+
+    def loci(self) -> Iterator[Locus]:
+        contig = self.contig
+        for pos, b1, b2, rs, rb in zip(self.pos, self.bases1, self.bases2,
+                                       self.ref_status, self.ref_base):
+            yield Locus(contig, pos, (BASES_BY_VALUE[b1], BASES_BY_VALUE[b2]),
+                        REF_STATUS_BY_VALUE[rs], ref_base=BASES_BY_VALUE[rb])
+
+    def compact_loci(self) -> Iterator[CompactLocus]:
+        return map(CompactLocus, repeat(self.contig), self.pos, self.bases1, self.bases2,
+                   self.ref_status, self.ref_base)
+
+
+def _check_ref(calls: List[_Call], start: int, codes: bytes, stats: Counter) -> None:
+    for c in calls:
+        v = c.variant
+        fasta_ref = [BASES_BY_VALUE[b] for b in codes[c.start - start:c.end - start]]
+        if fasta_ref != v.ref:
+            logging.error(f"{v.contig}:{v.pos} Difference between VCF ref "
+                          f"({''.join(map(str, v.ref))}) and fasta ref "
+                          f"({''.join(map(str, fasta_ref))})")
+            stats["ref_mismatches"] += 1
+
+
+def _padded_codes(reference, start: int, end: int) -> bytes:
+    """
+    reference.get_codes(start, end), N for calls beyond the end of the reference
+    """
+    codes = reference.get_codes(start, end)
+    return codes + bytes([B.N.value]) * (end - start - len(codes))
+
+
+class ConsensusBuilder(object):
+    """
+    Builds the consensus sequence of a contig in blocks.
+
+    reference: anything with get_codes(start, end) and len,
+               e.g. FastaContig or packed_ref.PackedContig
+    variants: PASS variants at or after start_pos (0-based), sorted by position
+
+    The calls are resolved into clusters of compatible calls by resolve_calls.
+    Stretches between clusters are copied from the reference slice in bulk,
+    only the cluster loci are handled one by one.
+
+    stats: if given, counts ref_mismatches and the counters of resolve_calls
+    """
+    def __init__(self, reference, variants: Iterable[Variant], start_pos: int = 0,
+                 stats: Optional[Counter] = None):
+        self.reference = reference
+        self.stats = stats if stats is not None else Counter()
+        self.contig = reference.contig
+        self.clusters = resolve_calls(variants, self.stats)
+        self.next_cluster = next(self.clusters, None)
+        # 0-based index of the next reference base
+        self.i = start_pos
+
+    def next_block(self, n: int) -> Optional[ConsensusBlock]:
+        """
+        Loci for (about) the next n reference bases, None at the end of the contig.
+        The block can extend further if it ends in a cluster of calls.
+        """
+        start = self.i
+        end = min(start + n, self.reference.len)
+        if start >= end:
+            return None
+        codes = self.reference.get_codes(start, end)
+        end = start + len(codes)
+        contig = self.contig
+
+        pos = array("L")
+        bases1 = bytearray()
+        bases2 = bytearray()
+        ref_status = bytearray()
+        ref_base = bytearray()
+
+        cur = start
+        while cur < end:
+            # skip clusters that can't match any more (i.e. an unsorted VCF)
+            while self.next_cluster is not None and self.next_cluster[0].start < cur:
+                for c in self.next_cluster:
+                    _drop(c, "unsorted", self.stats)
+                self.next_cluster = next(self.clusters, None)
+
+            stop = end
+            if self.next_cluster is not None:
+                stop = min(stop, self.next_cluster[0].start)
+
+            if stop > cur:
+                seg = codes[cur - start:stop - start]
+                pos.extend(range(cur + 1, stop + 1))
+                bases1 += seg
+                bases2 += seg
+                ref_base += seg
+                ref_status += bytes(stop - cur)  # RS.hom_ref
+                cur = stop
+
+            if cur >= end:
+                break
+
+            calls = self.next_cluster
+            self.next_cluster = next(self.clusters, None)
+            cluster_end = max(c.end for c in calls)
+            if cluster_end <= end:
+                cluster_codes = codes[cur - start:cluster_end - start]
             else:
-                ref_alts = [variant.ref] + variant.alts
-                
-                for b1, b2, ref_base_ in zip_longest(*(ref_alts[vi] for vi in variant.gt),
-                                                     variant.ref, fillvalue=B.X):
-                    yield Locus(contig, i, (b1, b2), gt_to_ref_status[variant.gt], ref_base=ref_base_)
-
-                # we yield from the sequence in the variant, so we need
-                # to skip the corresponding bases in the reference
-                [next(reference) for _ in variant.ref[1:]]
-
-                # If the next variant starts before this indel ends we have to skip it
-                # TODO: This is stupid...
-                # the skipped calls might be higher quality than the original one
-                while next_variant.pos < i + len(variant.ref):
-                    next_variant = next(vcf_iter, None)
+                cluster_codes = _padded_codes(self.reference, cur, cluster_end)
+            _check_ref(calls, cur, cluster_codes, self.stats)
+            for p, b1, b2, rs, rb in _cluster_loci(calls, cur, cluster_codes):
+                pos.append(p)
+                bases1.append(b1)
+                bases2.append(b2)
+                ref_status.append(rs)
+                ref_base.append(rb)
+            cur = cluster_end
+
+        self.i = cur
+        return ConsensusBlock(contig, pos, bases1, bases2, ref_status, ref_base)
 
+
+CONSENSUS_BLOCK_SIZE = 4096
+
+
+class _TourCluster(object):
+    """
+    A resolved cluster of calls in the variant tour: reference span [start, end) (0-based)
+    and its loci (see _cluster_loci) once computed
+    """
+    __slots__ = ("calls", "start", "end", "loci")
+
+    def __init__(self, calls: List[_Call]):
+        self.calls = calls
+        self.start = calls[0].start
+        self.end = max(c.end for c in calls)
+        self.loci: Optional[List[Tuple[int, int, int, int, int]]] = None
+
+    def compute_loci(self, codes: bytes, stats: Counter) -> None:
+        """
+        codes: the reference of the cluster span
+        """
+        _check_ref(self.calls, self.start, codes, stats)
+        self.loci = _cluster_loci(self.calls, self.start, codes)
+
+
+def _tour_block(reference, clusters: List[_TourCluster], start: int, end: int,
+                stats: Counter) -> ConsensusBlock:
+    """
+    Loci of [start, end) (0-based) with the given clusters of calls, read with one
+    reference access
+    """
+    codes = _padded_codes(reference, start, end)
+    pos = array("L")
+    bases1 = bytearray()
+    bases2 = bytearray()
+    ref_status = bytearray()
+    ref_base = bytearray()
+    cur = start
+    for cluster in clusters + [None]:
+        stop = end if cluster is None else cluster.start
+        seg = codes[cur - start:stop - start]
+        pos.extend(range(cur + 1, stop + 1))
+        bases1 += seg
+        bases2 += seg
+        ref_base += seg
+        ref_status += bytes(stop - cur)  # RS.hom_ref
+        if cluster is None:
+            break
+        if cluster.loci is None:
+            cluster.compute_loci(codes[stop - start:cluster.end - start], stats)
+        for p, b1, b2, rs, rb in cluster.loci:
+            pos.append(p)
+            bases1.append(b1)
+            bases2.append(b2)
+            ref_status.append(rs)
+            ref_base.append(rb)
+        cur = cluster.end
+    return ConsensusBlock(reference.contig, pos, bases1, bases2, ref_status, ref_base)
+
+
+def _group_end(group: List[_TourCluster], flank_end: int, ref_len: int) -> int:
+    """
+    End of a tour block: the right flank, clipped to the reference,
+    but not cutting the calls of the block
+    """
+    return max(min(flank_end, ref_len), group[-1].end)
+
+
+def iterate_variant_tour(reference, variants: Iterable[Variant], flank: int, start_pos: int = 0,
+                         types: Optional[Collection[VariantType]] = None,
+                         ref_statuses: Optional[Collection[RefStatus]] = None,
+                         stats: Optional[Counter] = None) -> Iterator[ConsensusBlock]:
+    """
+    Sparse consensus driven by the calls: a block for each resolved cluster of calls
+    (see resolve_calls) with flank reference bases on both sides, clusters closer
+    than 2 * flank share a block. Only these stretches are read from the reference
+    (one get_codes per block, plus one per cluster passing the types filter when
+    filtering by ref status), so the cost depends on the number of calls, not the
+    length of the contig.
+
+    reference, variants: as for ConsensusBuilder, blocks start at start_pos or later
+    types: only clusters with a call of one of these types start a block
+    ref_statuses: only clusters with a locus of one of these ref statuses start a block
+    Filtered clusters are still shown where they fall into the flanks of a block,
+    so the flanks match the full consensus.
+    stats: counts tour_clusters (shown) and tour_filtered besides the counters of resolve_calls
+    """
+    stats = stats if stats is not None else Counter()
+    rs_values = None if ref_statuses is None else {rs.value for rs in ref_statuses}
+    # clusters of the current block (shown or not) and the end of its right flank
+    group: List[_TourCluster] = []
+    group_start = flank_end = start_pos
+    block_end = start_pos  # end of the last block
+    prev_end = start_pos
+    # filtered clusters after the current block, which can end up in the next left flank
+    skipped: deque = deque()
+    for calls in resolve_calls(variants, stats):
+        cluster = _TourCluster(calls)
+        if cluster.start < start_pos:
+            continue
+        if cluster.start < prev_end:
+            for c in calls:
+                _drop(c, "unsorted", stats)
+            continue
+        prev_end = cluster.end
+
+        shown = types is None or any(c.variant.type in types for c in calls)
+        if shown and rs_values is not None:
+            # the loci are reused by _tour_block
+            cluster.compute_loci(_padded_codes(reference, cluster.start, cluster.end), stats)
+            shown = any(l[3] in rs_values for l in cluster.loci)
+        if not shown:
+            # still part of the consensus where it falls into a flank
+            stats["tour_filtered"] += 1
+            if group and cluster.start < flank_end:
+                group.append(cluster)
+            else:
+                while skipped and skipped[0].end <= cluster.start - flank:
+                    skipped.popleft()
+                skipped.append(cluster)
             continue
 
-        yield Locus(contig, i, (ref_base, ref_base), RS.hom_ref, ref_base=ref_base)
+        stats["tour_clusters"] += 1
+        if group and cluster.start - flank > flank_end:
+            block_end = _group_end(group, flank_end, reference.len)
+            yield _tour_block(reference, group, group_start, block_end, stats)
+            group = []
+        if not group:
+            group_start = max(cluster.start - flank, block_end)
+            for sk in skipped:
+                if sk.start < group_start < sk.end:
+                    # the flank ends at a filtered cluster it would cut
+                    group_start = sk.end
+                elif sk.start >= group_start:
+                    group.append(sk)
+        else:
+            group.extend(skipped)
+        skipped.clear()
+        group.append(cluster)
+        flank_end = cluster.end + flank
+    if group:
+        yield _tour_block(reference, group, group_start,
+                          _group_end(group, flank_end, reference.len), stats)
+
+
+def _get_builder(vcf_path: str, ref_file: Optional[TextIO], fai_line: FaiLine, start_pos: int,
+                 reference, variants: Optional[Iterable[Variant]]) -> ConsensusBuilder:
+    if variants is None:
+        vcf_file = VCFFile(vcf_path, fai_line.contig, filter_status=True)
+        # VCF positions are 1-based
+        variants = vcf_file.iterate_from_pos(start_pos + 1)
+    if reference is None:
+        reference = FastaContig(ref_file, fai_line)
+    return ConsensusBuilder(reference, variants, start_pos)
+
+
+def get_consensus_block(vcf_path: str, ref_file: Optional[TextIO], fai_line: FaiLine,
+                        start_pos: int, n: int, reference=None,
+                        variants: Optional[Iterable[Variant]] = None) -> Optional[ConsensusBlock]:
+    """
+    Loci for (about) n reference bases from start_pos as parallel arrays.
+    See get_consensus_sequence for the arguments.
+    """
+    return _get_builder(vcf_path, ref_file, fai_line, start_pos,
+                        reference, variants).next_block(n)
+
+
+def get_consensus_sequence(vcf_path: str, ref_file: Optional[TextIO], fai_line: FaiLine,
+                           start_pos: int = 0, reference=None,
+                           variants: Optional[Iterable[Variant]] = None,
+                           compact: bool = False) -> Iterator[Union[Locus, CompactLocus]]:
+    """
+    reference: reference source with get_codes(start, end),
+               e.g. a packed_ref.PackedContig. If None the reference
+               is read from ref_file.
+    variants: iterator over the PASS variants from start_pos (VCF pos >= start_pos + 1),
+              e.g. from vcf_bulk.iterate_variants_from. If None they are read
+              from vcf_path with VCFFile.
+    compact: yield CompactLocus instead of Locus
+    """
+    builder = _get_builder(vcf_path, ref_file, fai_line, start_pos, reference, variants)
+    while True:
+        block = builder.next_block(CONSENSUS_BLOCK_SIZE)
+        if block is None:
+            return
+        yield from block.compact_loci() if compact else block.loci()
 
 
 if __name__ == "__main__":
     from config import VCF_PATH_PATTERN, CONTIGS, FASTA_PATH, FAI_PATH
 
     contig = CONTIGS[2]
-    vcf_path = VCF_PATH_PATTERN.format(contig)
+    vcf_path = VCF_PATH_PATTERN.format(contig=contig)
     fai_index = read_fai(FAI_PATH, CONTIGS)
 
     with open(FASTA_PATH, mode="r", encoding="utf-8") as ref_file:
@@ -0,0 +1,326 @@
+"""
+Whole genome consensus export and statistics, in parallel over all cores.
+
+Contigs are split into shards of about SHARD_SIZE bases that are built
+independently in a process pool. Shard boundaries are moved to the next
+position no PASS call can skip over (i.e. not inside a deletion or other
+multi-base call), so a shard started there continues exactly where the
+previous shard stops and indels crossing the nominal boundary are
+handled once, by the shard they start in.
+
+Outputs (to OUT_DIR):
+    consensus.fa (+ .fai): the displayed bases (second allele), hom-ref
+                           loci in lowercase, deleted bases left out
+    track_{contig}.bin: consensus tracks as written by track.py (--track,
+                        needs the packed reference)
+    stats.json: per contig counts of PASS calls by VariantType, loci by RefStatus,
+                dropped calls (by reason), combined calls and ref mismatches
+
+Usage: python export.py OUT_DIR [--contigs chr1,chr2] [--processes N] [--track]
+"""
+import json
+import logging
+import os
+from collections import Counter
+from multiprocessing import Pool
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from bgzf import open_file
+from dna import Base, ConsensusBuilder, FaiLine, FastaContig, RefStatus, Variant, read_fai
+from packed_ref import PackedContig
+from track import HEADER as TRACK_HEADER, MAGIC as TRACK_MAGIC, RECORD, RUN, VARIANT
+from vcf_bulk import iterate_variants_from
+
+SHARD_SIZE = 1 << 23
+# calls starting this far before a shard boundary are checked for spanning it
+BOUNDARY_LOOKBACK = 100000
+BOUNDARY_READ_SIZE = 1 << 18
+BLOCK_SIZE = 1 << 16
+LINE_WIDTH = 60
+
+# Base value -> displayed character, hom-ref loci get | 0x20 (lowercase) applied
+_UPPER = bytes(ord(str(b)) for b in Base) + bytes(256 - len(Base))
+_HOMREF_MASK = b"\x20" + bytes(255)
+_KEEP_N_UPPER = bytes(range(256)).replace(b"n", b"N")
+
+
+class Shard(NamedTuple):
+    contig: str
+    index: int
+    start: int  # 0-based, inclusive
+    end: int  # 0-based, exclusive
+
+
+class ShardResult(NamedTuple):
+    shard: Shard
+    fasta: bytes
+    track: bytes  # packed track records
+    n_track_records: int
+    stats: Counter
+
+
+def _spans(vcf_path: str, contig: str, start: int, end: int) -> Iterator[Tuple[int, int]]:
+    """
+    (first, last) 0-based positions ConsensusBuilder may skip over because of
+    the PASS calls starting in [start, end), in order of first
+    """
+    for v in iterate_variants_from(vcf_path, contig, start + 1, BOUNDARY_READ_SIZE):
+        if v.pos - 1 >= end:
+            return
+        if len(v.ref) > 1:
+            yield v.pos, v.pos + len(v.ref) - 2
+
+
+def plan_shards(vcf_path: str, fai_line: FaiLine, shard_size: int = SHARD_SIZE) -> List[Shard]:
+    """
+    Splits a contig into shards, moving each boundary forward to the first
+    position that isn't skipped by a call starting before it
+    """
+    boundaries = [0]
+    for nominal in range(shard_size, fai_line.len, shard_size):
+        b = max(nominal, boundaries[-1])
+        for first, last in _spans(vcf_path, fai_line.contig,
+                                    max(b - BOUNDARY_LOOKBACK, 0), b + BOUNDARY_LOOKBACK):
+            if first <= b <= last:
+                b = last + 1
+        if b < fai_line.len:
+            boundaries.append(b)
+    boundaries.append(fai_line.len)
+    return [Shard(fai_line.contig, i, s, e)
+            for i, (s, e) in enumerate(zip(boundaries, boundaries[1:])) if s < e]
+
+
+def _count_types(variants: Iterator[Variant], last_pos: int, stats: Counter) -> Iterator[Variant]:
+    for v in variants:
+        if v.pos <= last_pos:
+            stats[f"calls_{v.type}"] += 1
+        yield v
+
+
+def _track_records(block, codes: bytes, codes_start: int, run: Optional[List[int]],
+                   out: bytearray) -> Tuple[Optional[List[int]], int]:
+    """
+    Appends the track records of block to out, same as track.compile_contig.
+    codes: reference codes from codes_start (0-based) covering the block
+    run: the open hom-ref run [pos, length], returned updated with the # of records written
+    """
+    n = 0
+    for p, b1, b2, rs, rb in zip(block.pos, block.bases1, block.bases2, block.ref_status,
+                                 block.ref_base):
+        if rs == 0 and b1 == b2 == rb == codes[p - 1 - codes_start]:
+            if run is not None and p == run[0] + run[1]:
+                run[1] += 1
+                continue
+            if run is not None:
+                out += RECORD.pack(RUN, 0, 0, 0, 0, run[0], run[1])
+                n += 1
+            run = [p, 1]
+            continue
+        if run is not None:
+            out += RECORD.pack(RUN, 0, 0, 0, 0, run[0], run[1])
+            n += 1
+            run = None
+        out += RECORD.pack(VARIANT, b1, b2, rs, rb, p, 1)
+        n += 1
+    return run, n
+
+
+def build_shard(args: Tuple[Shard, str, str, FaiLine, Optional[str], bool]) -> ShardResult:
+    shard, ref_path, vcf_path, fai_line, packed_path, with_track = args
+    stats = Counter()
+    fasta = bytearray()
+    track = bytearray()
+    n_track_records = 0
+    run = None
+
+    with open_file(ref_path) as ref_file:
+        if packed_path is not None and os.path.exists(packed_path):
+            reference = PackedContig(packed_path, shard.contig)
+        else:
+            reference = FastaContig(ref_file, fai_line)
+        variants = _count_types(iterate_variants_from(vcf_path, shard.contig, shard.start + 1),
+                                shard.end, stats)
+        builder = ConsensusBuilder(reference, variants, shard.start, stats)
+        while builder.i < shard.end:
+            block_start = builder.i
+            block = builder.next_block(min(BLOCK_SIZE, shard.end - builder.i))
+            if block is None:
+                break
+            for rs in RefStatus:
+                stats[f"loci_{rs}"] += block.ref_status.count(rs.value)
+            # lowercase hom-ref loci by OR-ing 0x20 into their characters, using big ints
+            # to do it for the whole block at once
+            upper = bytes(block.bases2).translate(_UPPER)
+            mask = bytes(block.ref_status).translate(_HOMREF_MASK)
+            chars = (int.from_bytes(upper, "big") | int.from_bytes(mask, "big")).to_bytes(
+                len(upper), "big")
+            fasta += chars.translate(_KEEP_N_UPPER).replace(b"X", b"")
+            if with_track:
+                codes = reference.get_codes(block_start, builder.i)
+                run, n = _track_records(block, codes, block_start, run, track)
+                n_track_records += n
+        if isinstance(reference, PackedContig):
+            reference.close()
+
+    if builder.i != shard.end:
+        logging.error(f"{shard.contig}: shard {shard.index} ended at {builder.i}, "
+                      f"expected {shard.end}")
+    if run is not None:
+        track += RECORD.pack(RUN, 0, 0, 0, 0, run[0], run[1])
+        n_track_records += 1
+    return ShardResult(shard, bytes(fasta), bytes(track), n_track_records, stats)
+
+
+class _FastaWriter(object):
+    """
+    Writes contigs in fixed width lines, one chunk at a time, and their .fai
+    """
+    def __init__(self, filename: str, line_width: int = LINE_WIDTH):
+        self.file = open(filename, "wb")
+        self.fai = open(filename + ".fai", "w", encoding="ascii", newline="\n")
+        self.line_width = line_width
+        self.contig = None
+        self.carry = b""
+
+    def start_contig(self, contig: str) -> None:
+        self.file.write(f">{contig}\n".encode("ascii"))
+        self.contig = (contig, self.file.tell())
+        self.length = 0
+
+    def write(self, chars: bytes) -> None:
+        data = self.carry + chars
+        n_full = len(data) - len(data) % self.line_width
+        w = self.line_width
+        self.file.write(b"".join(data[i:i + w] + b"\n" for i in range(0, n_full, w)))
+        self.carry = data[n_full:]
+        self.length += len(chars)
+
+    def end_contig(self) -> None:
+        if self.carry:
+            self.file.write(self.carry + b"\n")
+            self.carry = b""
+        contig, offset = self.contig
+        self.fai.write(f"{contig}\t{self.length}\t{offset}\t{self.line_width}\t"
+                       f"{self.line_width + 1}\n")
+
+    def close(self) -> None:
+        self.file.close()
+        self.fai.close()
+
+
+class _TrackWriter(object):
+    """
+    Concatenates shard records to a track file, merging hom-ref runs across shard boundaries
+    """
+    def __init__(self, filename: str, contig_len: int, vcf_stat: os.stat_result):
+        self.file = open(filename, "wb")
+        self.vcf_stamp = (vcf_stat.st_size, vcf_stat.st_mtime_ns)
+        self.file.write(TRACK_HEADER.pack(TRACK_MAGIC, *self.vcf_stamp, contig_len, 0))
+        self.contig_len = contig_len
+        self.n_records = 0
+        self.last: Optional[bytes] = None
+
+    def write(self, records: bytes, n: int) -> None:
+        if not n:
+            return
+        first = RECORD.unpack_from(records, 0)
+        if self.last is not None:
+            last = RECORD.unpack(self.last)
+            if last[0] == RUN and first[0] == RUN and last[5] + last[6] == first[5]:
+                records = (RECORD.pack(RUN, 0, 0, 0, 0, last[5], last[6] + first[6])
+                           + records[RECORD.size:])
+                n -= 1
+            else:
+                self.file.write(self.last)
+        self.file.write(records[:-RECORD.size])
+        self.last = records[-RECORD.size:]
+        self.n_records += n
+
+    def close(self) -> int:
+        if self.last is not None:
+            self.file.write(self.last)
+        self.file.seek(0)
+        self.file.write(TRACK_HEADER.pack(TRACK_MAGIC, *self.vcf_stamp, self.contig_len,
+                                          self.n_records))
+        self.file.close()
+        return self.n_records
+
+
+def export(out_dir: str, ref_path: str, fai_path: str, contigs: List[str],
+           vcf_paths: Dict[str, str], packed_ref_paths: Dict[str, str],
+           processes: Optional[int] = None, with_track: bool = False,
+           shard_size: int = SHARD_SIZE) -> Dict[str, Counter]:
+    """
+    Writes consensus.fa(.fai), stats.json and (with_track) track_{contig}.bin to out_dir,
+    returns the statistics per contig
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    fai_index = read_fai(fai_path, contigs)
+    # before reading, so a VCF that changes meanwhile makes the tracks stale
+    vcf_stats = {contig: os.stat(vcf_paths[contig]) for contig in contigs}
+    tasks = []
+    for contig in contigs:
+        packed_path = packed_ref_paths.get(contig)
+        if with_track and (packed_path is None or not os.path.exists(packed_path)):
+            raise ValueError(f"Track export needs the packed reference of {contig}")
+        for shard in plan_shards(vcf_paths[contig], fai_index[contig], shard_size):
+            tasks.append((shard, ref_path, vcf_paths[contig], fai_index[contig], packed_path,
+                          with_track))
+    logging.info(f"{len(tasks)} shards in {len(contigs)} contigs")
+
+    stats: Dict[str, Counter] = {c: Counter() for c in contigs}
+    fasta = _FastaWriter(os.path.join(out_dir, "consensus.fa"))
+    track = None
+    with Pool(processes) as pool:
+        # imap returns the shards in order, while the pool works ahead
+        for result in pool.imap(build_shard, tasks):
+            shard = result.shard
+            if shard.index == 0:
+                if fasta.contig is not None:
+                    fasta.end_contig()
+                fasta.start_contig(shard.contig)
+                if with_track:
+                    if track is not None:
+                        track.close()
+                    track = _TrackWriter(os.path.join(out_dir, f"track_{shard.contig}.bin"),
+                                         fai_index[shard.contig].len,
+                                         vcf_stats[shard.contig])
+            fasta.write(result.fasta)
+            if track is not None:
+                track.write(result.track, result.n_track_records)
+            stats[shard.contig] += result.stats
+            logging.debug(f"{shard.contig}: shard {shard.index} done")
+    if fasta.contig is not None:
+        fasta.end_contig()
+    fasta.close()
+    if track is not None:
+        track.close()
+
+    with open(os.path.join(out_dir, "stats.json"), "w", encoding="utf-8") as f:
+        json.dump({c: dict(s) for c, s in stats.items()}, f, indent=1)
+    return stats
+
+
+if __name__ == "__main__":
+    import argparse
+    from time import perf_counter
+    from config import CONTIGS, FASTA_PATH, FAI_PATH, VCF_PATHS, PACKED_REF_PATHS
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("out_dir")
+    parser.add_argument("--contigs", help="comma separated, default: all of config.CONTIGS")
+    parser.add_argument("--processes", type=int, help="default: # of cores")
+    parser.add_argument("--track", action="store_true", help="also write consensus tracks")
+    parser.add_argument("--log-level", default="ERROR",
+                        help="conflicting calls are logged at WARNING level")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    contigs = args.contigs.split(",") if args.contigs else CONTIGS
+    t0 = perf_counter()
+    stats = export(args.out_dir, FASTA_PATH, FAI_PATH, contigs, VCF_PATHS, PACKED_REF_PATHS,
+                   args.processes, args.track)
+    total = sum(stats.values(), Counter())
+    print(f"{len(contigs)} contigs in {perf_counter() - t0:.1f}s")
+    for key in sorted(total):
+        print(f"{key}: {total[key]}")
@@ -0,0 +1,313 @@
+"""
+Synthetic reference and VCF generator for testing and scaling benchmarks.
+
+Writes a FASTA (+ .fai) with the contigs of config.CONTIGS scaled down
+from their GRCh38 lengths, and one VCF per contig with the cases
+get_consensus_sequence / resolve_calls have to deal with:
+    - N runs (at the contig ends and random gaps) and sporadic IUPAC codes
+    - SNPs (incl. multi-allelic 1/2 calls), insertions, deletions and
+      OTHER (ref and alt longer than one base)
+    - multiple calls at one position (e.g. an SNP and an insertion)
+    - calls starting inside a preceding deletion
+    - haploid genotypes on chrX/chrY/chrM
+    - non-PASS records
+
+Everything is generated in chunks and streamed to disk, so sizes from a few
+KB to several GB work with constant memory use.
+
+Usage: python fixtures.py OUT_DIR [--size 100M] [--contigs chr1,chr2,chrX] [--seed 0]
+"""
+import logging
+import os
+import random
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional, TextIO, Tuple
+
+from config import CONTIGS
+
+GRCH38_LENGTHS = {
+    "chr1": 248956422, "chr2": 242193529, "chr3": 198295559, "chr4": 190214555,
+    "chr5": 181538259, "chr6": 170805979, "chr7": 159345973, "chr8": 145138636,
+    "chr9": 138394717, "chr10": 133797422, "chr11": 135086622, "chr12": 133275309,
+    "chr13": 114364328, "chr14": 107043718, "chr15": 101991189, "chr16": 90338345,
+    "chr17": 83257441, "chr18": 80373285, "chr19": 58617616, "chr20": 64444167,
+    "chr21": 46709983, "chr22": 50818468, "chrX": 156040895, "chrY": 57227415,
+    "chrM": 16569,
+}
+
+MIN_CONTIG_LENGTH = 1000
+
+# bases generated at once (a multiple of the usual line widths)
+CHUNK_SIZE = 60 * 61 * 256
+
+_ACGT = bytes(b"ACGT"[i % 4] for i in range(256))
+IUPAC_CODES = "RYKMSWBDHV"
+
+SNP, INS, DEL, OTHER = range(4)
+
+
+class FixtureSpec(NamedTuple):
+    """
+    line_width: bases per FASTA line
+    variant_rate: variant sites per base
+    type_weights: relative frequency of SNP, INS, DEL and OTHER sites
+    max_indel_len: maximum # of inserted / deleted bases
+    multi_allelic_rate: fraction of SNP sites with two alt alleles (1/2 genotype)
+    multi_call_rate: fraction of sites with 2 (or sometimes 3) calls at the same position
+    overlap_rate: fraction of deletions followed by a call inside the deleted bases
+    non_pass_rate: fraction of records that don't PASS the filter
+    gap_rate: N runs per base (in addition to the contig ends)
+    gap_len: min / max length of a N run
+    iupac_rate: IUPAC codes per base
+    haploid_contigs: contigs with haploid genotypes
+    """
+    line_width: int = 60
+    variant_rate: float = 1 / 1000
+    type_weights: Tuple[float, float, float, float] = (0.8, 0.08, 0.08, 0.04)
+    max_indel_len: int = 10
+    multi_allelic_rate: float = 0.02
+    multi_call_rate: float = 0.01
+    overlap_rate: float = 0.02
+    non_pass_rate: float = 0.05
+    gap_rate: float = 1 / 2000000
+    gap_len: Tuple[int, int] = (100, 50000)
+    iupac_rate: float = 1 / 200000
+    haploid_contigs: Tuple[str, ...] = ("chrX", "chrY", "chrM")
+
+
+class Fixture(NamedTuple):
+    fasta_path: str
+    fai_path: str
+    vcf_paths: Dict[str, str]
+    stats: Counter
+
+
+def parse_size(size: str) -> int:
+    """
+    "5000", "500K", "10M", "3G" -> # of bases
+    """
+    factors = {"K": 10 ** 3, "M": 10 ** 6, "G": 10 ** 9}
+    size = size.strip().upper()
+    if size[-1:] in factors:
+        return int(float(size[:-1]) * factors[size[-1]])
+    return int(size)
+
+
+def scaled_lengths(total: int, contigs: List[str]) -> Dict[str, int]:
+    """
+    Contig lengths proportional to GRCh38, adding up to (about) total
+    """
+    ref_total = sum(GRCH38_LENGTHS.get(c, GRCH38_LENGTHS["chr22"]) for c in contigs)
+    return {c: max(GRCH38_LENGTHS.get(c, GRCH38_LENGTHS["chr22"]) * total // ref_total,
+                   MIN_CONTIG_LENGTH)
+            for c in contigs}
+
+
+def _pl(rng: random.Random, n_alleles: int, gt: Tuple[int, ...]) -> str:
+    if len(gt) == 1:
+        n, best = n_alleles, gt[0]
+    else:
+        n, best = n_alleles * (n_alleles + 1) // 2, gt[1] * (gt[1] + 1) // 2 + gt[0]
+    return ",".join("0" if i == best else str(rng.randint(5, 255)) for i in range(n))
+
+
+class _ContigWriter(object):
+    def __init__(self, contig: str, length: int, spec: FixtureSpec, rng: random.Random):
+        self.contig = contig
+        self.length = length
+        self.spec = spec
+        self.rng = rng
+        self.haploid = contig in spec.haploid_contigs
+        self.stats = Counter()
+
+        self.flank = min(length // 20, 10000)
+        self.gap = (0, self.flank)
+        self.next_iupac = self._next(self.flank, spec.iupac_rate)
+        # 1-based position of the next variant site
+        self.next_site = self._next(self.flank + 1, spec.variant_rate)
+
+    def _next(self, pos: int, rate: float) -> int:
+        if rate <= 0:
+            return self.length + 1
+        return pos + 1 + int(self.rng.expovariate(rate))
+
+    def _random_bases(self, n: int) -> str:
+        return "".join(self.rng.choice("ACGT") for _ in range(n))
+
+    def _fill_gaps(self, seq: bytearray, start: int) -> None:
+        end = start + len(seq)
+        gap_start, gap_end = self.gap
+        while gap_start < end:
+            a, b = max(gap_start, start), min(gap_end, end)
+            if a < b:
+                seq[a - start:b - start] = b"N" * (b - a)
+                self.stats["N bases"] += b - a
+            if gap_end > end:
+                break
+            gap_start = self._next(gap_end, self.spec.gap_rate)
+            gap_end = gap_start + self.rng.randint(*self.spec.gap_len)
+        self.gap = (gap_start, gap_end)
+
+        tail = self.length - self.flank
+        if end > tail:
+            a = max(tail, start)
+            seq[a - start:] = b"N" * (end - a)
+            self.stats["N bases"] += end - a
+
+        while self.next_iupac < end:
+            seq[self.next_iupac - start] = ord(self.rng.choice(IUPAC_CODES))
+            self.stats["IUPAC bases"] += 1
+            self.next_iupac = self._next(self.next_iupac, self.spec.iupac_rate)
+
+    def _call(self, kind: int, ref_seq: str, multi_allelic: bool = False) -> Tuple[str, List[str]]:
+        """
+        ref and alt alleles of a call of the given kind
+        """
+        rng = self.rng
+        ref_base = ref_seq[0]
+        if kind == SNP:
+            others = [b for b in "ACGT" if b != ref_base]
+            alts = rng.sample(others, 2) if multi_allelic else [rng.choice(others)]
+            return ref_base, alts
+        n = rng.randint(1, self.spec.max_indel_len)
+        if kind == INS:
+            return ref_base, [ref_base + self._random_bases(n)]
+        if kind == DEL:
+            return ref_seq[:n + 1], [ref_base]
+        m = rng.randint(1, self.spec.max_indel_len)
+        return ref_seq[:n + 1], [ref_base + self._random_bases(m)]
+
+    def _record(self, pos: int, ref: str, alts: List[str], gt: Tuple[int, ...]) -> str:
+        rng = self.rng
+        if rng.random() < self.spec.non_pass_rate:
+            status = "LowQual"
+            qual = rng.uniform(3, 30)
+            self.stats["non-PASS records"] += 1
+        else:
+            status = "PASS"
+            qual = rng.uniform(30, 250)
+        return (f"{self.contig}\t{pos}\t.\t{ref}\t{','.join(alts)}\t{qual:.2f}\t{status}"
+                f"\tDP={rng.randint(5, 60)}\tGT:PL\t{'/'.join(map(str, gt))}"
+                f":{_pl(rng, len(alts) + 1, gt)}\n")
+
+    def _site(self, pos: int, ref_seq: str) -> Tuple[List[str], int]:
+        """
+        Records of a variant site and the # of reference bases they span
+        """
+        rng = self.rng
+        spec = self.spec
+        kinds = [rng.choices((SNP, INS, DEL, OTHER), spec.type_weights)[0]]
+        if rng.random() < spec.multi_call_rate:
+            n_extra = 2 if rng.random() < 0.1 else 1
+            kinds += [rng.choice((SNP, INS, DEL)) for _ in range(n_extra)]
+            self.stats["multi call sites"] += 1
+
+        records = []
+        ref_len = 1
+        for kind in kinds:
+            multi_allelic = (kind == SNP and len(kinds) == 1 and not self.haploid
+                             and rng.random() < spec.multi_allelic_rate)
+            ref, alts = self._call(kind, ref_seq, multi_allelic)
+            if self.haploid:
+                gt = (1,)
+            elif multi_allelic:
+                gt = (1, 2)
+            else:
+                gt = rng.choice(((0, 1), (0, 1), (1, 1)))
+            records.append(self._record(pos, ref, alts, gt))
+            ref_len = max(ref_len, len(ref))
+            self.stats[("SNP", "INS", "DEL", "OTHER")[kind]] += 1
+        return records, ref_len
+
+    def _sites(self, seq: bytearray, start: int, last_chunk: bool) -> List[str]:
+        max_span = self.spec.max_indel_len + 1
+        end = start + len(seq)
+        records = []
+        while self.next_site - 1 < end:
+            pos = self.next_site
+            if pos - 1 + max_span > end and not last_chunk:
+                # would reach into the next chunk, continue there
+                self.next_site = end + 1
+                break
+            ref_seq = seq[pos - 1 - start:pos - 1 - start + max_span].decode("ascii")
+            if len(ref_seq) < max_span or ref_seq.strip("ACGT"):
+                self.next_site = self._next(pos, self.spec.variant_rate)
+                continue
+            site_records, ref_len = self._site(pos, ref_seq)
+            records += site_records
+            if ref_len > 1 and self.rng.random() < self.spec.overlap_rate:
+                self.next_site = pos + self.rng.randint(1, ref_len - 1)
+                self.stats["overlapping calls"] += 1
+            else:
+                self.next_site = self._next(pos + ref_len - 1, self.spec.variant_rate)
+        return records
+
+    def write(self, fasta: TextIO, vcf: TextIO) -> int:
+        """
+        Writes the contig to fasta and its calls to vcf, returns the offset
+        of the first base in fasta
+        """
+        width = self.spec.line_width
+        fasta.write(f">{self.contig}\n")
+        offset = fasta.tell()
+        for start in range(0, self.length, CHUNK_SIZE):
+            n = min(CHUNK_SIZE, self.length - start)
+            seq = bytearray(self.rng.randbytes(n).translate(_ACGT))
+            self._fill_gaps(seq, start)
+            vcf.writelines(self._sites(seq, start, start + n >= self.length))
+            text = seq.decode("ascii")
+            fasta.writelines([text[i:i + width] + "\n" for i in range(0, n, width)])
+        return offset
+
+
+def generate(out_dir: str, total_size: int, contigs: Optional[List[str]] = None,
+             spec: FixtureSpec = FixtureSpec(), seed: int = 0) -> Fixture:
+    """
+    Writes ref.fa, ref.fa.fai and calls_{contig}.vcf for each contig to out_dir
+    """
+    contigs = contigs or CONTIGS
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    fasta_path = os.path.join(out_dir, "ref.fa")
+    fai_path = fasta_path + ".fai"
+    vcf_paths = {}
+    stats = Counter()
+
+    with open(fasta_path, "w", encoding="ascii", newline="\n") as fasta, \
+            open(fai_path, "w", encoding="ascii", newline="\n") as fai:
+        for contig, length in scaled_lengths(total_size, contigs).items():
+            vcf_paths[contig] = os.path.join(out_dir, f"calls_{contig}.vcf")
+            writer = _ContigWriter(contig, length, spec, rng)
+            with open(vcf_paths[contig], "w", encoding="ascii", newline="\n") as vcf:
+                vcf.write("##fileformat=VCFv4.2\n")
+                vcf.write(f"##contig=<ID={contig},length={length}>\n")
+                vcf.write('##FILTER=<ID=LowQual,Description="Low quality">\n')
+                vcf.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n")
+                offset = writer.write(fasta, vcf)
+            fai.write(f"{contig}\t{length}\t{offset}\t{spec.line_width}\t{spec.line_width + 1}\n")
+            logging.debug(f"{contig}: {length} bases, {dict(writer.stats)}")
+            stats += writer.stats
+            stats["bases"] += length
+
+    return Fixture(fasta_path, fai_path, vcf_paths, stats)
+
+
+if __name__ == "__main__":
+    import argparse
+    from time import perf_counter
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("out_dir")
+    parser.add_argument("--size", default="100M", help="total # of bases, e.g. 500K, 10M, 3G")
+    parser.add_argument("--contigs", help="comma separated, default: all of config.CONTIGS")
+    parser.add_argument("--variant-rate", type=float, default=FixtureSpec().variant_rate)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level="INFO")
+    t0 = perf_counter()
+    fixture = generate(args.out_dir, parse_size(args.size),
+                       args.contigs.split(",") if args.contigs else None,
+                       FixtureSpec(variant_rate=args.variant_rate), args.seed)
+    logging.info(f"Wrote {fixture.fasta_path} and {len(fixture.vcf_paths)} VCFs "
+                 f"in {perf_counter() - t0:.1f}s: {dict(fixture.stats)}")
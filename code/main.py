@@ -1,22 +1,42 @@
-import board
-from rpi_ws281x import ws, Color, PixelStrip
-import busio
-import adafruit_ssd1306
-import gpiozero
-
 from time import sleep, perf_counter
-from typing import Iterator, Any, Tuple, List, Dict
-from itertools import islice
+from typing import Collection, Iterator, Iterable, Any, Tuple, List, Dict, Optional
+from array import array
+from itertools import chain
+from collections import Counter, deque
+import threading
 import random
 import logging
-from subprocess import check_call
+import os
 import queue
 
-from dna import get_consensus_sequence, Locus, Base, RefStatus, read_fai, INVERSE_BASES
-from config import (VCF_PATHS, CONTIGS, FASTA_PATH, FAI_PATH,
+import adafruit_framebuf
+
+from startup import timeline
+from dna import (get_consensus_sequence, get_consensus_block, iterate_variant_tour,
+                 ConsensusBlock, ConsensusBuilder, CompactLocus, Base, RefStatus, VariantType, read_fai,
+                 fai_offset, INVERSE_BASES, BASES_BY_VALUE, REF_STATUS_BY_VALUE)
+from cache import DataCache
+from checkpoint import Checkpoint, Checkpointer, file_stamp, load_checkpoint
+from playlist import RegionStager, read_bed
+from regions import JumpSampler, load_regions
+from backends import Color, create_display, create_strands, create_button
+from config import (BACKEND, BUTTON_PIN,
+                    VCF_PATHS, CONTIGS, FASTA_PATH, FAI_PATH, PACKED_REF_PATHS, TRACK_PATHS,
+                    VARIANT_DENSITY_PATHS, VALID_REGIONS_PATH, JUMP_VARIANT_BIAS,
                     N_LEDS, LED_PIN_1, LED_PIN_2, HOMREF_BRIGHTNESS_FACTOR,
-                    BASES_PER_SECOND, BASES_PER_SECOND_DIFF, JUMP_PROB, N_BASES_DISPLAYED)
-from minimal_disp_replacements import MinimalMemoryFont
+                    LED_GAMMA, LED_BRIGHTNESS,
+                    BASES_PER_SECOND, BASES_PER_SECOND_DIFF, BASES_PER_SECOND_FAST,
+                    FAST_FORWARD_DISTANCE, JUMP_PROB, N_BASES_DISPLAYED,
+                    PREFETCH_QUEUE_SIZE, FRAME_STATS_LOG_INTERVAL, FRAME_STATS_DUMP_PATH,
+                    DATA_CACHE_MAX_BYTES, CHECKPOINT_PATH, CHECKPOINT_INTERVAL,
+                    PLAYLIST_PATH, PLAYLIST_LOOP, PLAYLIST_BUFFER_BYTES, PLAYLIST_MAX_REGION_BASES,
+                    VARIANT_TOUR, VARIANT_TOUR_FLANK, VARIANT_TOUR_TYPES,
+                    VARIANT_TOUR_REF_STATUSES)
+from timing import FrameScheduler, FrameStats
+from output import OutputPipeline
+from minimal_disp_replacements import MinimalMemoryFont, DirtyRegionUpdater, clear
+
+timeline.mark("imports")
 
 
 BASE_COLORS = {
@@ -28,157 +48,810 @@ BASE_COLORS = {
 
 FALLBACK_COLOR = (30, 30, 30)
 
+# timed parts of each frame
+# (i2c / leds are sent in the output thread, latency is from the end of render to the end of leds)
+FRAME_STAGES = ("fetch", "render", "i2c", "leds", "latency", "slack")
+
 
 class Screen(object):
-    def __init__(self):
-        i2c = busio.I2C(board.SCL, board.SDA, frequency=800000)
-        self.display: adafruit_ssd1306.SSD1306_I2C = adafruit_ssd1306.SSD1306_I2C(
-            128, 64, i2c)
-        self.display.rotation = 2
+    def __init__(self, display):
+        self.display = display
 
         # replace the font class with a less complicated faster one
         self.display._font = MinimalMemoryFont()
+        # only send the changed part of the frame
+        self.updater = DirtyRegionUpdater(self.display)
+
+    def update_screen(self, window: "LociWindow") -> None:
+        self.render(window)
+        self.show()
+
+    def new_framebuffer(self) -> adafruit_framebuf.FrameBuffer:
+        """
+        Offscreen framebuffer with the size, rotation and font of the display
+        """
+        framebuffer = adafruit_framebuf.FrameBuffer(
+            bytearray(len(self.display.buf)), self.display.width, self.display.height,
+            adafruit_framebuf.MVLSB)
+        framebuffer.rotation = self.display.rotation
+        framebuffer._font = self.display._font
+        return framebuffer
+
+    def load(self, framebuffer: adafruit_framebuf.FrameBuffer) -> None:
+        """
+        Copies an offscreen framebuffer into the display buffer
+        """
+        self.display.buf[:] = framebuffer.buf
+
+    def render(self, window: "LociWindow", framebuffer=None) -> None:
+        """
+        Draws window into framebuffer (default the display buffer)
+        """
+        fb = self.display if framebuffer is None else framebuffer
+        first = window.first()
+        clear(fb)
+        fb.text("{}: {}".format(
+            first.contig, first.pos), 0, 0, 1)
+        fb.text("_" * N_LEDS, 0, 10, 1)
+        fb.text(window.text(), 0, 20, 1)
+        fb.text(window.ref_text(), 0, 30, 1)
 
-    def update_screen(self, loci: List[Locus]) -> None:
-        self.display.fill(0)
-        self.display.text("{}: {}".format(
-            loci[0].contig, loci[0].pos), 0, 0, 1)
-        self.display.text("_" * N_LEDS, 0, 10, 1)
-        self.display.text("".join(str(l.bases[1]) for l in loci), 0, 20, 1)
-        self.display.text("".join(" " if l.ref_base == l.bases[1]
-                                  else str(l.ref_base) for l in loci), 0, 30, 1)
-        self._show()
+    def draw_message(self, message: str, framebuffer=None) -> None:
+        fb = self.display if framebuffer is None else framebuffer
+        clear(fb)
+        fb.text(message, 10, 15, 1)
 
     def show_message(self, message: str) -> None:
-        self.display.fill(0)
-        self.display.text(message, 10, 15, 1)
-        self._show()
+        self.draw_message(message)
+        self.show()
 
-    def _show(self) -> None:
+    def show(self) -> None:
         # When the button is pressed this also pulls down the I2C clock line
         # as this is the only pin that can wake the Pi up from halt.
         # This shouldn't matter, as when the button is pressed we shut down anyway.
         try:
-            self.display.show()
+            self.updater.show()
         except OSError:
             logging.warning("Display comm error. Button pressed?")
 
 
+def tour_settings() -> Dict[str, Any]:
+    """
+    DNAIterator arguments for the variant tour settings in config.py
+    """
+    if not VARIANT_TOUR:
+        return {}
+    return {"tour_flank": VARIANT_TOUR_FLANK,
+            "tour_types": (None if VARIANT_TOUR_TYPES is None
+                           else {VariantType[t] for t in VARIANT_TOUR_TYPES}),
+            "tour_ref_statuses": (None if VARIANT_TOUR_REF_STATUSES is None
+                                  else {RefStatus[s] for s in VARIANT_TOUR_REF_STATUSES})}
+
+
 class DNAIterator(object):
-    def __init__(self, ref_path: str, contigs: List[str], vcf_paths: Dict[str, str], fai_path: str):
+    def __init__(self, ref_path: str, contigs: List[str], vcf_paths: Dict[str, str], fai_path: str,
+                 packed_ref_paths: Dict[str, str] = None, track_paths: Dict[str, str] = None,
+                 valid_regions_path: str = None, variant_bias: float = 0.0,
+                 cache_max_bytes: int = DATA_CACHE_MAX_BYTES, load_in_background: bool = False,
+                 density_paths: Dict[str, str] = None, tour_flank: Optional[int] = None,
+                 tour_types: Optional[Collection[VariantType]] = None,
+                 tour_ref_statuses: Optional[Collection[RefStatus]] = None):
+        """
+        load_in_background: load the valid regions and the file indexes in a background thread.
+                            Until the regions are loaded jump targets are drawn with retries.
+        tour_flank: variant tour mode, iterate_loci only yields the (filtered) variants with
+                    tour_flank reference bases on both sides (see dna.iterate_variant_tour)
+        """
         self.fai_index = read_fai(fai_path, vcf_paths.keys())
         self.contigs = contigs
         self.ref_path = ref_path
         self.vcf_paths = vcf_paths
+        # keeps the files open and recently read chunks cached across jumps
+        self.cache = DataCache(ref_path, vcf_paths, self.fai_index, packed_ref_paths, track_paths,
+                               cache_max_bytes, density_paths)
+        # jump targets and jump decisions, its state is saved in the checkpoint
+        self.rng = random.Random()
+        self.tour_flank = tour_flank
+        self.tour_types = tour_types
+        self.tour_ref_statuses = tour_ref_statuses
+        self.tour_stats: Counter = Counter()
+        self.sampler: Optional[JumpSampler] = None
+        if load_in_background:
+            self.loader = threading.Thread(target=self._load_indexes, name="index loader",
+                                           args=(valid_regions_path, variant_bias), daemon=True)
+            self.loader.start()
+        else:
+            self.sampler = self._load_sampler(valid_regions_path, variant_bias)
+
+    def _load_indexes(self, valid_regions_path: Optional[str], variant_bias: float) -> None:
+        try:
+            with timeline.stage("valid regions"):
+                self.sampler = self._load_sampler(valid_regions_path, variant_bias)
+            with timeline.stage("file indexes"):
+                for contig in self.contigs:
+                    self.cache.preload(contig)
+        except Exception:
+            logging.exception("Error loading the indexes")
+
+    def _load_sampler(self, valid_regions_path: Optional[str],
+                      variant_bias: float) -> Optional[JumpSampler]:
+        if valid_regions_path is None or not os.path.exists(valid_regions_path):
+            logging.info("No valid regions index, jump targets are drawn with retries")
+            return None
+        regions = load_regions(valid_regions_path)
+        for contig, r in list(regions.items()):
+            fai_line = self.fai_index.get(contig)
+            if fai_line is not None and fai_line.len != r.len:
+                logging.warning(f"Valid regions of {contig} don't match the reference, ignoring them")
+                del regions[contig]
+        return JumpSampler(regions, self.contigs, variant_bias, self.rng)
 
-    def iterate_loci(self, contig: str, start_pos: int) -> Iterator[Locus]:
-        with open(self.ref_path, mode="r", encoding="utf-8") as ref_file:
+    def iterate_loci(self, contig: str, start_pos: int,
+                     vcf_offset: Optional[int] = None) -> Iterator[CompactLocus]:
+        """
+        Loci from start_pos, only the variant tour in tour mode (see iterate_tour),
+        else the full consensus (see iterate_consensus)
+        """
+        if self.tour_flank is not None:
+            for block in self.iterate_tour(contig, start_pos, vcf_offset):
+                yield from block.compact_loci()
+            return
+        yield from self.iterate_consensus(contig, start_pos, vcf_offset)
+
+    def iterate_consensus(self, contig: str, start_pos: int,
+                          vcf_offset: Optional[int] = None) -> Iterator[CompactLocus]:
+        """
+        Full consensus from start_pos, also in tour mode
+        start_pos: 0-based
+        vcf_offset: DataCache.vcf_offset(contig, start_pos + 1) if known, i.e. the offset of
+                    the first VCF record at or after start_pos
+        """
+        track = self.cache.track(contig)
+        if track is not None:
             logging.info(
-                "starting iteration from {}:{}".format(contig, start_pos))
-            consensus_it = get_consensus_sequence(
-                self.vcf_paths[contig], ref_file, self.fai_index[contig], start_pos)
-            yield from consensus_it
+                "starting iteration from {}:{} (consensus track)".format(contig, start_pos))
+            yield from track.iterate_from(start_pos, compact=True)
+            return
+
+        logging.info(
+            "starting iteration from {}:{}".format(contig, start_pos))
+        yield from get_consensus_sequence(
+            self.vcf_paths[contig], None, self.fai_index[contig], start_pos,
+            reference=self.cache.reference(contig),
+            variants=self.cache.iterate_variants(contig, start_pos + 1, vcf_offset), compact=True)
+
+    def iterate_tour(self, contig: str, start_pos: int,
+                     vcf_offset: Optional[int] = None) -> Iterator[ConsensusBlock]:
+        """
+        Blocks of the variant tour from start_pos (one per variant or group of close ones),
+        read from the VCF and reference even if there is a consensus track. Only the flanks
+        are read from the reference, without the chunk cache.
+        """
+        logging.info(f"starting variant tour from {contig}:{start_pos}")
+        yield from iterate_variant_tour(
+            self.cache.direct_reference(contig),
+            self.cache.iterate_variants(contig, start_pos + 1, vcf_offset),
+            self.tour_flank, start_pos, self.tour_types, self.tour_ref_statuses,
+            self.tour_stats)
+
+    def get_consensus_block(self, contig: str, start_pos: int, n: int) -> Optional[ConsensusBlock]:
+        """
+        Loci for (about) n reference bases from start_pos as parallel arrays
+        """
+        return get_consensus_block(self.vcf_paths[contig], None, self.fai_index[contig],
+                                   start_pos, n, reference=self.cache.reference(contig),
+                                   variants=self.cache.iterate_variants(contig, start_pos + 1))
+
+    def consensus_builder(self, contig: str, start_pos: int) -> ConsensusBuilder:
+        """
+        Consensus blocks from start_pos, builder.i is where the blocks built so far end
+        (always between clusters of calls, so iterate_consensus can continue there)
+        """
+        return ConsensusBuilder(self.cache.reference(contig),
+                                self.cache.iterate_variants(contig, start_pos + 1), start_pos)
+
+    def close(self) -> None:
+        self.cache.close()
+
+    def random_target(self) -> Tuple[str, int]:
+        """
+        Random (contig, 0-based position) to jump to, the first locus there is a valid base
+        """
+        if self.sampler is not None:
+            # the sampler only returns valid bases, no need to redraw
+            return self.sampler.sample()
 
-    def iterate_from_random(self, redraw_invalid_start: bool = True) -> Iterator[Locus]:
-        contig = random.choice(self.contigs)
+        contig = self.rng.choice(self.contigs)
         while True:
-            start_pos = random.randint(0, self.fai_index[contig].len)
-            l_it = self.iterate_loci(contig, start_pos)
-            first_base = next(l_it)
-            if not first_base.bases[1] in (Base.A, Base.G, Base.T, Base.C):
+            start_pos = self.rng.randrange(self.fai_index[contig].len)
+            first_base = next(self.iterate_loci(contig, start_pos), None)
+            if first_base is not None and first_base.b2 in VALID_BASE_VALUES:
+                return contig, start_pos
+
+    def iterate_from_random(self) -> Iterator[CompactLocus]:
+        yield from self.iterate_loci(*self.random_target())
+
+    def checkpoint(self, contig: str, pos: int,
+                   next_target: Optional[Tuple[str, int]]) -> Checkpoint:
+        """
+        Checkpoint for resuming playback at pos (0-based), see checkpoint.py
+        """
+        return Checkpoint(contig, pos, self.cache.vcf_offset(contig, pos + 1),
+                          file_stamp(self.vcf_paths[contig]),
+                          fai_offset(self.fai_index[contig], pos), next_target,
+                          self.rng.getstate())
+
+    def _valid_target(self, target: Optional[Tuple[str, int]]) -> bool:
+        return (target is not None and target[0] in self.contigs
+                and 0 <= target[1] < self.fai_index[target[0]].len)
+
+    def restore(self, checkpoint: Checkpoint) -> Optional[Checkpoint]:
+        """
+        Checks that checkpoint matches the data and restores the RNG state.
+        Returns the checkpoint to resume from (vcf_offset None if the VCF changed),
+        None if it can't be used.
+        """
+        contig, pos = checkpoint.contig, checkpoint.pos
+        if (not self._valid_target((contig, pos))
+                or fai_offset(self.fai_index[contig], pos) != checkpoint.ref_offset):
+            logging.warning(f"Checkpoint {contig}:{pos} doesn't match the reference, ignoring it")
+            return None
+        if file_stamp(self.vcf_paths[contig]) != checkpoint.vcf_stamp:
+            logging.info(f"{self.vcf_paths[contig]} changed since the checkpoint, searching it")
+            checkpoint = checkpoint._replace(vcf_offset=None)
+        if not self._valid_target(checkpoint.next_target):
+            checkpoint = checkpoint._replace(next_target=None)
+        try:
+            self.rng.setstate(checkpoint.rng_state)
+        except (TypeError, ValueError):
+            logging.warning("Invalid RNG state in the checkpoint, not restoring it")
+        return checkpoint
+
+
+# queue marker for the end of a segment (i.e. jump to a new location)
+JUMP = object()
+
+# pause after each segment that didn't show a frame (growing up to 1s with
+# consecutive ones), so segments without loci don't spin on jumps
+EMPTY_SEGMENT_BACKOFF = 0.01
+
+
+class LociPrefetcher(object):
+    """
+    Runs the DNAIterator in a background thread, filling a bounded queue of loci.
+
+    The jumps (with probability jump_prob after each base) are decided here,
+    and the next jump target is already resolved (file opened, VCF searched,
+    first locus read) while the current segment is playing, so jumps don't stall.
+
+    The worker only touches the data files, never the display or LEDs.
+
+    resume: checkpoint to start from (see DNAIterator.restore) instead of a random location
+    playlist: play its regions in order instead (one segment per region),
+              continuing with random jumps at the end if it doesn't loop
+    """
+    def __init__(self, dna_iterator: DNAIterator, jump_prob: float, max_size: int,
+                 resume: Optional[Checkpoint] = None, playlist: Optional[RegionStager] = None):
+        self.dna_iterator = dna_iterator
+        self.jump_prob = jump_prob
+        self.resume = resume
+        self.playlist = playlist
+        # targets of the segments after the one being consumed and the ones in the queue
+        self._upcoming: deque = deque()
+        self.queue: queue.Queue = queue.Queue(maxsize=max_size)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="prefetch", daemon=True)
+
+        self.n_produced = 0
+        self.n_stalls = 0
+        self.stall_time = 0.0
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self.playlist is not None:
+            self.playlist.stop()
+        self._thread.join(timeout=1)
+
+    def _put(self, item: Any) -> bool:
+        while not self._stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
                 continue
-            yield first_base
-            yield from l_it
+        return False
+
+    def _resolve_jump(self, contig: str, start_pos: int,
+                      vcf_offset: Optional[int] = None) -> Iterator[CompactLocus]:
+        l_it = self.dna_iterator.iterate_loci(contig, start_pos, vcf_offset)
+        first = next(l_it)
+        return chain([first], l_it)
+
+    def _run(self) -> None:
+        try:
+            if self.playlist is not None:
+                if not self._run_playlist():
+                    return
+                logging.info("End of the playlist, continuing with random jumps")
+                self.resume = None
+            self._run_random()
+        except Exception as e:
+            logging.exception("Error in prefetch thread")
+            self._put(e)
+
+    def _run_playlist(self) -> bool:
+        """
+        Returns False if stopped before the end of the playlist
+        """
+        self.playlist.start()
+        first = True
+        while not self._stop_event.is_set():
+            staged = self.playlist.get()
+            if staged is None:
+                # stop() also ends the stager, don't mistake that for the end of the playlist
+                return not self._stop_event.is_set()
+            logging.info(f"Playing {staged.region}")
+            for l in self.playlist.iterate(staged):
+                if not self._put(l):
+                    return False
+                if first:
+                    timeline.mark("first locus")
+                    first = False
+                self.n_produced += 1
+            if not self._put(JUMP):
+                return False
+        return False
+
+    def _run_random(self) -> None:
+        rng = self.dna_iterator.rng
+        if self.resume is not None:
+            logging.info(f"Resuming from checkpoint {self.resume.contig}:{self.resume.pos}")
+            segment = self._resolve_jump(self.resume.contig, self.resume.pos,
+                                         self.resume.vcf_offset)
+            target = self.resume.next_target or self.dna_iterator.random_target()
+        else:
+            segment = self._resolve_jump(*self.dna_iterator.random_target())
+            target = self.dna_iterator.random_target()
+        timeline.mark("first locus")
+        while not self._stop_event.is_set():
+            self._upcoming.append(target)
+            next_segment = self._resolve_jump(*target)
+            for l in segment:
+                if not self._put(l):
+                    return
+                self.n_produced += 1
+                if rng.random() < self.jump_prob:
+                    break
+            if not self._put(JUMP):
+                return
+            segment = next_segment
+            target = self.dna_iterator.random_target()
+
+    def get(self) -> Any:
+        """
+        The next locus or JUMP
+        """
+        try:
+            item = self.queue.get_nowait()
+        except queue.Empty:
+            t0 = perf_counter()
+            item = self.queue.get()
+            self.n_stalls += 1
+            self.stall_time += perf_counter() - t0
+        if isinstance(item, Exception):
+            raise item
+        return item
 
+    def iterate_segment(self) -> Iterator[CompactLocus]:
+        """
+        Loci until the next jump
+        """
+        while True:
+            item = self.get()
+            if item is JUMP:
+                if self._upcoming:
+                    self._upcoming.popleft()
+                return
+            yield item
 
-def locus_to_colors(l: Locus) -> Tuple[Color, Color]:
-    b = l.bases[1]
-    c1 = BASE_COLORS.get(b, FALLBACK_COLOR)
-    c2 = BASE_COLORS.get(INVERSE_BASES.get(b, None), FALLBACK_COLOR)
+    def upcoming_target(self) -> Optional[Tuple[str, int]]:
+        """
+        (contig, 0-based position) the segment after the one being consumed starts at
+        """
+        try:
+            return self._upcoming[0]
+        except IndexError:
+            return None
 
-    if l.ref_status == RefStatus.hom_ref:
-        c1 = tuple(int(x * HOMREF_BRIGHTNESS_FACTOR) for x in c1)
-        c2 = tuple(int(x * HOMREF_BRIGHTNESS_FACTOR) for x in c2)
-    return (Color(*c1), Color(*c2))
+    def metrics(self) -> Dict[str, float]:
+        """
+        queue_depth: loci waiting in the queue
+        n_stalls / stall_time: how often / how long the consumer had to wait
+                               for the producer (i.e. producer lag)
+        """
+        return {"queue_depth": self.queue.qsize(), "n_produced": self.n_produced,
+                "n_stalls": self.n_stalls, "stall_time": self.stall_time}
 
 
-def iterate_sliding(source_it: Iterator[Any], n: int) -> Iterator[List[Any]]:
+def _channel_table(gamma: float, brightness: float) -> List[int]:
     """
-    Iterates through source_it returning a sliding window of n outputs
+    Maps 0-255 channel values to brightness scaled, gamma corrected values
     """
-    res = list(islice(source_it, n))
-    yield res
-    for e in source_it:
-        res = res[1:] + [e]
-        yield res
+    return [int(round(255 * (x * brightness / 255) ** gamma)) for x in range(256)]
+
+
+def build_color_table(strand: int) -> List[int]:
+    """
+    Packed colours of one strand (0: bases, 1: complementary bases)
+    for every (Base value, RefStatus value), indexed by base * len(RefStatus) + ref_status.
+    """
+    channel = _channel_table(LED_GAMMA[strand], LED_BRIGHTNESS[strand])
+    table = []
+    for b in BASES_BY_VALUE:
+        if strand == 1:
+            b = INVERSE_BASES.get(b, None)
+        c = BASE_COLORS.get(b, FALLBACK_COLOR)
+        for rs in REF_STATUS_BY_VALUE:
+            if rs == RefStatus.hom_ref:
+                rs_c = tuple(int(x * HOMREF_BRIGHTNESS_FACTOR) for x in c)
+            else:
+                rs_c = c
+            table.append(Color(*(channel[x] for x in rs_c)))
+    return table
+
+
+COLOR_TABLES = (build_color_table(0), build_color_table(1))
+N_REF_STATUS = len(REF_STATUS_BY_VALUE)
+
+
+# display characters by Base value
+BASE_CHARS = bytes(ord(str(b)) for b in BASES_BY_VALUE)
+VALID_BASE_VALUES = frozenset(b.value for b in (Base.A, Base.G, Base.T, Base.C))
+
+
+def locus_to_colors(l: CompactLocus) -> Tuple[int, int]:
+    i = l.b2 * N_REF_STATUS + l.rs
+    return COLOR_TABLES[0][i], COLOR_TABLES[1][i]
+
+
+class StrandWriter(object):
+    """
+    Writes all colours of a strand at once, only setting the LEDs that changed
+    and skipping show() if nothing changed.
+    """
+    def __init__(self, strand: Any, n_leds: int):
+        self.strand = strand
+        self.last: List[Optional[int]] = [None] * n_leds
+
+    def write(self, colors: Iterable[int]) -> bool:
+        changed = False
+        last = self.last
+        for i, c in enumerate(colors):
+            if last[i] != c:
+                self.strand.setPixelColor(i, c)
+                last[i] = c
+                changed = True
+        if changed:
+            self.strand.show()
+        return changed
+
+
+class LociWindow(object):
+    """
+    Fixed size sliding window over loci, backed by ring buffers.
+
+    Every slot is stored twice (at i and i + n), so the current window is
+    always a contiguous slice and can be returned as a view without copying.
+    The LED colours and display characters are computed once when a locus
+    enters the window.
+    """
+    def __init__(self, n: int):
+        self.n = n
+        self.start = 0
+        self.size = 0
+        self.loci: List[Optional[CompactLocus]] = [None] * n
+        self._colors1 = array("L", [0]) * (2 * n)
+        self._colors2 = array("L", [0]) * (2 * n)
+        self._ref_status = bytearray(2 * n)
+        self._chars = bytearray(b" " * (2 * n))
+        self._ref_chars = bytearray(b" " * (2 * n))
+
+    def push(self, l: CompactLocus) -> None:
+        """
+        Adds a locus at the end of the window, dropping the first one if the window is full
+        """
+        if self.size < self.n:
+            i = self.size
+            self.size += 1
+        else:
+            i = self.start
+            self.start = (self.start + 1) % self.n
+        c1, c2 = locus_to_colors(l)
+        b = l.b2
+        char = BASE_CHARS[b]
+        ref_char = 32 if l.rb == b else BASE_CHARS[l.rb]  # space if same
+        self.loci[i] = l
+        for j in (i, i + self.n):
+            self._colors1[j] = c1
+            self._colors2[j] = c2
+            self._ref_status[j] = l.rs
+            self._chars[j] = char
+            self._ref_chars[j] = ref_char
+
+    @property
+    def full(self) -> bool:
+        return self.size == self.n
+
+    def first(self) -> CompactLocus:
+        return self.loci[self.start]
+
+    def _view(self, buffer, length: int) -> memoryview:
+        return memoryview(buffer)[self.start:self.start + min(length, self.size)]
+
+    def colors(self, length: int) -> Tuple[memoryview, memoryview]:
+        """
+        LED colours of both strands for the first length loci
+        """
+        return self._view(self._colors1, length), self._view(self._colors2, length)
+
+    def ref_status(self, length: int) -> memoryview:
+        return self._view(self._ref_status, length)
+
+    def text(self) -> str:
+        return self._view(self._chars, self.n).tobytes().decode("ascii")
+
+    def ref_text(self) -> str:
+        """
+        Reference bases where they differ from the displayed ones, spaces elsewhere
+        """
+        return self._view(self._ref_chars, self.n).tobytes().decode("ascii")
+
+
+def iterate_sliding(source_it: Iterator[CompactLocus], n: int) -> Iterator[LociWindow]:
+    """
+    Iterates through source_it returning a sliding window of n loci.
+    The same LociWindow is updated in place and yielded each time.
+    """
+    window = LociWindow(n)
+    for l in source_it:
+        window.push(l)
+        if window.full:
+            yield window
+    if not window.full and window.size > 0:
+        yield window
+
+
+class PlaybackPacer(object):
+    """
+    Chooses the frame period and the # of loci to advance per frame from the
+    distance to the next variant in the density map (see density.py),
+    so the window doesn't have to be scanned every frame:
+        a variant on the LEDs: BASES_PER_SECOND_DIFF
+        at least fast_forward_distance bases before the next variant: several loci
+            per frame at BASES_PER_SECOND frames/s, bases_per_second_fast in total,
+            slowing down fast_forward_distance bases before the variant
+        otherwise: BASES_PER_SECOND
+    Contigs without a density map fall back to scanning the LED part of the window,
+    as does everything if use_density is False (e.g. the variant tour, where the loci
+    in the window aren't consecutive bases).
+    """
+    def __init__(self, cache: DataCache, fast_forward_distance: int = FAST_FORWARD_DISTANCE,
+                 bases_per_second_fast: float = BASES_PER_SECOND_FAST, use_density: bool = True):
+        self.cache = cache
+        self.use_density = use_density
+        self.fast_forward_distance = max(fast_forward_distance, N_LEDS)
+        self.max_steps = max(int(bases_per_second_fast / BASES_PER_SECOND), 1)
+        self._contig: Optional[str] = None
+        self._density = None
+        self.n_fast_forward = 0
+
+    def pace(self, window: LociWindow) -> Tuple[float, int]:
+        """
+        (frame period, # of loci to advance) for the current window
+        """
+        first = window.first()
+        if first.contig != self._contig:
+            self._contig = first.contig
+            self._density = self.cache.density(first.contig) if self.use_density else None
+        if self._density is None:
+            if any(window.ref_status(N_LEDS)):
+                return 1 / BASES_PER_SECOND_DIFF, 1
+            return 1 / BASES_PER_SECOND, 1
+
+        distance = self._density.distance(first.pos - 1)
+        if distance < N_LEDS:
+            return 1 / BASES_PER_SECOND_DIFF, 1
+        if distance >= self.fast_forward_distance and self.max_steps > 1:
+            self.n_fast_forward += 1
+            return 1 / BASES_PER_SECOND, min(self.max_steps,
+                                             distance - self.fast_forward_distance + 1)
+        return 1 / BASES_PER_SECOND, 1
 
 
 class DNASculpture(object):
-    def __init__(self):
-        self.init_leds()
-        self.display = Screen()
-        self.button = gpiozero.Button(4, bounce_time=0.05)
-        self.button.when_released = self.shutdown
+    def __init__(self, backend: str = BACKEND, simulate_timing: bool = True):
+        self.backend = backend
+        self.simulate_timing = simulate_timing
+        # the display first, so there is something to see as early as possible
+        with timeline.stage("display"):
+            self.display = Screen(create_display(backend, simulate_timing))
+        self.display.show_message("Loading DNA data...")
+        timeline.mark("loading message")
+        with timeline.stage("leds"):
+            self.init_leds()
+        # from here on the display and LEDs are only used by the output thread
+        self.output = OutputPipeline(self.display, self.writer1, self.writer2)
+        self.output.start()
+        self.button = None
+        self.checkpointer: Optional[Checkpointer] = None
         self.running = False
 
-    def init_leds(self) -> None:
-        self.strand1 = PixelStrip(N_LEDS, LED_PIN_1)
-        self.strand2 = PixelStrip(N_LEDS, LED_PIN_2, channel=1)
+    def init_button(self) -> None:
+        with timeline.stage("button"):
+            button = create_button(self.backend, BUTTON_PIN)
+        button.when_released = self.shutdown
+        self.button = button
 
-        self.strand1.begin()
-        self.strand2.begin()
+    def init_leds(self) -> None:
+        self.strand1, self.strand2 = create_strands(
+            self.backend, N_LEDS, LED_PIN_1, LED_PIN_2, self.simulate_timing)
+        self.writer1 = StrandWriter(self.strand1, N_LEDS)
+        self.writer2 = StrandWriter(self.strand2, N_LEDS)
 
     def shutdown(self) -> None:
         self.running = False
         logging.info("Shutting down")
+        if self.checkpointer is not None:
+            self.checkpointer.write()
+        if self.backend != "pi":
+            return
+        from subprocess import check_call
         sleep(1)
         check_call(['sudo', 'poweroff'])
         sleep(10)
 
-    def run(self) -> None:
-        self.display.show_message("Loading DNA data...")
-        dna_iterator = DNAIterator(FASTA_PATH, CONTIGS, VCF_PATHS, FAI_PATH)
+    def output_frame(self, seq: LociWindow, stats: FrameStats, block: bool = False) -> float:
+        """
+        Renders seq and hands it to the output thread for the display and the LEDs,
+        returns the time it finished (the transfer is timed in the output thread).
+        block: wait for the output thread instead of dropping a frame it didn't get to
+        """
+        t1 = perf_counter()
+        self.display.render(seq, self.output.back_buffer())
+        colors1, colors2 = seq.colors(N_LEDS)
+        t2 = perf_counter()
+        self.output.submit(colors1, colors2, stats, block)
+        stats.record("render", t2 - t1)
+        return perf_counter()
+
+    def show_message(self, message: str) -> None:
+        self.display.draw_message(message, self.output.back_buffer())
+        self.output.submit()
+
+    def first_frame_shown(self) -> None:
+        self.output.flush()
+        timeline.mark("first frame")
+        timeline.log()
+        # the button is only needed to shut down, no need to wait for gpiozero before that
+        threading.Thread(target=self.init_button, name="button", daemon=True).start()
+
+    def run(self, dna_iterator: Optional[DNAIterator] = None,
+            max_frames: Optional[int] = None,
+            checkpoint_path: Optional[str] = CHECKPOINT_PATH,
+            playlist_path: Optional[str] = PLAYLIST_PATH) -> None:
+        """
+        dna_iterator: default is the data in config.py, with the indexes loaded in the background
+        max_frames: stop after this many frames (for benchmarks), default is to run forever
+        checkpoint_path: resume from / periodically save the playback position there (None: don't)
+        playlist_path: BED file of regions to play in order (see playlist.py), the checkpoint
+                       isn't resumed from then
+        """
+        if dna_iterator is None:
+            with timeline.stage("dna iterator"):
+                dna_iterator = DNAIterator(FASTA_PATH, CONTIGS, VCF_PATHS, FAI_PATH,
+                                           PACKED_REF_PATHS, TRACK_PATHS,
+                                           VALID_REGIONS_PATH, JUMP_VARIANT_BIAS,
+                                           load_in_background=True,
+                                           density_paths=VARIANT_DENSITY_PATHS,
+                                           **tour_settings())
+
+        checkpoint = None
+        if checkpoint_path is not None:
+            checkpoint = load_checkpoint(checkpoint_path)
+            if checkpoint is not None:
+                checkpoint = dna_iterator.restore(checkpoint)
+            self.checkpointer = Checkpointer(checkpoint_path, dna_iterator.checkpoint,
+                                             CHECKPOINT_INTERVAL)
+            self.checkpointer.start()
+
+        playlist = None
+        if playlist_path is not None:
+            regions = read_bed(playlist_path, dna_iterator.fai_index)
+            if regions:
+                logging.info(f"Playing {len(regions)} regions of {playlist_path}")
+                playlist = RegionStager(dna_iterator, regions, PLAYLIST_BUFFER_BYTES,
+                                        PLAYLIST_MAX_REGION_BASES, PLAYLIST_LOOP)
+                checkpoint = None
+            else:
+                logging.warning(f"No regions in {playlist_path}, jumping to random locations")
+
+        prefetcher = LociPrefetcher(dna_iterator, JUMP_PROB, PREFETCH_QUEUE_SIZE, checkpoint,
+                                    playlist)
+        prefetcher.start()
+
+        scheduler = FrameScheduler()
+        pacer = PlaybackPacer(dna_iterator.cache, use_density=dna_iterator.tour_flank is None)
+        stats = FrameStats(FRAME_STAGES, FRAME_STATS_LOG_INTERVAL, FRAME_STATS_DUMP_PATH)
 
         self.running = True
+        n_empty = 0
         while True:
-            random_iter = dna_iterator.iterate_from_random(redraw_invalid_start=True)
-            t0 = perf_counter()
-            for seq in iterate_sliding(random_iter, N_BASES_DISPLAYED):
+            windows = iterate_sliding(prefetcher.iterate_segment(), N_BASES_DISPLAYED)
+            scheduler.reset()
+            skip = 0
+            segment_frames = stats.n_frames
+            while True:
+                t0 = perf_counter()
+                for _ in range(skip):
+                    next(windows, None)
+                seq = next(windows, None)
+                if seq is None:
+                    break
+                t1 = perf_counter()
+
                 if not self.running:
+                    prefetcher.stop()
                     # This can't be in shutdown because the rpi_ws281x library is
                     # not threadsafe (causes segmentation fault).
-                    for i in range(N_LEDS):
-                        self.strand1.setPixelColor(i, Color(0, 0, 0))
-                        self.strand2.setPixelColor(i, Color(0, 0, 0))
-                    self.strand1.show()
-                    self.strand2.show()
+                    self.display.draw_message("", self.output.back_buffer())
+                    self.output.submit([Color(0, 0, 0)] * N_LEDS, [Color(0, 0, 0)] * N_LEDS)
+                    self.output.stop()
                     
                     while True:
                         # I2C is broken while the button is pressed
                         # hopefully it's released before we shut down...
                         self.display.show_message("")
 
-                self.display.update_screen(seq)
-                for i, l in enumerate(seq[:N_LEDS]):
-                    c1, c2 = locus_to_colors(l)
-                    self.strand1.setPixelColor(i, c1)
-                    self.strand2.setPixelColor(i, c2)
-                self.strand1.show()
-                self.strand2.show()
+                stats.record("fetch", t1 - t0)
+                t4 = self.output_frame(seq, stats)
+                if stats.n_frames == 0:
+                    self.first_frame_shown()
 
-                t1 = perf_counter()
-                tdiff = t1 - t0
-                if all(l.ref_status == RefStatus.hom_ref for l in seq[:N_LEDS]):
-                    if tdiff > 1 / BASES_PER_SECOND:
-                        logging.warning(f"Took {tdiff}s / base!")
-                    sleep(max(1 / BASES_PER_SECOND - tdiff, 0))
-                else:
-                    sleep(max(1 / BASES_PER_SECOND_DIFF - tdiff, 0))
-                t0 = perf_counter()
-                if random.random() < JUMP_PROB:
-                    logging.info("Jumping to new location")
-                    self.display.show_message("Jumping to new location...")
-                    break
+                if self.checkpointer is not None:
+                    first = seq.first()
+                    self.checkpointer.update(first.contig, first.pos - 1,
+                                             prefetcher.upcoming_target())
+                period, steps = pacer.pace(seq)
+                skip = steps - 1
+                tdiff = t4 - t0
+                if tdiff > period:
+                    logging.warning(f"Took {tdiff}s / base!")
+                slack = scheduler.wait(period)
+                stats.record("slack", max(slack, 0))
+                stats.end_frame(overrun=slack < 0)
+                if max_frames is not None and stats.n_frames >= max_frames:
+                    prefetcher.stop()
+                    self.output.flush()
+                    if self.checkpointer is not None:
+                        self.checkpointer.stop()
+                    return
+
+            if stats.n_frames == segment_frames:
+                n_empty += 1
+                if n_empty % 100 == 1:
+                    logging.warning(f"{n_empty} segment(s) in a row without loci")
+                sleep(min(EMPTY_SEGMENT_BACKOFF * n_empty, 1.0))
+                continue
+            n_empty = 0
+
+            logging.info("Jumping to new location, prefetch: {}, cache: {}, output: {}".format(
+                prefetcher.metrics(), dna_iterator.cache.stats(), self.output.metrics()))
+            if playlist is not None:
+                logging.info(f"Playlist staging: {playlist.metrics()}")
+            self.show_message("Jumping to new location...")
 
 
 if __name__ == "__main__":
@@ -1,6 +1,11 @@
 import os
 import struct
 
+import adafruit_framebuf
+
+SET_COL_ADDR = 0x21
+SET_PAGE_ADDR = 0x22
+
 class MinimalMemoryFont(object):
     """
     Replacement for Adafruit_CircuitPython_framebuf.Bitmapfont
@@ -24,10 +29,17 @@ class MinimalMemoryFont(object):
         except OSError:
             print("Could not find font file", font_name)
             raise
+        # columns flipped vertically, for drawing rotated by 180 degrees
+        self.reversed_font_data = [int("{:08b}".format(line)[::-1], 2)
+                                   for line in self.font_data]
     
     def draw_char(self, char, x, y, framebuffer, color, size=1): # pylint: disable=too-many-arguments
         """Draw one character at position (x,y) to a framebuffer in a given color"""
-        # TODO: Don't need to do this pixel by pixel...
+        if (size == 1 and color and framebuffer.rotation in (0, 2)
+                and isinstance(framebuffer.format, adafruit_framebuf.MVLSBFormat)):
+            self._blit_char(char, x, y, framebuffer)
+            return
+
         # Go through each column of the character.
         for char_x in range(self.font_width):
             # Grab the byte for the current column of font data.
@@ -38,7 +50,104 @@ class MinimalMemoryFont(object):
                 # Draw a pixel for each bit that's flipped on.
                 if (line >> char_y) & 0x1:
                     framebuffer.pixel(x + char_x, y + char_y, color)
-    
+
+    def _blit_char(self, char, x, y, framebuffer):
+        """
+        OR the column bytes of the character directly into the page organized
+        (MVLSB) buffer of the framebuffer. Only for rotation 0 and 2 (180 degrees),
+        where columns stay columns.
+        """
+        width, height, stride = framebuffer.width, framebuffer.height, framebuffer.stride
+        buf = framebuffer.buf
+        offset = ord(char) * self.font_width
+        if framebuffer.rotation == 2:
+            columns = self.reversed_font_data[offset:offset + self.font_width]
+            xs = range(width - 1 - x, width - 1 - x - self.font_width, -1)
+            top = height - y - self.font_height
+        else:
+            columns = self.font_data[offset:offset + self.font_width]
+            xs = range(x, x + self.font_width)
+            top = y
+        page, shift = divmod(top, 8)
+
+        for col_x, line in zip(xs, columns):
+            if not line or col_x < 0 or col_x >= width:
+                continue
+            line <<= shift
+            if 0 <= page and page * 8 < height:
+                buf[page * stride + col_x] |= line & 0xff
+            if shift and 0 <= page + 1 and (page + 1) * 8 < height:
+                buf[(page + 1) * stride + col_x] |= line >> 8
+
     def width(self, text):
         """Return the pixel width of the specified text message."""
-        return len(text) * (self.font_width + 1)
\ No newline at end of file
+        return len(text) * (self.font_width + 1)
+
+
+def clear(framebuffer):
+    """Faster replacement for framebuffer.fill(0)"""
+    framebuffer.buf[:] = bytes(len(framebuffer.buf))
+
+
+class DirtyRegionUpdater(object):
+    """
+    Replacement for SSD1306_I2C.show() that only sends the changed part
+    of the buffer.
+
+    Keeps a copy of the last frame sent, and for each run of consecutive
+    changed pages sends the range of columns that changed.
+    """
+    def __init__(self, display):
+        self.display = display
+        self.pages = display.height // 8
+        self._shadow = None
+
+    def show(self):
+        # only in newer adafruit_ssd1306 releases
+        if getattr(self.display, "page_addressing", False):
+            self.display.show()
+            return
+
+        buf = self.display.buf
+        width = self.display.width
+        if self._shadow is None:
+            regions = [(0, self.pages - 1, 0, width - 1)]
+        else:
+            regions = self._dirty_regions(buf, width)
+
+        # narrow displays use centered columns
+        col_offset = (128 - width) // 2 if width != 128 else 0
+        try:
+            for page0, page1, col0, col1 in regions:
+                data = b"".join(bytes(buf[p * width + col0:p * width + col1 + 1])
+                                for p in range(page0, page1 + 1))
+                for cmd in (SET_COL_ADDR, col0 + col_offset, col1 + col_offset,
+                            SET_PAGE_ADDR, page0, page1):
+                    self.display.write_cmd(cmd)
+                with self.display.i2c_device:
+                    self.display.i2c_device.write(b"\x40" + data)
+        except OSError:
+            # we don't know what the display shows now, resend everything next time
+            self._shadow = None
+            raise
+        self._shadow = bytes(buf)
+
+    def _dirty_regions(self, buf, width):
+        """
+        (first page, last page, first column, last column) of each run of changed pages
+        """
+        regions = []
+        for p in range(self.pages):
+            new = bytes(buf[p * width:(p + 1) * width])
+            old = self._shadow[p * width:(p + 1) * width]
+            if new == old:
+                continue
+            diff = int.from_bytes(new, "little") ^ int.from_bytes(old, "little")
+            col0 = ((diff & -diff).bit_length() - 1) // 8
+            col1 = (diff.bit_length() - 1) // 8
+            if regions and regions[-1][1] == p - 1:
+                page0, _, prev_col0, prev_col1 = regions[-1]
+                regions[-1] = (page0, p, min(col0, prev_col0), max(col1, prev_col1))
+            else:
+                regions.append((p, p, col0, col1))
+        return regions
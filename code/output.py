@@ -0,0 +1,145 @@
+"""
+Double buffered output stage: the render loop composes frame N+1 while an
+I/O thread sends frame N to the display (I2C) and the two LED strands.
+
+Once the pipeline is started the I/O thread owns the display and both strands,
+so all rpi_ws281x calls come from one thread. Frames are composed into two
+offscreen framebuffers used in turn, the I/O thread copies the newest one into
+the display buffer before sending it.
+
+Drop policy: only the newest frame waits for the I/O thread. If the transfer
+falls behind, a frame that is still waiting when the next one is submitted is
+dropped (counted in FrameStats.n_dropped), so the output is never more than one
+frame behind and a frame takes max(render, transfer) instead of their sum.
+"""
+import logging
+import threading
+from array import array
+from time import perf_counter
+from typing import Any, Dict, Iterable, Optional
+
+from timing import FrameStats
+
+
+class Frame(object):
+    __slots__ = ("framebuffer", "colors1", "colors2", "stats", "submitted")
+
+    def __init__(self, framebuffer: Any, colors1: Optional[array], colors2: Optional[array],
+                 stats: Optional[FrameStats]):
+        self.framebuffer = framebuffer
+        self.colors1 = colors1
+        self.colors2 = colors2
+        self.stats = stats
+        self.submitted = perf_counter()
+
+
+class OutputPipeline(object):
+    """
+    screen: main.Screen (the display), writer1 / writer2: main.StrandWriter of each strand
+
+    Frames with stats record the i2c / leds transfer times and the latency
+    from submit to the end of the transfer there.
+    """
+    def __init__(self, screen: Any, writer1: Any, writer2: Any):
+        self.screen = screen
+        self.writers = (writer1, writer2)
+        self.framebuffers = [screen.new_framebuffer() for _ in range(2)]
+        self._back = 0
+        self._pending: Optional[Frame] = None
+        self._busy = False
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="output", daemon=True)
+
+        self.n_submitted = 0
+        self.n_shown = 0
+        self.n_dropped = 0
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Sends the waiting frame and stops the I/O thread,
+        the display and strands can be used directly again afterwards
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join(timeout=1)
+
+    def back_buffer(self) -> Any:
+        """
+        The framebuffer to compose the next frame in
+        """
+        return self.framebuffers[self._back]
+
+    def submit(self, colors1: Optional[Iterable[int]] = None,
+               colors2: Optional[Iterable[int]] = None,
+               stats: Optional[FrameStats] = None, block: bool = False) -> None:
+        """
+        Queues the back buffer and the LED colours (copied, None leaves the LEDs as they are)
+        for output and switches to the other framebuffer.
+        block: wait for the I/O thread to take the waiting frame instead of dropping it
+        """
+        frame = Frame(self.framebuffers[self._back],
+                      None if colors1 is None else array("L", colors1),
+                      None if colors2 is None else array("L", colors2), stats)
+        with self._cond:
+            while block and self._pending is not None and self._thread.is_alive():
+                self._cond.wait(0.1)
+            if self._pending is not None:
+                self.n_dropped += 1
+                if self._pending.stats is not None:
+                    self._pending.stats.drop_frame()
+            self._pending = frame
+            self.n_submitted += 1
+            self._cond.notify_all()
+        # the other framebuffer was either dropped or already copied by the I/O thread
+        self._back ^= 1
+
+    def flush(self) -> None:
+        """
+        Waits until the submitted frames are shown
+        """
+        with self._cond:
+            while (self._pending is not None or self._busy) and self._thread.is_alive():
+                self._cond.wait(0.1)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while self._pending is None and not self._stopping:
+                    self._cond.wait()
+                frame = self._pending
+                if frame is None:
+                    return
+                self._pending = None
+                self._busy = True
+                # under the lock, so the render loop can't reuse the framebuffer yet
+                self.screen.load(frame.framebuffer)
+            try:
+                self._send(frame)
+            except Exception:
+                logging.exception("Error in output thread")
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    def _send(self, frame: Frame) -> None:
+        t0 = perf_counter()
+        self.screen.show()
+        t1 = perf_counter()
+        if frame.colors1 is not None:
+            self.writers[0].write(frame.colors1)
+        if frame.colors2 is not None:
+            self.writers[1].write(frame.colors2)
+        t2 = perf_counter()
+        self.n_shown += 1
+        if frame.stats is not None:
+            frame.stats.record("i2c", t1 - t0)
+            frame.stats.record("leds", t2 - t1)
+            frame.stats.record("latency", t2 - frame.submitted)
+
+    def metrics(self) -> Dict[str, int]:
+        return {"submitted": self.n_submitted, "shown": self.n_shown, "dropped": self.n_dropped}
@@ -0,0 +1,214 @@
+"""
+Compact 2-bit per base storage of the reference contigs.
+
+Each contig is stored in its own file:
+    header: magic, # of bases, # of exception runs
+    exception table: starts, ends (both uint64) and Base values (uint8)
+        of runs of non A/C/G/T bases (N-runs, IUPAC codes)
+    packed bases: 4 bases per byte, first base in the high bits,
+        exception positions are stored as A
+
+Positions are 0-based, as in the fai geometry.
+"""
+import logging
+import mmap
+import re
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+from typing import BinaryIO, Iterator, List, Tuple
+
+from dna import Base, BASES_BY_VALUE, FaiLine, base_to_enum
+
+MAGIC = b"DNA2BIT1"
+HEADER = struct.Struct("<8sQQ")
+
+PACKED_CODES = (Base.A, Base.C, Base.G, Base.T)
+BASE_TO_PACKED = {b: i for i, b in enumerate(PACKED_CODES)}
+
+# Base values of all 4 bases encoded by each possible byte
+DECODE_CODES = [bytes(PACKED_CODES[(byte >> shift) & 0b11].value for shift in (6, 4, 2, 0))
+                for byte in range(256)]
+
+# translates fasta characters to 2-bit codes, everything else to 0xff
+_CHAR_TO_CODE = bytearray(b"\xff" * 256)
+for _c, _b in base_to_enum.items():
+    if _b in BASE_TO_PACKED:
+        _CHAR_TO_CODE[ord(_c)] = BASE_TO_PACKED[_b]
+_CHAR_TO_CODE = bytes(_CHAR_TO_CODE)
+
+# maps 4 2-bit codes (one per byte of a little endian uint32) to the packed byte
+_WORD_TO_BYTE = {c0 | c1 << 8 | c2 << 16 | c3 << 24: c0 << 6 | c1 << 4 | c2 << 2 | c3
+                 for c0 in range(4) for c1 in range(4)
+                 for c2 in range(4) for c3 in range(4)}
+
+# runs of identical non A/C/G/T characters
+_RUN_RE = re.compile(rb"([^ACGT])\1*")
+
+CHUNK_LINES = 1 << 14
+
+
+def _read_contig_chunks(ref_file: BinaryIO, fai_line: FaiLine) -> Iterator[bytes]:
+    """
+    Reads the bases of a contig in large chunks, with newlines removed.
+    """
+    ref_file.seek(fai_line.start)
+    remaining = fai_line.len
+    while remaining > 0:
+        n_lines = min(CHUNK_LINES, -(-remaining // fai_line.bapl))
+        chunk = ref_file.read(n_lines * fai_line.bypl).translate(None, b"\r\n")
+        if not chunk:
+            break
+        chunk = chunk[:remaining]
+        if b">" in chunk:
+            chunk = chunk[:chunk.index(b">")]
+            logging.warning(
+                f"{fai_line.contig}:{fai_line.len - remaining + len(chunk)} Contig ended prematurely, "
+                f"expected {fai_line.len} bases.")
+            yield chunk
+            return
+        remaining -= len(chunk)
+        yield chunk
+
+
+def convert_contig(ref_file: BinaryIO, fai_line: FaiLine, out_file: BinaryIO) -> None:
+    """
+    Writes the contig described by fai_line in 2-bit packed format to out_file
+    """
+    contig = fai_line.contig
+    exc_starts = array("Q")
+    exc_ends = array("Q")
+    exc_bases = bytearray()
+    packed = bytearray()
+
+    pos = 0
+    carry = b""
+    for chunk in _read_contig_chunks(ref_file, fai_line):
+        codes = chunk.translate(_CHAR_TO_CODE)
+        if b"\xff" in codes:
+            for m in _RUN_RE.finditer(chunk):
+                run_start, run_end = pos + m.start(), pos + m.end()
+                base = base_to_enum.get(m.group(1).decode("ascii"))
+                if base is None:
+                    logging.error(f"{contig}:{run_start} Invalid char {m.group(1)} in fasta, storing N")
+                    base = Base.N
+                if exc_ends and exc_ends[-1] == run_start and exc_bases[-1] == base.value:
+                    exc_ends[-1] = run_end
+                else:
+                    exc_starts.append(run_start)
+                    exc_ends.append(run_end)
+                    exc_bases.append(base.value)
+            codes = codes.replace(b"\xff", b"\x00")
+        pos += len(chunk)
+
+        codes = carry + codes
+        n_full = len(codes) - len(codes) % 4
+        carry = codes[n_full:]
+        words = array("I")
+        words.frombytes(codes[:n_full])
+        if sys.byteorder == "big":
+            words.byteswap()
+        packed.extend(map(_WORD_TO_BYTE.__getitem__, words))
+
+    if carry:
+        carry = carry + b"\x00" * (4 - len(carry))
+        packed.append(_WORD_TO_BYTE[int.from_bytes(carry, "little")])
+
+    if pos != fai_line.len:
+        logging.warning(f"{contig}: expected {fai_line.len} bases, got {pos}.")
+
+    out_file.write(HEADER.pack(MAGIC, pos, len(exc_starts)))
+    out_file.write(exc_starts.tobytes())
+    out_file.write(exc_ends.tobytes())
+    out_file.write(exc_bases)
+    out_file.write(packed)
+
+
+class PackedContig(object):
+    """
+    Memory mapped reader for a contig in 2-bit packed format.
+    """
+    def __init__(self, filename: str, contig: str):
+        self.filename = filename
+        self.contig = contig
+        self._file = open(filename, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.len, n_exc = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{filename} is not a packed reference file")
+
+        offset = HEADER.size
+        self._exc_starts = array("Q", self._mmap[offset:offset + 8 * n_exc])
+        offset += 8 * n_exc
+        self._exc_ends = array("Q", self._mmap[offset:offset + 8 * n_exc])
+        offset += 8 * n_exc
+        self._exc_bases = [Base(b) for b in self._mmap[offset:offset + n_exc]]
+        self._data_offset = offset + n_exc
+
+    def close(self) -> None:
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self) -> "PackedContig":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def get_codes(self, start: int, end: int) -> bytes:
+        """
+        Base values of the bases in [start, end) (0-based) as bytes
+        """
+        start = max(start, 0)
+        end = min(end, self.len)
+        if start >= end:
+            return b""
+
+        first_byte = start // 4
+        data = self._mmap[self._data_offset + first_byte:
+                          self._data_offset + (end + 3) // 4]
+        skip = start - first_byte * 4
+        codes = bytearray(b"".join(map(DECODE_CODES.__getitem__, data))[skip:skip + end - start])
+
+        # overwrite N-runs/IUPAC codes
+        i = max(bisect_right(self._exc_starts, start) - 1, 0)
+        while i < len(self._exc_starts) and self._exc_starts[i] < end:
+            run_start = max(self._exc_starts[i], start)
+            run_end = min(self._exc_ends[i], end)
+            if run_start < run_end:
+                codes[run_start - start:run_end - start] = (
+                    bytes([self._exc_bases[i].value]) * (run_end - run_start))
+            i += 1
+        return bytes(codes)
+
+    def get_bases(self, start: int, end: int) -> List[Base]:
+        """
+        Returns the bases in [start, end) (0-based)
+        """
+        return [BASES_BY_VALUE[c] for c in self.get_codes(start, end)]
+
+    def iterate_from(self, start_pos: int = 0, chunk_size: int = 4096) -> Iterator[Tuple[int, Base]]:
+        """
+        Same output as dna.iterate_ref, i.e. (1-based position, base)
+        """
+        i = start_pos
+        while i < self.len:
+            for b in self.get_bases(i, i + chunk_size):
+                i += 1
+                yield i, b
+
+
+if __name__ == "__main__":
+    from config import CONTIGS, FASTA_PATH, FAI_PATH, PACKED_REF_PATHS
+    from bgzf import open_file
+    from dna import read_fai
+
+    logging.basicConfig(level="INFO")
+    fai_index = read_fai(FAI_PATH, CONTIGS)
+    with open_file(FASTA_PATH) as ref_file:
+        for contig in CONTIGS:
+            logging.info(f"Packing {contig} to {PACKED_REF_PATHS[contig]}")
+            with open(PACKED_REF_PATHS[contig], "wb") as out_file:
+                convert_contig(ref_file, fai_index[contig], out_file)
@@ -0,0 +1,249 @@
+"""
+Playlist mode: play the regions of a BED file (e.g. chosen genes) in order
+instead of jumping to random locations.
+
+The consensus loci of the upcoming regions are staged into memory buffers
+(dna.ConsensusBlock) by a background thread, as many regions ahead as fit in
+the memory budget, so switching to the next region doesn't wait for the files.
+Only the first max_region_bases of long regions are staged, the rest is read
+while the region plays. Regions are played as the full consensus, also in the
+variant tour mode (VARIANT_TOUR).
+
+BED format: contig, start (0-based), end (exclusive) and an optional name,
+tab or space separated; "#", "track" and "browser" lines are skipped.
+
+`python playlist.py BED_FILE` stages every region once and reports the staging
+times and buffer sizes, e.g. for choosing PLAYLIST_BUFFER_BYTES.
+"""
+import logging
+import threading
+from bisect import bisect_right
+from collections import deque
+from time import perf_counter
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+from dna import CompactLocus, ConsensusBlock, FaiLine
+from timing import Histogram
+
+
+class Region(NamedTuple):
+    contig: str
+    start: int  # 0-based
+    end: int  # exclusive
+    name: str
+
+    def __str__(self) -> str:
+        return f"{self.name} ({self.contig}:{self.start + 1}-{self.end})"
+
+
+class StagedRegion(NamedTuple):
+    region: Region
+    block: ConsensusBlock  # loci of region.start to staged_end
+    staged_end: int  # 0-based position after the staged bases
+    staging_time: float
+
+    def nbytes(self) -> int:
+        # plus the python objects of the block
+        return len(self.block.pos) * (self.block.pos.itemsize + 4) + 512
+
+
+def read_bed(path: str, fai_index: Dict[str, FaiLine]) -> List[Region]:
+    """
+    Regions of the BED file at path in file order. Regions on contigs that aren't
+    in fai_index are skipped, ends are clipped to the contig length.
+    """
+    regions = []
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            cols = line.split()
+            if not cols or cols[0].startswith("#") or cols[0] in ("track", "browser"):
+                continue
+            try:
+                contig, start, end = cols[0], int(cols[1]), int(cols[2])
+            except (IndexError, ValueError):
+                logging.warning(f"{path}:{line_no} Invalid BED line, skipping it")
+                continue
+            fai_line = fai_index.get(contig)
+            if fai_line is None:
+                logging.warning(f"{path}:{line_no} Unknown contig {contig}, skipping it")
+                continue
+            end = min(end, fai_line.len)
+            if not 0 <= start < end:
+                logging.warning(f"{path}:{line_no} Empty region, skipping it")
+                continue
+            name = cols[3] if len(cols) > 3 else f"{contig}:{start + 1}-{end}"
+            regions.append(Region(contig, start, end, name))
+    return regions
+
+
+def stage_region(dna_iterator, region: Region, max_bases: int) -> StagedRegion:
+    """
+    Builds the loci of (about) the first max_bases of region (see
+    main.DNAIterator.consensus_builder). The staged part ends between clusters of
+    calls, so a deletion across it isn't cut when the rest is read.
+    """
+    t0 = perf_counter()
+    builder = dna_iterator.consensus_builder(region.contig, region.start)
+    block = builder.next_block(min(max_bases, region.end - region.start))
+    # a cluster at the end of the block can reach beyond the region
+    n = bisect_right(block.pos, region.end)
+    if n < len(block.pos):
+        block = ConsensusBlock(region.contig, block.pos[:n], block.bases1[:n], block.bases2[:n],
+                               block.ref_status[:n], block.ref_base[:n])
+    return StagedRegion(region, block, builder.i, perf_counter() - t0)
+
+
+class RegionStager(object):
+    """
+    Stages the regions of a playlist in a background thread, in order (repeated if loop),
+    keeping at most max_bytes of staged loci (but always the next region).
+
+    get() returns the next staged region, iterate() its loci including the unstaged rest.
+    """
+    def __init__(self, dna_iterator, regions: List[Region], max_bytes: int,
+                 max_region_bases: int, loop: bool = True):
+        if not regions:
+            raise ValueError("Empty playlist")
+        self.dna_iterator = dna_iterator
+        self.regions = regions
+        self.max_bytes = max_bytes
+        self.max_region_bases = max_region_bases
+        self.loop = loop
+
+        self._staged: deque = deque()
+        self.nbytes = 0
+        self._done = False
+        self._error: Optional[Exception] = None
+        self._cond = threading.Condition()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stager", daemon=True)
+
+        self.n_staged = 0
+        self.n_stalls = 0
+        self.stall_time = 0.0
+        self.staging_times = Histogram(0.0005, 2000)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        with self._cond:
+            self._cond.notify_all()
+        self._thread.join(timeout=1)
+
+    def _run(self) -> None:
+        try:
+            while not self._stop_event.is_set():
+                n_staged = 0
+                for region in self.regions:
+                    if self._stop_event.is_set():
+                        return
+                    with self._cond:
+                        while self._staged and self.nbytes >= self.max_bytes:
+                            if self._stop_event.is_set():
+                                return
+                            self._cond.wait()
+                    staged = stage_region(self.dna_iterator, region, self.max_region_bases)
+                    if self._stop_event.is_set():
+                        return
+                    if not staged.block.pos:
+                        logging.warning(f"No loci in {region}, skipping it")
+                        continue
+                    n_staged += 1
+                    nbytes = staged.nbytes()
+                    logging.debug(f"Staged {region}: {len(staged.block.pos)} loci, "
+                                  f"{nbytes / 1024:.0f}KB in {1000 * staged.staging_time:.1f}ms")
+                    with self._cond:
+                        self._staged.append(staged)
+                        self.nbytes += nbytes
+                        self.n_staged += 1
+                        self.staging_times.add(staged.staging_time)
+                        self._cond.notify_all()
+                if not self.loop:
+                    break
+                if n_staged == 0:
+                    logging.error("No loci in any region of the playlist")
+                    break
+        except Exception as e:
+            logging.exception("Error in stager thread")
+            self._error = e
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    def get(self) -> Optional[StagedRegion]:
+        """
+        The next staged region, None at the end of the playlist
+        """
+        with self._cond:
+            if not self._staged and not self._done:
+                t0 = perf_counter()
+                while not self._staged and not self._done:
+                    self._cond.wait()
+                self.n_stalls += 1
+                self.stall_time += perf_counter() - t0
+            if not self._staged:
+                if self._error is not None:
+                    raise self._error
+                return None
+            staged = self._staged.popleft()
+            self.nbytes -= staged.nbytes()
+            self._cond.notify_all()
+            return staged
+
+    def iterate(self, staged: StagedRegion) -> Iterator[CompactLocus]:
+        """
+        Loci of a staged region, the part after staged_end is read from the files
+        """
+        yield from staged.block.compact_loci()
+        region = staged.region
+        if staged.staged_end < region.end:
+            for l in self.dna_iterator.iterate_consensus(region.contig, staged.staged_end):
+                if l.pos > region.end:
+                    return
+                yield l
+
+    def metrics(self) -> Dict[str, float]:
+        """
+        staging time per region, how often / how long get() had to wait for staging,
+        and the staged regions / bytes waiting
+        """
+        h = self.staging_times
+        return {"n_staged": self.n_staged,
+                "staging_mean": h.total / h.count if h.count else 0.0,
+                "staging_p95": h.percentile(95), "staging_max": h.max,
+                "n_stalls": self.n_stalls, "stall_time": self.stall_time,
+                "buffered_regions": len(self._staged), "buffered_bytes": self.nbytes}
+
+
+if __name__ == "__main__":
+    import argparse
+    from config import (CONTIGS, FASTA_PATH, FAI_PATH, VCF_PATHS, PACKED_REF_PATHS, TRACK_PATHS,
+                        PLAYLIST_MAX_REGION_BASES)
+    from main import DNAIterator
+
+    parser = argparse.ArgumentParser(description="Staging times and buffer sizes of a playlist")
+    parser.add_argument("bed_path")
+    args = parser.parse_args()
+
+    logging.basicConfig(level="WARNING")
+    dna_iterator = DNAIterator(FASTA_PATH, CONTIGS, VCF_PATHS, FAI_PATH, PACKED_REF_PATHS,
+                               TRACK_PATHS)
+    regions = read_bed(args.bed_path, dna_iterator.fai_index)
+    times = Histogram(0.0005, 2000)
+    sizes = []
+    for region in regions:
+        staged = stage_region(dna_iterator, region, PLAYLIST_MAX_REGION_BASES)
+        times.add(staged.staging_time)
+        sizes.append(staged.nbytes())
+    dna_iterator.close()
+    if not regions:
+        raise SystemExit("No regions")
+    sizes.sort()
+    print(f"{len(regions)} regions, staging time: mean {1000 * times.total / times.count:.1f}ms "
+          f"p95 {1000 * times.percentile(95):.1f}ms max {1000 * times.max:.1f}ms")
+    print(f"staged size: mean {sum(sizes) / len(sizes) / 1024:.1f}KB "
+          f"p95 {sizes[int(0.95 * (len(sizes) - 1))] / 1024:.1f}KB "
+          f"max {sizes[-1] / 1024:.1f}KB, total {sum(sizes) / 1024 / 1024:.1f}MB")
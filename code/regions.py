@@ -0,0 +1,186 @@
+"""
+Index of the valid (A/C/G/T) intervals of each contig and a sampler
+for jump targets inside them.
+
+Intervals are split into pieces of at most MAX_INTERVAL_LEN bases and
+store the # of PASS variants they contain, so jumps can be biased towards
+variant dense regions.
+
+File format ("valid regions" file, built with `python regions.py`):
+    header: magic, # of contigs
+    per contig: name length (uint16), name, contig length, # of intervals,
+                starts, ends (0-based, end exclusive), # of variants (uint64 arrays)
+"""
+import logging
+import os
+import random
+import re
+import struct
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
+from typing import BinaryIO, Dict, Iterable, NamedTuple, Tuple
+
+MAGIC = b"DNAREG01"
+HEADER = struct.Struct("<8sI")
+CONTIG_HEADER = struct.Struct("<QQ")
+
+MAX_INTERVAL_LEN = 1 << 16
+SCAN_CHUNK_SIZE = 1 << 22
+
+# runs of A/C/T/G Base values
+_VALID_RUN = re.compile(rb"[\x01-\x04]+")
+
+
+class ContigRegions(NamedTuple):
+    contig: str
+    len: int
+    starts: array
+    ends: array
+    n_variants: array
+
+
+def find_valid_intervals(reference, max_len: int = MAX_INTERVAL_LEN) -> Tuple[array, array]:
+    """
+    Valid intervals of reference (anything with get_codes(start, end) and len),
+    split into pieces of at most max_len bases
+    """
+    starts = array("Q")
+    ends = array("Q")
+    for chunk_start in range(0, reference.len, SCAN_CHUNK_SIZE):
+        codes = reference.get_codes(chunk_start, chunk_start + SCAN_CHUNK_SIZE)
+        for m in _VALID_RUN.finditer(codes):
+            start, end = chunk_start + m.start(), chunk_start + m.end()
+            if ends and ends[-1] == start and ends[-1] - starts[-1] < max_len:
+                # continues a run from the previous chunk
+                start = starts.pop()
+                ends.pop()
+            for piece_start in range(start, end, max_len):
+                starts.append(piece_start)
+                ends.append(min(piece_start + max_len, end))
+    return starts, ends
+
+
+def count_variants(starts: array, ends: array, positions: Iterable[int]) -> array:
+    """
+    # of positions (1-based) in each interval
+    """
+    counts = array("Q", [0]) * len(starts)
+    for pos in positions:
+        i = bisect_right(starts, pos - 1) - 1
+        if i >= 0 and pos - 1 < ends[i]:
+            counts[i] += 1
+    return counts
+
+
+def save_regions(filename: str, regions: Dict[str, ContigRegions]) -> None:
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(regions)))
+        for r in regions.values():
+            name = r.contig.encode("utf-8")
+            f.write(struct.pack("<H", len(name)) + name)
+            f.write(CONTIG_HEADER.pack(r.len, len(r.starts)))
+            r.starts.tofile(f)
+            r.ends.tofile(f)
+            r.n_variants.tofile(f)
+    os.replace(tmp_filename, filename)
+
+
+def _read_array(f: BinaryIO, n: int) -> array:
+    a = array("Q")
+    a.fromfile(f, n)
+    return a
+
+
+def load_regions(filename: str) -> Dict[str, ContigRegions]:
+    regions = {}
+    with open(filename, "rb") as f:
+        magic, n_contigs = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{filename} is not a valid regions file")
+        for _ in range(n_contigs):
+            name_len = struct.unpack("<H", f.read(2))[0]
+            contig = f.read(name_len).decode("utf-8")
+            length, n = CONTIG_HEADER.unpack(f.read(CONTIG_HEADER.size))
+            regions[contig] = ContigRegions(contig, length, _read_array(f, n),
+                                            _read_array(f, n), _read_array(f, n))
+    return regions
+
+
+class JumpSampler(object):
+    """
+    Draws jump targets uniformly over the valid bases of all contigs
+    (so longer contigs are chosen more often), with one random draw and
+    a binary search over the cumulative interval weights.
+
+    variant_bias: 0 weights intervals by length only, 1 by their # of variants only,
+                  values in between mix the two distributions.
+    """
+    def __init__(self, regions: Dict[str, ContigRegions], contigs: Iterable[str],
+                 variant_bias: float = 0.0, rng: random.Random = None):
+        self.rng = rng or random.Random()
+        self.contigs = []
+        contig_i = array("H")
+        self.starts = array("Q")
+        self.lengths = array("Q")
+        n_variants = array("Q")
+        for contig in contigs:
+            r = regions.get(contig)
+            if r is None:
+                logging.warning(f"No valid regions for {contig}, it won't be jumped to")
+                continue
+            contig_i.extend([len(self.contigs)] * len(r.starts))
+            self.contigs.append(contig)
+            self.starts.extend(r.starts)
+            self.lengths.extend(e - s for s, e in zip(r.starts, r.ends))
+            n_variants.extend(r.n_variants)
+        if not self.starts:
+            raise ValueError("No valid regions to jump to")
+        self.contig_i = contig_i
+
+        total_len = sum(self.lengths)
+        total_variants = sum(n_variants)
+        if total_variants == 0:
+            variant_bias = 0.0
+        weights = [(1 - variant_bias) * l / total_len
+                   + (variant_bias * v / total_variants if variant_bias else 0.0)
+                   for l, v in zip(self.lengths, n_variants)]
+        self.cum_weights = list(accumulate(weights))
+
+    def sample(self) -> Tuple[str, int]:
+        """
+        Random (contig, 0-based position) of a valid base
+        """
+        r = self.rng.random() * self.cum_weights[-1]
+        i = min(bisect_right(self.cum_weights, r), len(self.cum_weights) - 1)
+        # reuse the draw for the position inside the interval
+        lower = self.cum_weights[i - 1] if i > 0 else 0.0
+        frac = (r - lower) / (self.cum_weights[i] - lower) if self.cum_weights[i] > lower else 0.0
+        offset = min(int(frac * self.lengths[i]), self.lengths[i] - 1)
+        return self.contigs[self.contig_i[i]], self.starts[i] + offset
+
+
+if __name__ == "__main__":
+    from bgzf import open_file
+    from config import CONTIGS, FASTA_PATH, FAI_PATH, VCF_PATHS, PACKED_REF_PATHS, VALID_REGIONS_PATH
+    from dna import FastaContig, read_fai
+    from packed_ref import PackedContig
+    from vcf_bulk import read_columns
+
+    logging.basicConfig(level="INFO")
+    fai_index = read_fai(FAI_PATH, CONTIGS)
+    regions = {}
+    with open_file(FASTA_PATH) as ref_file:
+        for contig in CONTIGS:
+            packed_path = PACKED_REF_PATHS[contig]
+            if os.path.exists(packed_path):
+                with PackedContig(packed_path, contig) as packed:
+                    starts, ends = find_valid_intervals(packed)
+            else:
+                starts, ends = find_valid_intervals(FastaContig(ref_file, fai_index[contig]))
+            n_variants = count_variants(starts, ends, read_columns(VCF_PATHS[contig], contig).pos)
+            regions[contig] = ContigRegions(contig, fai_index[contig].len, starts, ends, n_variants)
+            logging.info(f"{contig}: {sum(e - s for s, e in zip(starts, ends))} valid bases "
+                         f"in {len(starts)} intervals, {sum(n_variants)} variants")
+    save_regions(VALID_REGIONS_PATH, regions)
@@ -0,0 +1,84 @@
+"""
+Startup timeline, i.e. where the time from process start to the first frame goes.
+
+Times are seconds since the process started, read from /proc on Linux so the
+interpreter startup is included (elsewhere they start at the import of this module).
+Stages (e.g. the import of a hardware library) also record their duration.
+The timeline is logged in one line once the first frame is shown.
+"""
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from importlib import import_module
+from time import perf_counter
+from types import ModuleType
+from typing import Iterator, List, NamedTuple, Optional
+
+
+def _process_age() -> float:
+    """
+    Seconds since the process started, 0 if unknown
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # the process name can contain spaces, starttime is the 20th field after it
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(uptime - start_ticks / os.sysconf("SC_CLK_TCK"), 0.0)
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+class Event(NamedTuple):
+    name: str
+    time: float  # since process start
+    duration: Optional[float]
+
+
+class StartupTimeline(object):
+    def __init__(self):
+        self.t0 = perf_counter() - _process_age()
+        self.events: List[Event] = []
+        self._lock = threading.Lock()
+        self.mark("interpreter")
+
+    def elapsed(self) -> float:
+        return perf_counter() - self.t0
+
+    def _add(self, event: Event) -> None:
+        with self._lock:
+            self.events.append(event)
+
+    def mark(self, name: str) -> None:
+        self._add(Event(name, self.elapsed(), None))
+
+    def get(self, name: str) -> Optional[Event]:
+        with self._lock:
+            return next((e for e in self.events if e.name == name), None)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        t0 = perf_counter()
+        yield
+        self._add(Event(name, self.elapsed(), perf_counter() - t0))
+
+    def import_module(self, name: str) -> ModuleType:
+        """
+        Imports a module, recording how long it took
+        """
+        with self.stage(f"import {name}"):
+            return import_module(name)
+
+    def summary(self) -> str:
+        with self._lock:
+            events = sorted(self.events, key=lambda e: e.time)
+        return ", ".join(f"{e.name} {e.time:.3f}s" if e.duration is None else
+                         f"{e.name} {e.time:.3f}s ({e.duration:.3f}s)" for e in events)
+
+    def log(self) -> None:
+        logging.info(f"Startup timeline: {self.summary()}")
+
+
+timeline = StartupTimeline()
@@ -0,0 +1,138 @@
+"""
+Frame scheduling and per stage timing statistics for the render loop.
+"""
+import json
+import logging
+import os
+from array import array
+from time import perf_counter, sleep
+from typing import Dict, Iterable, Optional
+
+
+class Histogram(object):
+    """
+    Fixed size histogram of durations (seconds), with an overflow bin
+    """
+    def __init__(self, bin_width: float, n_bins: int):
+        self.bin_width = bin_width
+        self.bins = array("L", [0]) * (n_bins + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value: float) -> None:
+        self.bins[min(int(value / self.bin_width), len(self.bins) - 1)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p: float) -> float:
+        """
+        Upper edge of the bin containing the p-th percentile (max for the overflow bin)
+        """
+        if not self.count:
+            return 0.0
+        target = p / 100 * self.count
+        n = 0
+        for i, c in enumerate(self.bins):
+            n += c
+            if n >= target:
+                if i == len(self.bins) - 1:
+                    return self.max
+                return min((i + 1) * self.bin_width, self.max)
+        return self.max
+
+    def reset(self) -> None:
+        for i in range(len(self.bins)):
+            self.bins[i] = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def to_dict(self) -> Dict:
+        return {"bin_width": self.bin_width, "bins": list(self.bins), "count": self.count,
+                "total": self.total, "max": self.max}
+
+
+class FrameStats(object):
+    """
+    Per stage timing histograms, summarized to the log every log_interval frames
+    (and written to dump_path as json if set).
+    """
+    def __init__(self, stages: Iterable[str], log_interval: int,
+                 dump_path: Optional[str] = None, bin_width: float = 0.002, n_bins: int = 250):
+        self.histograms = {s: Histogram(bin_width, n_bins) for s in stages}
+        self.log_interval = log_interval
+        self.dump_path = dump_path
+        self.n_frames = 0
+        self.n_overruns = 0
+        self.n_dropped = 0
+
+    def record(self, stage: str, seconds: float) -> None:
+        self.histograms[stage].add(seconds)
+
+    def drop_frame(self) -> None:
+        """
+        A frame that was rendered but never shown (see output.OutputPipeline)
+        """
+        self.n_dropped += 1
+
+    def end_frame(self, overrun: bool = False) -> None:
+        self.n_frames += 1
+        self.n_overruns += overrun
+        if self.log_interval and self.n_frames % self.log_interval == 0:
+            logging.info(self.summary())
+            if self.dump_path is not None:
+                self.dump(self.dump_path)
+
+    def summary(self) -> str:
+        parts = []
+        for stage, h in self.histograms.items():
+            if not h.count:
+                continue
+            parts.append(f"{stage}: mean {1000 * h.total / h.count:.1f}ms "
+                         f"p95 {1000 * h.percentile(95):.1f}ms max {1000 * h.max:.1f}ms")
+        return (f"{self.n_frames} frames, {self.n_overruns} over budget, "
+                f"{self.n_dropped} dropped | "
+                + ", ".join(parts))
+
+    def dump(self, path: str) -> None:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"n_frames": self.n_frames, "n_overruns": self.n_overruns,
+                       "n_dropped": self.n_dropped,
+                       "stages": {s: h.to_dict() for s, h in self.histograms.items()}}, f)
+        os.replace(tmp_path, path)
+
+
+class FrameScheduler(object):
+    """
+    Sleeps until absolute frame deadlines, so time spent in a frame
+    doesn't accumulate as drift.
+
+    If a frame ends more than max_lag seconds after its deadline the schedule
+    is reset to now instead of rushing through the following frames.
+    """
+    def __init__(self, max_lag: float = 0.5):
+        self.max_lag = max_lag
+        self.deadline: Optional[float] = None
+
+    def reset(self) -> None:
+        self.deadline = None
+
+    def wait(self, period: float) -> float:
+        """
+        Wait for the end of a frame of length period, returns the time slept
+        (negative if the frame was late)
+        """
+        now = perf_counter()
+        if self.deadline is None:
+            self.deadline = now
+        self.deadline += period
+        slack = self.deadline - now
+        if slack > 0:
+            sleep(slack)
+        elif -slack > self.max_lag:
+            self.deadline = now
+        return slack
@@ -0,0 +1,190 @@
+"""
+Precompiled consensus track, so playback doesn't have to redo the
+variant reconciliation in get_consensus_sequence.
+
+The Locus stream of a contig is stored as fixed width records sorted by position:
+    hom-ref run: kind=RUN, pos=first position, length=# of bases
+                 (bases are read from the 2-bit packed reference)
+    variant locus: kind=VARIANT, pos, bases, ref_status, ref_base, length=1
+Insertions produce multiple variant records with the same position.
+
+As the records have fixed width and are sorted they are directly
+binary searchable, so no separate index is needed.
+"""
+import logging
+import mmap
+import os
+import struct
+from itertools import repeat
+from typing import BinaryIO, Iterator, Union
+
+from dna import Base, CompactLocus, Locus, RefStatus, RS, FaiLine, get_consensus_sequence
+from packed_ref import PackedContig
+
+MAGIC = b"DNATRK02"
+# magic, VCF size, VCF mtime (ns), contig length, # of records
+HEADER = struct.Struct("<8sQQQQ")
+
+# kind, base 1, base 2, ref_status, ref_base, pos, length
+RECORD = struct.Struct("<BBBBBxxxII")
+
+RUN = 0
+VARIANT = 1
+
+REF_BLOCK_SIZE = 1 << 16
+
+
+class _RefLookup(object):
+    """
+    Block cached Base value lookup, used to check that hom-ref loci match the packed reference
+    """
+    def __init__(self, packed: PackedContig):
+        self.packed = packed
+        self.block_start = -1
+        self.block = b""
+
+    def __getitem__(self, i: int) -> int:
+        if not self.block_start <= i < self.block_start + len(self.block):
+            self.block_start = i
+            self.block = self.packed.get_codes(i, i + REF_BLOCK_SIZE)
+        return self.block[i - self.block_start]
+
+
+def compile_contig(vcf_path: str, packed: PackedContig, fai_line: FaiLine,
+                   out_file: BinaryIO) -> int:
+    """
+    Writes the consensus track of a contig to out_file, returns the # of records
+    """
+    # before reading, so a VCF that changes meanwhile makes the track stale
+    st = os.stat(vcf_path)
+    ref = _RefLookup(packed)
+    out_file.write(HEADER.pack(MAGIC, st.st_size, st.st_mtime_ns, packed.len, 0))
+
+    n_records = 0
+    run_start = None
+    run_len = 0
+    for l in get_consensus_sequence(vcf_path, None, fai_line, 0, reference=packed, compact=True):
+        is_ref = (l.rs == RS.hom_ref.value and l.b1 == l.b2 == l.rb and ref[l.pos - 1] == l.rb)
+        if is_ref and run_start is not None and l.pos == run_start + run_len:
+            run_len += 1
+            continue
+
+        if run_start is not None:
+            out_file.write(RECORD.pack(RUN, 0, 0, 0, 0, run_start, run_len))
+            n_records += 1
+            run_start = None
+
+        if is_ref:
+            run_start, run_len = l.pos, 1
+        else:
+            out_file.write(RECORD.pack(VARIANT, l.b1, l.b2, l.rs, l.rb, l.pos, 1))
+            n_records += 1
+
+    if run_start is not None:
+        out_file.write(RECORD.pack(RUN, 0, 0, 0, 0, run_start, run_len))
+        n_records += 1
+
+    out_file.seek(0)
+    out_file.write(HEADER.pack(MAGIC, st.st_size, st.st_mtime_ns, packed.len, n_records))
+    return n_records
+
+
+class ConsensusTrack(object):
+    """
+    Reader for a compiled consensus track. Bases of hom-ref runs are read from packed.
+    """
+    def __init__(self, filename: str, packed: PackedContig):
+        self.filename = filename
+        self.packed = packed
+        self.contig = packed.contig
+        self._file = open(filename, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, self.vcf_size, self.vcf_mtime_ns, self.len,
+         self.n_records) = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{filename} is not a consensus track file (or an old version)")
+        if self.len != packed.len:
+            self.close()
+            raise ValueError(f"{filename} doesn't match the packed reference of {self.contig}")
+
+    def close(self) -> None:
+        self._mmap.close()
+        self._file.close()
+
+    def is_valid_for(self, vcf_path: str) -> bool:
+        st = os.stat(vcf_path)
+        return st.st_size == self.vcf_size and st.st_mtime_ns == self.vcf_mtime_ns
+
+    def __enter__(self) -> "ConsensusTrack":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _record(self, i: int):
+        return RECORD.unpack_from(self._mmap, HEADER.size + i * RECORD.size)
+
+    def _find_record(self, pos: int) -> int:
+        """
+        Index of the first record containing a position >= pos
+        """
+        lower, upper = 0, self.n_records
+        while lower < upper:
+            mid = (lower + upper) // 2
+            if self._record(mid)[5] < pos:
+                lower = mid + 1
+            else:
+                upper = mid
+        if lower > 0:
+            kind, *_, r_pos, r_len = self._record(lower - 1)
+            if kind == RUN and r_pos + r_len > pos:
+                return lower - 1
+        return lower
+
+    def iterate_from(self, start_pos: int = 0,
+                     compact: bool = False) -> Iterator[Union[Locus, CompactLocus]]:
+        """
+        Same output as get_consensus_sequence starting at start_pos (0-based)
+        compact: yield CompactLocus instead of Locus
+        """
+        contig = self.contig
+        pos = start_pos + 1
+        for i in range(self._find_record(pos), self.n_records):
+            kind, b1, b2, ref_status, ref_base, r_pos, r_len = self._record(i)
+            if kind == VARIANT:
+                if compact:
+                    yield CompactLocus(contig, r_pos, b1, b2, ref_status, ref_base)
+                else:
+                    yield Locus(contig, r_pos, (Base(b1), Base(b2)), RefStatus(ref_status),
+                                ref_base=Base(ref_base))
+                continue
+
+            r_start = max(r_pos, pos)
+            r_end = r_pos + r_len
+            while r_start < r_end:
+                block_end = min(r_start + REF_BLOCK_SIZE, r_end)
+                if compact:
+                    codes = self.packed.get_codes(r_start - 1, block_end - 1)
+                    yield from map(CompactLocus, repeat(contig), range(r_start, block_end),
+                                   codes, codes, repeat(RS.hom_ref.value), codes)
+                else:
+                    for p, b in enumerate(self.packed.get_bases(r_start - 1, block_end - 1),
+                                          r_start):
+                        yield Locus(contig, p, (b, b), RS.hom_ref, ref_base=b)
+                r_start = block_end
+
+
+if __name__ == "__main__":
+    from config import CONTIGS, FAI_PATH, VCF_PATHS, PACKED_REF_PATHS, TRACK_PATHS
+    from dna import read_fai
+
+    logging.basicConfig(level="INFO")
+    fai_index = read_fai(FAI_PATH, CONTIGS)
+    for contig in CONTIGS:
+        logging.info(f"Compiling consensus track for {contig} to {TRACK_PATHS[contig]}")
+        with PackedContig(PACKED_REF_PATHS[contig], contig) as packed, \
+                open(TRACK_PATHS[contig], "wb") as out_file:
+            n = compile_contig(VCF_PATHS[contig], packed, fai_index[contig], out_file)
+        logging.info(f"{contig}: {n} records")
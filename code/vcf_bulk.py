@@ -0,0 +1,216 @@
+"""
+Bulk VCF loader producing columnar arrays instead of one Variant per line.
+
+Reads a contig VCF (or a byte range of it) in large chunks, drops filtered
+records before parsing anything but the FILTER column and stores the
+remaining records in flat arrays:
+    pos: position
+    type: VariantType value
+    ref_len / alt_len: length of ref / longest alt allele
+    qual: quality score
+    passed: 1 if FILTER is PASS
+    gt1 / gt2: genotype allele indices (gt2 is -1 for haploid calls)
+    alleles: Base values of all alleles (ref first, then alts), with
+             allele_offsets[record_alleles[i]:record_alleles[i + 1] + 1]
+             delimiting the alleles of record i
+    pl: phred scaled likelihoods, pl_offsets[i]:pl_offsets[i + 1] for record i
+
+Run directly to benchmark it against VCFFile on a whole contig.
+"""
+import os
+from array import array
+from itertools import accumulate, chain
+from typing import BinaryIO, Iterator, List, Optional
+
+from bgzf import open_file
+from dna import Base, Variant, VariantType, VT, VCFFile, base_to_enum
+
+CHUNK_SIZE = 1 << 18
+LINE_READ_SIZE = 4096
+
+_BASE_TRANSLATION = bytearray(range(256))
+for _c, _b in base_to_enum.items():
+    _BASE_TRANSLATION[ord(_c)] = _b.value
+_BASE_TRANSLATION = bytes(_BASE_TRANSLATION)
+
+_SNP, _INS, _DEL, _OTHER = VT.SNP.value, VT.INS.value, VT.DEL.value, VT.OTHER.value
+
+
+class VariantColumns(object):
+    def __init__(self, contig: str):
+        self.contig = contig
+        self.pos = array("L")
+        self.type = array("B")
+        self.ref_len = array("L")
+        self.alt_len = array("L")
+        self.qual = array("d")
+        self.passed = array("B")
+        self.gt1 = array("b")
+        self.gt2 = array("b")
+        self.alleles = bytearray()
+        self.allele_offsets = array("L", [0])
+        self.record_alleles = array("L", [0])
+        self.pl = array("l")
+        self.pl_offsets = array("L", [0])
+
+    def __len__(self) -> int:
+        return len(self.pos)
+
+    def get_alleles(self, i: int) -> List[bytes]:
+        """
+        Encoded (Base values) alleles of record i, ref first
+        """
+        offsets = self.allele_offsets[self.record_alleles[i]:self.record_alleles[i + 1] + 1]
+        return [self.alleles[a:b] for a, b in zip(offsets, offsets[1:])]
+
+    def get_variant(self, i: int) -> Variant:
+        """
+        Record i as a dna.Variant (info is not kept)
+        """
+        ref, *alts = [[Base(b) for b in allele] for allele in self.get_alleles(i)]
+        gt = (self.gt1[i],) if self.gt2[i] < 0 else (self.gt1[i], self.gt2[i])
+        pl = ",".join(str(p) for p in self.pl[self.pl_offsets[i]:self.pl_offsets[i + 1]])
+        return Variant(contig=self.contig, pos=self.pos[i], type=VariantType(self.type[i]),
+                       ref=ref, alts=alts, qual=self.qual[i],
+                       filter="PASS" if self.passed[i] else "", info="", gt=gt, pl=pl)
+
+    def nbytes(self) -> int:
+        """
+        Approximate memory use of the columns
+        """
+        return sum(len(a) * a.itemsize for a in (
+            self.pos, self.type, self.ref_len, self.alt_len, self.qual, self.passed, self.gt1,
+            self.gt2, self.allele_offsets, self.record_alleles, self.pl, self.pl_offsets)
+        ) + len(self.alleles)
+
+    def iterate_variants(self, start: int = 0) -> Iterator[Variant]:
+        for i in range(start, len(self)):
+            yield self.get_variant(i)
+
+    def _extend(self, lines: List[bytes], filter_status: bool) -> None:
+        """
+        Appends the records in lines, one column at a time
+        """
+        rows = [line.rstrip(b"\r").split(b"\t") for line in lines]
+        if filter_status:
+            rows = [r for r in rows if r[6] == b"PASS"]
+        if not rows:
+            return
+
+        self.pos.extend(map(int, [r[1] for r in rows]))
+        self.qual.extend(map(float, [r[5] for r in rows]))
+        self.passed.extend([r[6] == b"PASS" for r in rows])
+
+        refs = [r[3] for r in rows]
+        alts = [r[4].split(b",") for r in rows]
+        ref_lens = list(map(len, refs))
+        max_alt_lens = [max(map(len, a)) for a in alts]
+        min_alt_lens = [min(map(len, a)) for a in alts]
+        self.ref_len.extend(ref_lens)
+        self.alt_len.extend(max_alt_lens)
+        self.type.extend([
+            _SNP if rl == 1 and ma == 1 else
+            _INS if rl == 1 and mi > 1 else
+            _DEL if rl > 1 and ma == 1 else _OTHER
+            for rl, ma, mi in zip(ref_lens, max_alt_lens, min_alt_lens)])
+
+        alleles = [[ref] + a for ref, a in zip(refs, alts)]
+        flat = list(chain.from_iterable(alleles))
+        self.alleles += b"".join(flat).translate(_BASE_TRANSLATION)
+        self.allele_offsets.extend(accumulate(map(len, flat), initial=self.allele_offsets[-1]))
+        self.allele_offsets.pop(len(self.allele_offsets) - len(flat) - 1)
+        self.record_alleles.extend(accumulate(map(len, alleles), initial=self.record_alleles[-1]))
+        self.record_alleles.pop(len(self.record_alleles) - len(alleles) - 1)
+
+        samples = [r[-1].split(b":") for r in rows]
+        gts = [s[0].split(b"/") for s in samples]
+        self.gt1.extend([int(gt[0]) for gt in gts])
+        self.gt2.extend([int(gt[1]) if len(gt) > 1 else -1 for gt in gts])
+        # calls without likelihoods (GT only or ".") get an empty PL list
+        pls = [s[1].split(b",") if len(s) > 1 and s[1] != b"." else [] for s in samples]
+        self.pl.extend(map(int, chain.from_iterable(pls)))
+        self.pl_offsets.extend(accumulate(map(len, pls), initial=self.pl_offsets[-1]))
+        self.pl_offsets.pop(len(self.pl_offsets) - len(pls) - 1)
+
+
+def read_columns(vcf_path: str, contig: str, filter_status: bool = True,
+                 start_offset: int = 0, end_offset: Optional[int] = None,
+                 file: Optional[BinaryIO] = None) -> VariantColumns:
+    """
+    Reads all records whose line starts in [start_offset, end_offset).
+    file: already opened vcf_path (e.g. kept open across calls), it is seeked as needed.
+    """
+    if file is None:
+        with open_file(vcf_path) as f:
+            return read_columns(vcf_path, contig, filter_status, start_offset, end_offset, f)
+
+    f = file
+    cols = VariantColumns(contig)
+    prefix = contig.encode("ascii") + b"\t"
+    if end_offset is None:
+        end_offset = f.seek(0, os.SEEK_END)
+    offset = start_offset
+    if start_offset > 0:
+        # skip the partial line unless we start exactly at a line start
+        f.seek(start_offset - 1)
+        if f.read(1) != b"\n":
+            offset += len(f.readline())
+    f.seek(offset)
+
+    carry = b""
+    while offset < end_offset:
+        # don't read much past end_offset, only enough to complete the last line
+        chunk = f.read(min(max(end_offset - offset - len(carry), LINE_READ_SIZE), CHUNK_SIZE))
+        if not chunk and not carry:
+            break
+        data = carry + (chunk or b"\n")
+        # lines starting before end_offset, but only complete ones
+        cut = data.rfind(b"\n") + 1
+        if offset + cut > end_offset:
+            cut = data.find(b"\n", end_offset - offset - 1) + 1
+        carry = data[cut:]
+        lines = data[:cut].split(b"\n")
+        lines.pop()
+        offset += cut
+        cols._extend([line for line in lines if line.startswith(prefix)], filter_status)
+    return cols
+
+
+def iterate_variants_from(vcf_path: str, contig: str, pos: int,
+                          block_size: int = CHUNK_SIZE) -> Iterator[Variant]:
+    """
+    PASS variants at or after pos, read in blocks of block_size bytes.
+    Can be passed to dna.get_consensus_sequence instead of VCFFile.
+    """
+    with open_file(vcf_path) as f:
+        VCFFile(vcf_path, contig).seek_to_pos(f, pos)
+        offset = f.tell()
+        file_size = f.seek(0, os.SEEK_END)
+
+    while offset < file_size:
+        cols = read_columns(vcf_path, contig, start_offset=offset,
+                            end_offset=min(offset + block_size, file_size))
+        for v in cols.iterate_variants():
+            if v.pos >= pos:
+                yield v
+        offset += block_size
+
+
+if __name__ == "__main__":
+    import sys
+    from time import perf_counter
+    from config import VCF_PATHS
+
+    contig = sys.argv[1] if len(sys.argv) > 1 else "chr1"
+    vcf_path = VCF_PATHS[contig]
+
+    t0 = perf_counter()
+    with open(vcf_path, "rb") as f:
+        n_lines = sum(1 for _ in VCFFile(vcf_path, contig)._iterate_vcf(f))
+    t1 = perf_counter()
+    cols = read_columns(vcf_path, contig)
+    t2 = perf_counter()
+
+    print(f"{contig}: {n_lines} PASS records")
+    print(f"VCFFile per line: {t1 - t0:.2f}s ({n_lines / (t1 - t0):.0f} records/s)")
+    print(f"read_columns: {t2 - t1:.2f}s ({len(cols) / (t2 - t1):.0f} records/s)")
@@ -0,0 +1,169 @@
+"""
+Sidecar index for the (uncompressed) per contig VCF files.
+
+Stores the position and byte offset of every STRIDE-th record, so finding
+the first record at or after a position needs one lookup, one seek and
+a short sequential scan instead of a binary search over the whole file.
+
+The index is written to "{vcf_path}.idx":
+    header: magic, vcf size, vcf mtime (ns), stride, # of entries
+    positions: uint64 array
+    offsets: uint64 array
+"""
+import logging
+import os
+import struct
+import tempfile
+from array import array
+from bisect import bisect_left
+from typing import BinaryIO, Dict, Optional, Tuple
+
+from bgzf import open_file
+
+MAGIC = b"VCFIDX01"
+HEADER = struct.Struct("<8sQQQQ")
+
+DEFAULT_STRIDE = 64
+
+
+def index_path(vcf_path: str) -> str:
+    return vcf_path + ".idx"
+
+
+def _record_pos(line: bytes) -> Optional[int]:
+    if line.startswith(b"#"):
+        return None
+    cols = line.split(b"\t", 2)
+    if len(cols) < 3:
+        return None
+    return int(cols[1])
+
+
+class VCFIndex(object):
+    def __init__(self, positions: array, offsets: array, vcf_size: int, vcf_mtime_ns: int,
+                 stride: int):
+        self.positions = positions
+        self.offsets = offsets
+        self.vcf_size = vcf_size
+        self.vcf_mtime_ns = vcf_mtime_ns
+        self.stride = stride
+
+    @classmethod
+    def build(cls, vcf_path: str, stride: int = DEFAULT_STRIDE) -> "VCFIndex":
+        logging.info(f"Building index for {vcf_path}")
+        st = os.stat(vcf_path)
+        positions = array("Q")
+        offsets = array("Q")
+        with open_file(vcf_path) as f:
+            offset = 0
+            n = 0
+            for line in f:
+                pos = _record_pos(line)
+                if pos is not None:
+                    if n % stride == 0:
+                        positions.append(pos)
+                        offsets.append(offset)
+                    n += 1
+                offset += len(line)
+        return cls(positions, offsets, st.st_size, st.st_mtime_ns, stride)
+
+    @classmethod
+    def load(cls, filename: str) -> "VCFIndex":
+        with open(filename, "rb") as f:
+            magic, size, mtime_ns, stride, n = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{filename} is not a VCF index")
+            positions = array("Q")
+            positions.fromfile(f, n)
+            offsets = array("Q")
+            offsets.fromfile(f, n)
+        return cls(positions, offsets, size, mtime_ns, stride)
+
+    def save(self, filename: str) -> None:
+        # unique temp file, so concurrent writers of the same index don't mix their data
+        fd, tmp_filename = tempfile.mkstemp(prefix=os.path.basename(filename) + ".",
+                                            suffix=".tmp", dir=os.path.dirname(filename) or ".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(HEADER.pack(MAGIC, self.vcf_size, self.vcf_mtime_ns,
+                                    self.stride, len(self.positions)))
+                self.positions.tofile(f)
+                self.offsets.tofile(f)
+            os.replace(tmp_filename, filename)
+        except Exception:
+            os.remove(tmp_filename)
+            raise
+
+    def is_valid_for(self, vcf_path: str) -> bool:
+        st = os.stat(vcf_path)
+        return st.st_size == self.vcf_size and st.st_mtime_ns == self.vcf_mtime_ns
+
+    def seek_to_pos(self, file: BinaryIO, pos: int) -> None:
+        """
+        Seek file to the first record with position >= pos
+        """
+        if not self.positions:
+            file.seek(0, os.SEEK_END)
+            return
+        i = max(bisect_left(self.positions, pos) - 1, 0)
+        offset = self.offsets[i]
+        file.seek(offset)
+        for line in iter(file.readline, b""):
+            line_pos = _record_pos(line)
+            if line_pos is not None and line_pos >= pos:
+                break
+            offset += len(line)
+        file.seek(offset)
+
+
+_index_cache: Dict[str, Tuple[VCFIndex, int, int]] = {}
+
+
+def get_index(vcf_path: str, rebuild_stale: bool = True) -> Optional[VCFIndex]:
+    """
+    Returns the index for vcf_path, or None if there is no index file.
+    Stale index files (VCF size/mtime changed) are rebuilt if rebuild_stale is True.
+    """
+    idx_path = index_path(vcf_path)
+    if not os.path.exists(idx_path):
+        return None
+
+    st = os.stat(vcf_path)
+    cached = _index_cache.get(vcf_path)
+    if cached is not None and cached[1:] == (st.st_size, st.st_mtime_ns):
+        return cached[0]
+
+    try:
+        index = VCFIndex.load(idx_path)
+    except (ValueError, struct.error, EOFError) as e:
+        logging.warning(f"Could not read index {idx_path}: {e}")
+        index = None
+
+    if index is None or not index.is_valid_for(vcf_path):
+        if not rebuild_stale:
+            return None
+        logging.warning(f"Index {idx_path} is stale, rebuilding")
+        index = VCFIndex.build(vcf_path, index.stride if index is not None else DEFAULT_STRIDE)
+        try:
+            index.save(idx_path)
+        except OSError as e:
+            logging.warning(f"Could not write index {idx_path}: {e}")
+
+    _index_cache[vcf_path] = (index, index.vcf_size, index.vcf_mtime_ns)
+    return index
+
+
+if __name__ == "__main__":
+    from config import VCF_PATHS
+
+    logging.basicConfig(level="INFO")
+    for contig, vcf_path in VCF_PATHS.items():
+        idx_path = index_path(vcf_path)
+        if os.path.exists(idx_path):
+            try:
+                if VCFIndex.load(idx_path).is_valid_for(vcf_path):
+                    logging.info(f"Index for {contig} is up to date")
+                    continue
+            except (ValueError, struct.error, EOFError):
+                pass
+        VCFIndex.build(vcf_path).save(idx_path)